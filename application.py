@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 from remedy.radremedy import create_app
 from remedy.sitemap import create_sitemap
+from remedy.rad.models import db
+from remedy.rad.textsearch import get_backend
+from remedy.rad.gazetteer import build_gazetteer
+import remedy.rad.aggregateservice
+from remedy.jobs import run_worker
+from remedy.benchmark.runner import run_benchmarks, save_results, \
+    load_results, compare_results, format_results, format_comparison
 
 import os
 
@@ -22,5 +29,146 @@ def sitemap():
     create_sitemap(application)
 
 
+@manager.command
+def reindex():
+    """
+    Rebuilds the full-text search index for the configured backend.
+    """
+    with application.app_context():
+        get_backend(application).rebuild(db.session)
+        db.session.commit()
+
+
+@manager.option(
+    '-r', '--repair', dest='repair', action='store_true', default=False,
+    help='Recalculate aggregates for resources that have drifted.')
+@manager.option(
+    '-b', '--rebuild', dest='rebuild', action='store_true', default=False,
+    help='Recalculate aggregates for all resources.')
+def aggregates(repair, rebuild):
+    """
+    Verifies the aggregate review scores against the reviews,
+    optionally repairing or fully rebuilding them.
+    """
+    with application.app_context():
+        if rebuild:
+            remedy.rad.aggregateservice.rebuild_aggregates(db.session)
+            db.session.commit()
+            print('Rebuilt aggregates for all resources.')
+            return
+
+        drifted = remedy.rad.aggregateservice.verify_aggregates(db.session)
+
+        if len(drifted) == 0:
+            print('All aggregates are up to date.')
+            return
+
+        print('Aggregates out of date for resources: ' +
+              ', '.join(str(res_id) for res_id in drifted))
+
+        if repair:
+            remedy.rad.aggregateservice.update_resource_aggregates(
+                db.session,
+                drifted)
+            db.session.commit()
+            print('Repaired ' + str(len(drifted)) + ' resources.')
+
+
+@manager.option(
+    '-s', '--source', dest='source', required=True,
+    help='The path to the GeoNames US postal code file (US.txt).')
+def gazetteer(source):
+    """
+    Builds the offline gazetteer used to geocode ZIP codes, cities
+    and states without the external geocoding service.
+    """
+    zip_count, place_count = build_gazetteer(
+        source,
+        application.config['GAZETTEER_PATH'])
+
+    print('Built gazetteer with ' + str(zip_count) + ' ZIP codes and ' +
+          str(place_count) + ' places.')
+
+
+@manager.option(
+    '-o', '--once', dest='once', action='store_true', default=False,
+    help='Stop once there are no more queued jobs.')
+@manager.option(
+    '-i', '--interval', dest='interval', type=float, default=5,
+    help='The number of seconds to wait between checks for new jobs.')
+def worker(once, interval):
+    """
+    Runs queued background jobs, such as geocoding and imports.
+    """
+    with application.app_context():
+        run_worker(poll_interval=interval, once=once)
+
+
+@manager.option(
+    '-d', '--database', dest='database', default=None,
+    help='The SQLite database to benchmark against. A dataset is ' +
+    'generated in it if it doesn\'t exist. Defaults to a temporary file.')
+@manager.option(
+    '-r', '--resources', dest='resources', type=int, default=10000,
+    help='The number of resources to generate.')
+@manager.option(
+    '-u', '--users', dest='users', type=int, default=1000,
+    help='The number of users to generate.')
+@manager.option(
+    '-v', '--reviews', dest='reviews', type=int, default=20000,
+    help='The number of reviews to generate.')
+@manager.option(
+    '-s', '--seed', dest='seed', type=int, default=1,
+    help='The seed used to generate the dataset.')
+@manager.option(
+    '-n', '--repeat', dest='repeat', type=int, default=5,
+    help='The number of timed runs of each benchmark.')
+@manager.option(
+    '-i', '--import-rows', dest='import_rows', type=int, default=500,
+    help='The number of resources in each imported CSV file.')
+@manager.option(
+    '-g', '--only', dest='only', default=None,
+    help='A comma-separated list of the benchmark groups to run ' +
+    '(search, pages, aggregates, sitemap, import).')
+@manager.option(
+    '-o', '--output', dest='output', default=None,
+    help='The file to save the results to, as JSON.')
+@manager.option(
+    '-c', '--compare', dest='compare', default=None,
+    help='A results file from an earlier run to compare against.')
+def benchmark(database, resources, users, reviews, seed, repeat,
+              import_rows, only, output, compare):
+    """
+    Times searches, resource pages, search suggestions, imports,
+    aggregate recalculation and sitemap generation against a
+    synthetic SQLite dataset.
+    """
+    results = run_benchmarks(
+        application,
+        database_path=database,
+        resources=resources,
+        users=users,
+        reviews=reviews,
+        seed=seed,
+        repeat=repeat,
+        import_rows=import_rows,
+        only=only.split(',') if only else None)
+
+    print(format_results(results))
+
+    if output:
+        save_results(results, output)
+        print('Saved results to ' + output)
+
+    if compare:
+        baseline = load_results(compare)
+
+        if baseline.get('dataset') != results.get('dataset'):
+            print('The datasets differ, so the timings may not be ' +
+                  'comparable.')
+
+        print(format_comparison(compare_results(baseline, results)))
+
+
 if __name__ == '__main__':
     manager.run()
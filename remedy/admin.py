@@ -56,6 +56,12 @@ resource_path = op.join(op.dirname(__file__), 'imports', 'resources')
 if not op.exists(resource_path):
     os.makedirs(resource_path)
 
+# Do the same for import sessions, which hold parsed CSV files
+session_path = op.join(op.dirname(__file__), 'imports', 'sessions')
+
+if not op.exists(session_path):
+    os.makedirs(session_path)
+
 admin.add_view(resourceimportview.ResourceImportFilesView(
     resource_path,
     None,
@@ -63,7 +69,8 @@ admin.add_view(resourceimportview.ResourceImportFilesView(
     name='CSV Import'))
 admin.add_view(resourceimportview.ResourceImportView(
     db.session,
-    resource_path))
+    resource_path,
+    session_path))
 
 admin.add_view(resourceview.ResourceCategoryAssignView(db.session))
 admin.add_view(resourceview.ResourcePopulationAssignView(db.session))
@@ -110,6 +117,15 @@ admin.add_view(reviewview.ReviewView(
 
 admin.add_view(maintenanceview.MaintenanceView(db.session))
 
+admin.add_view(jobview.JobView(
+    db.session,
+    name='Jobs',
+    endpoint='jobview'))
+
+admin.add_view(profileview.ProfileView(
+    name='Profiles',
+    endpoint='profileview'))
+
 # Add a link back to the main site
 admin.add_link(MenuLink(name="Main Site", url='/'))
 
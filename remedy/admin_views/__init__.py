@@ -10,6 +10,8 @@ __all__ = [
     "populationview",
     "populationgroupview",
     "maintenanceview",
+    "jobview",
+    "profileview",
     "homeview",
     "newsview"
 ]
@@ -5,10 +5,11 @@ Contains helper classes and methods for administrative actions.
 """
 from urllib import quote
 
-from flask import redirect, url_for, escape, Markup
+from flask import redirect, url_for, escape, flash, Markup
 from flask.ext.login import current_user
 
 from remedy.remedy_utils import get_nl2br
+from remedy.caching import bump_version
 
 
 def nl2br_formatter(value, make_urls=True):
@@ -138,6 +139,45 @@ def get_email_link(user, subject=None):
         escape(user.email)))
 
 
+def get_job_link(job):
+    """
+    Gets a properly-escaped link to the job.
+
+    Args:
+        job: The job to link to.
+
+    Returns:
+        A properly-escaped link to the job.
+    """
+    return Markup(u'<a href="%s">%s</a>' % (
+        url_for('jobview.details_view', id=job.id),
+        escape(u'job #' + unicode(job.id))))
+
+
+def flash_job(job):
+    """
+    Flashes the results of a job if it has already finished, or a
+    link to follow its progress if it's still queued or running.
+
+    Args:
+        job: The job to describe.
+    """
+    if job.status in (u'queued', u'running'):
+        flash(
+            Markup(u'Started %s (%s). It will continue in the background.')
+            % (get_job_link(job), job.description),
+            'success')
+        return
+
+    if job.status == u'failed':
+        flash(u'The job failed: ' + (job.error or u''), 'error')
+    elif job.status == u'cancelled':
+        flash(u'The job was cancelled.', 'warning')
+
+    if job.messages:
+        flash(job.messages)
+
+
 class AdminAuthMixin(object):
     """
     A mixin for ensuring that only logged-in administrators
@@ -156,6 +196,31 @@ class AdminAuthMixin(object):
         return False
 
 
+class OptionCacheMixin(object):
+    """
+    A mixin for model views whose changes affect cached option
+    lists, such as the grouped categories used in searching.
+
+    Attributes:
+        cache_namespaces: The cache namespaces to invalidate
+            when models are changed.
+    """
+    cache_namespaces = ()
+
+    def invalidate_options(self):
+        """
+        Invalidates the cached option lists for this view.
+        """
+        for namespace in self.cache_namespaces:
+            bump_version(namespace)
+
+    def after_model_change(self, form, model, is_created):
+        self.invalidate_options()
+
+    def after_model_delete(self, model):
+        self.invalidate_options()
+
+
 # Defines column labels to be shared between resource views.
 resource_column_labels = {
     'id': 'ID',
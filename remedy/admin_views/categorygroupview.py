@@ -7,13 +7,16 @@ from admin_helpers import *
 
 from flask.ext.admin.contrib.sqla import ModelView
 
+from remedy.caching import CATEGORY_OPTIONS
 from remedy.rad.models import CategoryGroup
 
 
-class CategoryGroupView(AdminAuthMixin, ModelView):
+class CategoryGroupView(AdminAuthMixin, OptionCacheMixin, ModelView):
     """
     An administrative view for working with category groups.
     """
+    cache_namespaces = (CATEGORY_OPTIONS,)
+
     can_view_details = True
 
     # Allow exporting
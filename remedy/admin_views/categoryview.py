@@ -10,13 +10,17 @@ from flask.ext.admin import BaseView, expose
 from flask.ext.admin.contrib.sqla import ModelView
 from flask.ext.admin.actions import action
 
+from remedy.caching import CATEGORY_OPTIONS
 from remedy.rad.models import Category
+from remedy.jobs import enqueue_job
 
 
-class CategoryView(AdminAuthMixin, ModelView):
+class CategoryView(AdminAuthMixin, OptionCacheMixin, ModelView):
     """
     An administrative view for working with categories.
     """
+    cache_namespaces = (CATEGORY_OPTIONS,)
+
     can_view_details = True
 
     # Allow exporting
@@ -105,6 +109,7 @@ class CategoryView(AdminAuthMixin, ModelView):
 
             # Save our changes.
             self.session.commit()
+            self.invalidate_options()
 
         else:
             results.append('No categories were selected.')
@@ -171,43 +176,18 @@ class CategoryMergeView(AdminAuthMixin, BaseView):
                 None)
 
             if primary_category is not None:
-                # Build a list of all the results
-                results = []
-
-                results.append(
-                    'Primary category: ' + primary_category.name +
-                    ' (#' + str(primary_category.id) + ').')
-
-                for category in target_categories:
-                    # Skip over the primary category.
-                    if category.id == primary_category.id:
-                        continue
-
-                    # Build a helpful message string to use for messages.
-                    category_str = 'category #' + str(category.id) + \
-                        ' (' + category.name + ')'
-                    try:
-                        # Delegate all resources
-                        for resource in category.resources:
-
-                            # Make sure we're not double-adding
-                            if resource not in primary_category.resources:
-                                primary_category.resources.append(resource)
-
-                        # Delete the category
-                        self.session.delete(category)
-
-                    except Exception as ex:
-                        results.append(
-                            'Error merging ' + category_str + ': ' + str(ex))
-                    else:
-                        results.append('Merged ' + category_str + '.')
-
-                # Save our changes.
-                self.session.commit()
-
-                # Flash the results of everything
-                flash("\n".join(msg for msg in results))
+                # Moving resources can take a while for large
+                # categories, so do the merge in the background
+                job = enqueue_job(
+                    'merge-categories',
+                    'Merge ' + str(len(target_categories) - 1) +
+                    ' category(ies) into ' + primary_category.name,
+                    dict(
+                        primary_category_id=primary_category.id,
+                        category_ids=[c.id for c in target_categories]),
+                    current_user._get_current_object())
+
+                flash_job(job)
             else:
                 flash('The selected category was not found.', 'error')
 
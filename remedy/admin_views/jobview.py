@@ -0,0 +1,142 @@
+"""
+jobview.py
+
+Contains an administrative view for following background jobs.
+"""
+from admin_helpers import *
+
+from flask import flash
+from flask.ext.admin.actions import action
+from flask.ext.admin.contrib.sqla import ModelView
+from wtforms.validators import ValidationError
+
+from remedy.jobs import cancel_job, ACTIVE_STATUSES
+from remedy.rad.models import Job
+
+
+def job_progress_formatter(view, context, model, name):
+    """
+    Formats the progress of a job, including the total
+    number of items if it's known.
+
+    Args:
+        view: The current administrative view.
+        context: The current context.
+        model: The job being displayed.
+        name: The name of the column.
+
+    Returns:
+        The progress of the job.
+    """
+    if model.total is None:
+        return str(model.progress)
+
+    return str(model.progress) + ' / ' + str(model.total)
+
+
+class JobView(AdminAuthMixin, ModelView):
+    """
+    An administrative view for following and cancelling background jobs.
+    """
+    # Jobs are only created through other actions
+    can_create = False
+    can_edit = False
+
+    # Allow details
+    can_view_details = True
+    details_template = 'admin/job_details.html'
+
+    column_list = (
+        'description',
+        'status',
+        'progress',
+        'created_by',
+        'date_created',
+        'date_finished'
+    )
+
+    column_details_list = (
+        'description',
+        'job_type',
+        'status',
+        'progress',
+        'error',
+        'messages',
+        'created_by',
+        'worker',
+        'date_created',
+        'date_started',
+        'date_heartbeat',
+        'date_finished'
+    )
+
+    column_default_sort = ('date_created', True)
+
+    column_searchable_list = ('description',)
+
+    column_filters = (
+        'job_type',
+        'status',
+        'date_created'
+    )
+
+    column_labels = {
+        'job_type': 'Type',
+        'created_by': 'Started By'
+    }
+
+    column_formatters = {
+        'progress': job_progress_formatter,
+        'messages': lambda v, c, m, p:
+            nl2br_formatter(m.messages, make_urls=False),
+        'error': lambda v, c, m, p:
+            nl2br_formatter(m.error, make_urls=False)
+    }
+
+    def on_model_delete(self, model):
+        """
+        Prevents jobs from being deleted while they're still active.
+
+        Args:
+            model: The job being deleted.
+        """
+        if model.status in ACTIVE_STATUSES:
+            raise ValidationError(
+                'Jobs must be cancelled before they can be deleted.')
+
+    @action(
+        'cancel',
+        'Cancel',
+        'Are you sure you wish to cancel the selected jobs?')
+    def action_cancel(self, ids):
+        """
+        Attempts to cancel each of the specified jobs. Running jobs
+        will stop after they finish their current batch of work.
+
+        Args:
+            ids: The list of job IDs, indicating which jobs
+                should be cancelled.
+        """
+        target_jobs = self.get_query(). \
+            filter(self.model.id.in_(ids)).all()
+
+        # Build a list of all the results
+        results = []
+
+        for job in target_jobs:
+            job_str = 'job #' + str(job.id) + ' (' + job.description + ')'
+
+            if cancel_job(self.session, job):
+                results.append('Cancelled ' + job_str + '.')
+            else:
+                results.append(
+                    'Skipped ' + job_str + ', which has already finished.')
+
+        if len(results) == 0:
+            results.append('No jobs were selected.')
+
+        # Flash the results of everything
+        flash("\n".join(msg for msg in results))
+
+    def __init__(self, session, **kwargs):
+        super(JobView, self).__init__(Job, session, **kwargs)
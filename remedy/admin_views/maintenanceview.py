@@ -3,17 +3,16 @@ maintenanceview.py
 
 Contains maintenance views for performing dark magic upon data.
 """
-from datetime import datetime
-
 from admin_helpers import *
 
-from flask import redirect, flash, request
+from flask import redirect, request
 from flask.ext.admin import BaseView, expose
 from flask.ext.admin.helpers import get_redirect_target
 
 from remedy.remedyblueprint import group_active_populations, \
     group_active_categories
-from remedy.rad.models import Resource, Category, Population
+from remedy.rad.models import Category, Population
+from remedy.jobs import enqueue_job
 
 
 class MaintenanceView(AdminAuthMixin, BaseView):
@@ -49,37 +48,25 @@ class MaintenanceView(AdminAuthMixin, BaseView):
                 grouped_categories=grouped_categories,
                 return_url=return_url)
         else:
-            query = Resource.query
-
             # See if there's categories/populations to filter on
-            categories = request.form.getlist('categories')
-            populations = request.form.getlist('populations')
-
-            if len(categories) > 0:
-                query = query.filter(Resource.categories.any(
-                    Category.id.in_(categories)))
-
-            if len(populations) > 0:
-                query = query.filter(Resource.populations.any(
-                    Population.id.in_(populations)))
-
-            # Now apply our filtering.
-            target_resources = query.all()
-
-            if len(target_resources) > 0:
-                # Touch the last-updated date.
-                for resource in target_resources:
-                    resource.last_updated = datetime.utcnow()
-
-                # Save our changes.
-                self.session.commit()
-
-                # Indicate how many we changed.
-                flash(
-                    'Updated ' + str(len(target_resources)) + ' resource(s).',
-                    'success')
-            else:
-                flash('No resources matched the provided query.', 'warning')
+            category_ids = [
+                int(id) for id in request.form.getlist('categories')]
+            population_ids = [
+                int(id) for id in request.form.getlist('populations')]
+
+            # Touching every resource can take a while,
+            # so do it in the background
+            job = enqueue_job(
+                'touch-resources',
+                'Touch resources in ' + str(len(category_ids)) +
+                ' category(ies) and ' + str(len(population_ids)) +
+                ' population(s)',
+                dict(
+                    category_ids=category_ids,
+                    population_ids=population_ids),
+                current_user._get_current_object())
+
+            flash_job(job)
 
             return redirect(return_url)
 
@@ -7,13 +7,16 @@ from admin_helpers import *
 
 from flask.ext.admin.contrib.sqla import ModelView
 
+from remedy.caching import POPULATION_OPTIONS
 from remedy.rad.models import PopulationGroup
 
 
-class PopulationGroupView(AdminAuthMixin, ModelView):
+class PopulationGroupView(AdminAuthMixin, OptionCacheMixin, ModelView):
     """
     An administrative view for working with population groups.
     """
+    cache_namespaces = (POPULATION_OPTIONS,)
+
     can_view_details = True
 
     # Allow exporting
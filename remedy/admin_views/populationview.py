@@ -9,13 +9,16 @@ from flask import flash
 from flask.ext.admin.contrib.sqla import ModelView
 from flask.ext.admin.actions import action
 
+from remedy.caching import POPULATION_OPTIONS
 from remedy.rad.models import Population
 
 
-class PopulationView(AdminAuthMixin, ModelView):
+class PopulationView(AdminAuthMixin, OptionCacheMixin, ModelView):
     """
     An administrative view for working with populations.
     """
+    cache_namespaces = (POPULATION_OPTIONS,)
+
     can_view_details = True
 
     # Allow exporting
@@ -104,6 +107,7 @@ class PopulationView(AdminAuthMixin, ModelView):
 
             # Save our changes.
             self.session.commit()
+            self.invalidate_options()
 
         else:
             results.append('No populations were selected.')
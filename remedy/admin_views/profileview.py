@@ -0,0 +1,80 @@
+"""
+profileview.py
+
+Contains an administrative view for browsing request profiles.
+"""
+from admin_helpers import *
+
+from flask import abort, Response
+from flask.ext.admin import BaseView, expose
+
+from remedy.profiling import get_profiles, get_profile, clear_profiles, \
+    PROFILE_HEADER, PROFILE_ARG
+
+
+class ProfileView(AdminAuthMixin, BaseView):
+    """
+    An administrative view for browsing the profiles of
+    individual requests.
+    """
+    @expose('/')
+    def index(self):
+        """
+        A view for listing the stored profiles.
+        """
+        return self.render(
+            'admin/profile_list.html',
+            profiles=get_profiles(),
+            profile_header=PROFILE_HEADER,
+            profile_arg=PROFILE_ARG)
+
+    @expose('/<profile_id>/')
+    def details(self, profile_id):
+        """
+        A view for the details of a profile, including the functions
+        it spent the most time in and the SQL statements it ran.
+
+        Args:
+            profile_id: The ID of the profile.
+        """
+        profile = get_profile(profile_id)
+
+        if profile is None:
+            abort(404)
+
+        return self.render(
+            'admin/profile_details.html',
+            profile=profile,
+            top_functions=profile.top_functions())
+
+    @expose('/<profile_id>/collapsed')
+    def collapsed(self, profile_id):
+        """
+        Downloads a profile as collapsed stacks, for use with
+        flame graph tools.
+
+        Args:
+            profile_id: The ID of the profile.
+        """
+        profile = get_profile(profile_id)
+
+        if profile is None:
+            abort(404)
+
+        return Response(
+            profile.collapsed() + '\n',
+            mimetype='text/plain',
+            headers={
+                'Content-Disposition':
+                    'attachment; filename=profile-' + profile.id + '.txt'
+            })
+
+    @expose('/clear', methods=['POST'])
+    def clear(self):
+        """
+        Removes all stored profiles.
+        """
+        clear_profiles()
+        flash('Cleared all profiles.')
+
+        return redirect(self.get_url('profileview.index'))
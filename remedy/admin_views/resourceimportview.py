@@ -5,19 +5,17 @@ Contains administrative views for importing resources from CSV files.
 """
 from admin_helpers import *
 
-import os
 import os.path as op
 
 import werkzeug.security
-from werkzeug.datastructures import MultiDict
 
-from flask import flash, request
+from flask import current_app, flash, request, redirect, url_for
 from flask.ext.admin import BaseView, expose
 from flask.ext.admin.contrib.fileadmin import FileAdmin
 
-import remedy.data_importer.data_importer
-from remedy.rad.db_fun import get_or_create_resource
-from remedy.rad.models import Resource
+from remedy.data_importer.importsession import get_import_session
+from remedy.rad.db_fun import find_record_duplicates
+from remedy.jobs import enqueue_job
 
 
 class ResourceImportFilesView(AdminAuthMixin, FileAdmin):
@@ -54,12 +52,18 @@ class ResourceImportView(AdminAuthMixin, BaseView):
         A view for importing resources from a CSV file.
 
         This relies on a filename being provided via a "file"
-        query string parameter.
-
-        When actually importing resources via POST, the
-        following items are used from the submitted form:
-            rowid: A list of the row IDs to import, which
-                are indicated on the page via checkboxes.
+        query string parameter. The file is parsed once into an
+        import session, which is used to page through the rows
+        and to import them. A "page" query string parameter
+        indicates the zero-based page of rows to display.
+
+        When submitting the form via POST, the following items
+        are used from the submitted form:
+            rowid: A list of the row IDs on the current page to
+                import, which are indicated on the page via checkboxes.
+                The selection is remembered between pages.
+            goto_page: If provided, the selection is saved and the
+                user is redirected to the specified page.
             create_categories: If true, indicates that new
                 categories should be created for each
                 resource if it lists any that do not
@@ -74,18 +78,23 @@ class ResourceImportView(AdminAuthMixin, BaseView):
                 path: The name of the file being imported.
                 resource_fields: The names of the fields that
                     will be displayed in the importer.
-                resources: A list of the resources that
-                    were found in the CSV file. Each resource
-                    will have the following fields:
+                resources: A list of the rows on the current page.
+                    Each row will have the following fields:
                         row_index: The index of the row, starting with 1.
                         resource: The RadRecord read from the row.
                         valid: A boolean indicating if the record is valid.
                         has_dupes: A boolean indicating if there were
                             pre-existing resources with the same name or NPI.
-                        dupes: The existing resources detected as duplicates.
-
-            Upon a valid submission, the user will be
-            redirected to the list of CSV files.
+                        dupes: The IDs and names of the existing
+                            resources detected as duplicates.
+                        selected: A boolean indicating if the row is
+                            selected for importing.
+                page: The zero-based index of the current page.
+                num_pages: The total number of pages.
+                row_count: The total number of rows.
+
+            Upon a valid submission, an import job will be started
+            and the user will be redirected to the list of CSV files.
         """
         # Get the filename
         filename = request.args.get('file')
@@ -100,11 +109,16 @@ class ResourceImportView(AdminAuthMixin, BaseView):
             flash('The file "' + filename + '" does not exist.', 'error')
             return resourceimport_redirect()
 
-        # Let's get down to business. Load up the records.
-        radrecords = remedy.data_importer.data_importer.get_radrecords(
-            filepath)
+        # Let's get down to business. Load up the records,
+        # parsing the file if it's new or has changed.
+        import_session = get_import_session(
+            self.session_dir,
+            filepath,
+            lambda rad_records: find_record_duplicates(
+                self.session,
+                rad_records))
 
-        if len(radrecords) == 0:
+        if import_session.row_count == 0:
             flash('There are no rows in the provided file.', 'error')
             return resourceimport_redirect()
 
@@ -114,7 +128,7 @@ class ResourceImportView(AdminAuthMixin, BaseView):
         # and filter out population_names because we're using population_tags.
         resource_fields = [
             field
-            for field in radrecords[0]._fields
+            for field in import_session.fields
             if field not in (
                 'category_name',
                 'procedure_type',
@@ -122,62 +136,29 @@ class ResourceImportView(AdminAuthMixin, BaseView):
             )
         ]
 
-        # Get all existing resource names and build MultDicts
-        # based on the lowercase name and (if provided) the NPI
-        existing_resources = self.session.query(Resource).all()
-        dup_name_dict = MultiDict()
-        dup_npi_dict = MultiDict()
-
-        for res in existing_resources:
-            dup_name_dict.add(res.name.strip().lower(), res)
-
-            if res.npi and not res.npi.isspace():
-                dup_npi_dict.add(res.npi.strip().lower(), res)
-
-        # Now wrap each resource in a dict, with additional metadata
-        # such as the index of the resource in the list, whether it's
-        # valid, and if it has a duplicate
-        row_index = 0
-        wrapped_resources = []
-
-        for record in radrecords:
-            row_index += 1
-
-            # Find duplicates - build a set, starting with
-            # any duplicate names
-            dup_set = set(
-                dup_name_dict.getlist(record.name.strip().lower()))
-
-            # If the record has an NPI field as well, include
-            # any duplicates on the basis of NPI in the set
-            if record.npi and not record.npi.isspace():
-                dup_set.update(
-                    dup_npi_dict.getlist(record.npi.strip().lower()))
-
-            wrapped_resources.append(dict(
-                resource=record,
-                row_index=row_index,
-                valid=record.is_valid(),
-                has_dupes=(len(dup_set) > 0),
-                dupes=dup_set))
-
-        if request.method == 'GET':
-            return self.render(
-                'admin/resource_import.html',
-                path=filename,
-                resources=wrapped_resources,
-                resource_fields=resource_fields)
-        else:
-            row_ids = set(
-                [int(id) for id in request.form.getlist('rowid')])
-
-            if len(row_ids) == 0:
-                flash('No rows were selected.')
-                return self.render(
-                    'admin/resource_import.html',
-                    path=filename,
-                    resources=wrapped_resources,
-                    resource_fields=resource_fields)
+        # Figure out which page of rows we're on
+        page_size = current_app.config.get('IMPORT_PREVIEW_PAGE_SIZE', 100)
+        num_pages = (import_session.row_count + page_size - 1) // page_size
+        page = request.args.get('page', 0, type=int)
+        page = min(max(page, 0), num_pages - 1)
+
+        page_rows = list(import_session.iter_rows(
+            page * page_size,
+            (page + 1) * page_size))
+
+        if request.method == 'POST':
+            # Remember the selection for this page
+            import_session.update_selection(
+                page_rows,
+                set([int(id) for id in request.form.getlist('rowid')]))
+
+            goto_page = request.form.get('goto_page', type=int)
+
+            if goto_page is not None:
+                return redirect(url_for(
+                    '.index',
+                    file=filename,
+                    page=goto_page))
 
             # Get our other config options.
             create_categories = bool(
@@ -185,55 +166,46 @@ class ResourceImportView(AdminAuthMixin, BaseView):
             delete_after = bool(
                 request.form.get('delete_after', False))
 
-            results = []
-            had_row_error = False
-
-            # Buckle up. It's time.
-            for wrapped_res in wrapped_resources:
-                # Build a helpful string to use for messages.
-                row_str = 'row #' + str(wrapped_res['row_index']) + \
-                    ' (' + wrapped_res['resource'].name + ')'
-
-                try:
-                    # See if this row is selected and is valid.
-                    if wrapped_res['row_index'] in row_ids and \
-                            wrapped_res['valid']:
-
-                        # Create it and flash a message.
-                        get_or_create_resource(
-                            self.session,
-                            wrapped_res['resource'],
-                            create_categories=create_categories)
-                        results.append('Imported ' + row_str + '.')
-
-                except Exception as ex:
-                    results.append(
-                        'Error importing ' + row_str + ': ' + str(ex))
-                    had_row_error = True
-
-            # Now try to commit everything
-            try:
-                self.session.commit()
-            except Exception as ex:
-                results.append('Error committing changes: ' + str(ex))
-            else:
-                # If specified, clean up afterwards,
-                # since we didn't get a fatal error
-                if delete_after and not had_row_error:
-                    try:
-                        os.remove(filepath)
-                    except Exception as ex:
-                        results.append(
-                            'The import was successful, but there was ' +
-                            'an error deleting the file afterwards: ' +
-                            str(ex))
-
-            # Flash the results of everything
-            flash("\n".join(msg for msg in results))
+            if not any(True for row in import_session.iter_selected_rows()):
+                flash('No rows were selected.')
+                return redirect(url_for('.index', file=filename, page=page))
+
+            # Buckle up. It's time. Large files can take a while,
+            # so do the import in the background.
+            job = enqueue_job(
+                'import',
+                'Import ' + filename,
+                dict(
+                    file_path=filepath,
+                    session_dir=self.session_dir,
+                    create_categories=create_categories,
+                    delete_after=delete_after),
+                current_user._get_current_object())
+
+            flash_job(job)
 
             return resourceimport_redirect()
 
-    def __init__(self, session, basedir, **kwargs):
+        # Mark which rows on the page are selected
+        include, exclude = import_session.get_selection()
+
+        for row in page_rows:
+            row['selected'] = import_session.is_selected(
+                row,
+                include,
+                exclude)
+
+        return self.render(
+            'admin/resource_import.html',
+            path=filename,
+            resources=page_rows,
+            resource_fields=resource_fields,
+            page=page,
+            num_pages=num_pages,
+            row_count=import_session.row_count)
+
+    def __init__(self, session, basedir, session_dir, **kwargs):
         self.session = session
         self.basedir = basedir
+        self.session_dir = session_dir
         super(ResourceImportView, self).__init__(**kwargs)
@@ -7,8 +7,8 @@ from datetime import date, datetime
 
 from admin_helpers import *
 
-from sqlalchemy import or_, not_, and_, func
-from flask import current_app, redirect, flash, request, url_for
+from sqlalchemy import or_, not_, func
+from flask import redirect, flash, request, url_for
 from flask.ext.admin import BaseView, expose
 from flask.ext.admin.form import rules
 from flask.ext.admin.helpers import get_redirect_target
@@ -17,13 +17,11 @@ from flask.ext.admin.contrib.sqla import ModelView
 from flask.ext.admin.contrib.sqla.filters import FilterEmpty
 from wtforms import DecimalField, validators
 
-import geopy
-from geopy.exc import *
-
 from remedy.remedyblueprint import group_active_populations, \
     group_active_categories
-from remedy.rad.models import Resource, Category, Population
-from remedy.rad.geocoder import Geocoder
+from remedy.rad.models import Resource, Category, Population, \
+    get_duplicate_key
+from remedy.jobs import enqueue_job
 from remedy.rad.nullablebooleanfield import NullableBooleanField
 from remedy.rad.plaintextfield import PlainTextField
 from remedy.rad.statichtmlfield import StaticHtmlField
@@ -72,6 +70,9 @@ class ResourceView(AdminAuthMixin, ModelView):
         'longitude',
         'location',
         'category_text',
+        'geohash',
+        'normalized_name',
+        'normalized_npi',
         'overall_aggregate'
     )
 
@@ -158,6 +159,9 @@ class ResourceView(AdminAuthMixin, ModelView):
         'date_created',
         'last_updated',
         'category_text',
+        'geohash',
+        'normalized_name',
+        'normalized_npi',
         'reviews',
         'aggregateratings',
         'submitted_user',
@@ -460,77 +464,27 @@ class ResourceRequiringGeocodingView(ResourceView):
             ids: The list of resource IDs, indicating which resources
                 should be geocoded.
         """
-        # Load all resources by the set of IDs
-        target_resources = self.get_query(). \
-            filter(self.model.id.in_(ids)).all()
-
-        # Build a list of all the results
-        results = []
-
-        if len(target_resources) > 0:
-
-            # Set up the geocoder, and then try to geocode each resource
-            geocoder = Geocoder(
-                api_key=current_app.config.get('MAPS_SERVER_KEY'))
-
-            for resource in target_resources:
-                # Build a helpful message string to use for errors.
-                resource_str = 'resource #' + str(resource.id) + \
-                    ' (' + resource.name + ')'
-                try:
-                    geocoder.geocode(resource)
-                    resource.last_updated = datetime.utcnow()
-                except geopy.exc.GeopyError as gpex:
-                    # Handle Geopy errors separately
-                    exc_type = ''
-
-                    # Attempt to infer some extra information based
-                    # on the exception type
-                    if isinstance(
-                            gpex,
-                            geopy.exc.GeocoderQuotaExceeded):
-                        exc_type = 'quota exceeded'
-                    elif isinstance(
-                            gpex,
-                            geopy.exc.GeocoderAuthenticationFailure):
-                        exc_type = 'authentication failure'
-                    elif isinstance(
-                            gpex,
-                            geopy.exc.GeocoderInsufficientPrivileges):
-                        exc_type = 'insufficient privileges'
-                    elif isinstance(
-                            gpex,
-                            geopy.exc.GeocoderUnavailable):
-                        exc_type = 'server unavailable'
-                    elif isinstance(
-                            gpex,
-                            geopy.exc.GeocoderTimedOut):
-                        exc_type = 'timed out'
-                    elif isinstance(
-                            gpex,
-                            geopy.exc.GeocoderQueryError):
-                        exc_type = 'query error'
-
-                    if len(exc_type) > 0:
-                        exc_type = '(' + exc_type + ') '
-
-                    results.append(
-                        'Error geocoding ' + resource_str + ': ' +
-                        exc_type + str(gpex))
-                except Exception as ex:
-                    results.append(
-                        'Error geocoding ' + resource_str + ': ' + str(ex))
-                else:
-                    results.append('Geocoded ' + resource_str + '.')
-
-            # Save our changes.
-            self.session.commit()
-
-        else:
-            results.append('No resources were selected.')
-
-        # Flash the results of everything
-        flash("\n".join(msg for msg in results))
+        # Only include resources that still need geocoding
+        resource_ids = [
+            row.id
+            for row in self.get_query().
+            filter(self.model.id.in_(ids)).
+            with_entities(self.model.id).
+            order_by(self.model.id)
+        ]
+
+        if len(resource_ids) == 0:
+            flash('No resources were selected.')
+            return
+
+        # Geocoding can take a while, so run it in the background
+        job = enqueue_job(
+            'geocode',
+            'Geocode ' + str(len(resource_ids)) + ' resource(s)',
+            dict(resource_ids=resource_ids),
+            current_user._get_current_object())
+
+        flash_job(job)
 
     @action(
         'removeaddress',
@@ -744,39 +698,25 @@ class ResourceCategoryAssignView(AdminAuthMixin, BaseView):
         else:
             # Get the selected categories - use request.form,
             # not request.args
-            target_categories = Category.query.filter(
-                Category.id.in_(request.form.getlist('categories'))).all()
-
-            if len(target_categories) > 0:
-                # Build a list of all the results
-                results = []
-
-                for resource in target_resources:
-                    # Build a helpful message string to use for resources.
-                    resource_str = 'resource #' + str(resource.id) + \
-                        ' (' + resource.name + ')'
-
-                    try:
-                        # Assign all categories
-                        for category in target_categories:
-
-                            # Make sure we're not double-adding
-                            if category not in resource.categories:
-                                resource.categories.append(category)
-                                resource.last_updated = datetime.utcnow()
-
-                    except Exception as ex:
-                        results.append(
-                            'Error updating ' + resource_str + ': ' + str(ex))
-                    else:
-                        results.append(
-                            'Updated ' + resource_str + '.')
-
-                # Save our changes.
-                self.session.commit()
-
-                # Flash the results of everything
-                flash("\n".join(msg for msg in results))
+            category_ids = [
+                row.id
+                for row in Category.query.
+                filter(Category.id.in_(request.form.getlist('categories'))).
+                with_entities(Category.id)
+            ]
+
+            if len(category_ids) > 0:
+                job = enqueue_job(
+                    'assign-categories',
+                    'Assign ' + str(len(category_ids)) +
+                    ' category(ies) to ' + str(len(target_resources)) +
+                    ' resource(s)',
+                    dict(
+                        resource_ids=[r.id for r in target_resources],
+                        category_ids=category_ids),
+                    current_user._get_current_object())
+
+                flash_job(job)
             else:
                 flash('At least one category must be selected.', 'error')
 
@@ -835,39 +775,26 @@ class ResourcePopulationAssignView(AdminAuthMixin, BaseView):
         else:
             # Get the selected populations - use request.form,
             # not request.args
-            target_populations = Population.query.filter(
-                Population.id.in_(request.form.getlist('populations'))).all()
-
-            if len(target_populations) > 0:
-                # Build a list of all the results
-                results = []
-
-                for resource in target_resources:
-                    # Build a helpful message string to use for resources.
-                    resource_str = 'resource #' + str(resource.id) + \
-                        ' (' + resource.name + ')'
-
-                    try:
-                        # Assign all populations
-                        for population in target_populations:
-
-                            # Make sure we're not double-adding
-                            if population not in resource.populations:
-                                resource.populations.append(population)
-                                resource.last_updated = datetime.utcnow()
-
-                    except Exception as ex:
-                        results.append(
-                            'Error updating ' + resource_str + ': ' + str(ex))
-                    else:
-                        results.append(
-                            'Updated ' + resource_str + '.')
-
-                # Save our changes.
-                self.session.commit()
-
-                # Flash the results of everything
-                flash("\n".join(msg for msg in results))
+            population_ids = [
+                row.id
+                for row in Population.query.
+                filter(Population.id.in_(
+                    request.form.getlist('populations'))).
+                with_entities(Population.id)
+            ]
+
+            if len(population_ids) > 0:
+                job = enqueue_job(
+                    'assign-populations',
+                    'Assign ' + str(len(population_ids)) +
+                    ' population(s) to ' + str(len(target_resources)) +
+                    ' resource(s)',
+                    dict(
+                        resource_ids=[r.id for r in target_resources],
+                        population_ids=population_ids),
+                    current_user._get_current_object())
+
+                flash_job(job)
             else:
                 flash('At least one population must be selected.', 'error')
 
@@ -942,6 +869,9 @@ class SubmittedResourceView(AdminAuthMixin, ModelView):
         'longitude',
         'location',
         'category_text',
+        'geohash',
+        'normalized_name',
+        'normalized_npi',
         'is_approved',
         'visible',
         'date_verified',
@@ -1019,6 +949,9 @@ class SubmittedResourceView(AdminAuthMixin, ModelView):
         'date_created',
         'last_updated',
         'category_text',
+        'geohash',
+        'normalized_name',
+        'normalized_npi',
         'reviews',
         'aggregateratings',
         'submitted_user',
@@ -1172,14 +1105,18 @@ class SubmittedResourceView(AdminAuthMixin, ModelView):
         form = super(SubmittedResourceView, self).edit_form(obj)
 
         # Try to detect duplicates based on matching names/NPIs
+        dup_filters = [
+            Resource.normalized_name == get_duplicate_key(obj.name)
+        ]
+
+        npi_key = get_duplicate_key(obj.npi)
+
+        if npi_key is not None:
+            dup_filters.append(Resource.normalized_npi == npi_key)
+
         dup_resources = self.session.query(Resource). \
             filter(Resource.id != obj.id). \
-            filter(or_(
-                and_(
-                    Resource.npi != '',
-                    Resource.npi.isnot(None),
-                    Resource.npi == obj.npi),
-                Resource.name == obj.name.strip())). \
+            filter(or_(*dup_filters)). \
             all()
 
         if len(dup_resources) > 0:
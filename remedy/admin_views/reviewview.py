@@ -10,6 +10,7 @@ from flask.ext.admin.actions import action
 from flask.ext.admin.contrib.sqla import ModelView
 from wtforms import IntegerField, validators
 
+import remedy.rad.aggregateservice
 import remedy.rad.reviewservice
 from remedy.rad.models import Review
 
@@ -128,6 +129,20 @@ class ReviewView(AdminAuthMixin, ModelView):
 
         return form_class
 
+    def on_model_change(self, form, model, is_created):
+        """
+        Updates the aggregates for the review's resource
+        before an edited review is committed.
+
+        Args:
+            form: The source form.
+            model: The review being changed.
+            is_created: A boolean indicating if the review is new.
+        """
+        remedy.rad.aggregateservice.update_resource_aggregates(
+            self.session,
+            [model.resource_id])
+
     def delete_model(self, model):
         """
         Deletes the specified review.
@@ -193,7 +208,11 @@ class ReviewView(AdminAuthMixin, ModelView):
                     results.append(
                         'Marked ' + review_str + visible_status + '.')
 
-            # Save our changes.
+            # Update the aggregates of the affected resources
+            # and save our changes.
+            remedy.rad.aggregateservice.update_resource_aggregates(
+                self.session,
+                [review.resource_id for review in target_reviews])
             self.session.commit()
 
         else:
@@ -14,6 +14,7 @@ from flask.ext.admin.contrib.sqla import ModelView
 from wtforms import StringField, DecimalField, PasswordField, validators
 
 from remedy.rad.models import User
+import remedy.rad.aggregateservice
 
 
 class UserView(AdminAuthMixin, ModelView):
@@ -179,6 +180,8 @@ class UserView(AdminAuthMixin, ModelView):
             model: The model being updated.
         """
         try:
+            old_pop_ids = set(p.id for p in model.populations)
+
             form.populate_obj(model)
 
             # Are we specifying a new password?
@@ -198,6 +201,13 @@ class UserView(AdminAuthMixin, ModelView):
                 else:
                     raise ValueError('Passwords must match.')
 
+            # Update aggregates if the user's reviews now
+            # count towards different populations
+            if old_pop_ids != set(p.id for p in model.populations):
+                remedy.rad.aggregateservice.update_user_aggregates(
+                    self.session,
+                    model.id)
+
             self.session.commit()
             return True
         except Exception, ex:
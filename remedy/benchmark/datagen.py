@@ -0,0 +1,422 @@
+"""
+datagen.py
+
+Generates synthetic datasets for benchmarking.
+
+Resources are clustered around the largest US cities, with the rest
+scattered across the continental US, and are assigned to grouped
+categories and populations. Users leave reviews, and some users review
+the same resource more than once so that their earlier reviews are
+marked as old, as when reviews are resubmitted through the site.
+
+Rows are inserted in bulk (bypassing the ORM events that normally
+denormalize resources), so the same derived values are calculated here.
+"""
+from datetime import datetime, timedelta
+import random
+
+from remedy.rad.models import db, Resource, Category, CategoryGroup, \
+    Population, PopulationGroup, User, Review, resourcecategory, \
+    resourcepopulation, userpopulation, get_duplicate_key
+from remedy.rad.geoutils import geohash_encode
+from remedy.rad.textsearch import get_backend
+from remedy.rad.aggregateservice import rebuild_aggregates
+
+# The number of rows to insert at a time.
+INSERT_CHUNK_SIZE = 1000
+
+# Cities that resources are clustered around, with their coordinates
+# and relative weights.
+CITIES = (
+    (u'New York', u'NY', 40.7128, -74.0060, 20),
+    (u'Los Angeles', u'CA', 34.0522, -118.2437, 13),
+    (u'Chicago', u'IL', 41.8781, -87.6298, 9),
+    (u'Houston', u'TX', 29.7604, -95.3698, 7),
+    (u'Phoenix', u'AZ', 33.4484, -112.0740, 5),
+    (u'Philadelphia', u'PA', 39.9526, -75.1652, 5),
+    (u'San Antonio', u'TX', 29.4241, -98.4936, 4),
+    (u'San Diego', u'CA', 32.7157, -117.1611, 4),
+    (u'Dallas', u'TX', 32.7767, -96.7970, 4),
+    (u'San Francisco', u'CA', 37.7749, -122.4194, 6),
+    (u'Seattle', u'WA', 47.6062, -122.3321, 5),
+    (u'Denver', u'CO', 39.7392, -104.9903, 4),
+    (u'Boston', u'MA', 42.3601, -71.0589, 5),
+    (u'Atlanta', u'GA', 33.7490, -84.3880, 4),
+    (u'Miami', u'FL', 25.7617, -80.1918, 4),
+    (u'Minneapolis', u'MN', 44.9778, -93.2650, 3),
+    (u'Portland', u'OR', 45.5152, -122.6784, 3),
+    (u'Detroit', u'MI', 42.3314, -83.0458, 3),
+    (u'Washington', u'DC', 38.9072, -77.0369, 4),
+    (u'Nashville', u'TN', 36.1627, -86.7816, 2),
+)
+
+# The bounds of the continental US, for resources outside of cities.
+US_BOUNDS = (25.0, -124.5, 49.0, -67.0)
+
+# The fraction of resources scattered outside of cities.
+RURAL_FRACTION = 0.15
+
+# Words used to build names, descriptions and keywords.
+SPECIALTIES = (
+    u'primary care', u'hormone therapy', u'counseling', u'therapist',
+    u'surgery', u'dental', u'legal aid', u'voice therapy',
+    u'endocrinology', u'family medicine', u'psychiatry', u'pharmacy',
+    u'sexual health', u'housing', u'support group', u'urgent care',
+    u'gynecology', u'urology', u'dermatology', u'electrolysis'
+)
+
+NAME_WORDS = (
+    u'Community', u'Health', u'Center', u'Clinic', u'Wellness', u'Family',
+    u'Pride', u'Rainbow', u'Valley', u'Metro', u'Harbor', u'Bridge',
+    u'Riverside', u'Lakeside', u'Northside', u'Unity', u'Open Door',
+    u'Spectrum', u'Horizon', u'Beacon'
+)
+
+DESCRIPTION_WORDS = (
+    u'affirming', u'inclusive', u'sliding', u'scale', u'insurance',
+    u'accepted', u'walk-in', u'appointments', u'evening', u'weekend',
+    u'hours', u'bilingual', u'spanish', u'telehealth', u'referrals',
+    u'youth', u'adults', u'seniors', u'families', u'confidential'
+)
+
+POPULATION_NAMES = (
+    u'Trans Women', u'Trans Men', u'Nonbinary', u'Intersex', u'Youth',
+    u'Seniors', u'People of Color', u'Immigrants', u'Veterans',
+    u'People with Disabilities', u'Sex Workers', u'People Living with HIV'
+)
+
+
+def insert_rows(session, table, rows):
+    """
+    Inserts rows into a table in chunks.
+
+    Args:
+        session: The current database session.
+        table: The table to insert into.
+        rows: The list of dictionaries of column values to insert.
+    """
+    for start in xrange(0, len(rows), INSERT_CHUNK_SIZE):
+        session.execute(
+            table.insert(),
+            rows[start:start + INSERT_CHUNK_SIZE])
+
+
+def random_location(rnd):
+    """
+    Picks a location for a resource, usually near a city.
+
+    Args:
+        rnd: The random number generator.
+
+    Returns:
+        A tuple of the latitude, longitude and address.
+    """
+    if rnd.random() < RURAL_FRACTION:
+        min_lat, min_long, max_lat, max_long = US_BOUNDS
+        return (
+            rnd.uniform(min_lat, max_lat),
+            rnd.uniform(min_long, max_long),
+            u'%d County Road %d' % (rnd.randint(1, 9999), rnd.randint(1, 99)))
+
+    total = sum(city[4] for city in CITIES)
+    pick = rnd.uniform(0, total)
+
+    for name, state, lat, lng, weight in CITIES:
+        pick -= weight
+
+        if pick <= 0:
+            break
+
+    # Most resources are downtown, with a long tail into the suburbs
+    spread = 0.05 if rnd.random() < 0.7 else 0.3
+
+    return (
+        rnd.gauss(lat, spread),
+        rnd.gauss(lng, spread),
+        u'%d %s St, %s, %s' % (
+            rnd.randint(1, 9999),
+            rnd.choice(NAME_WORDS),
+            name,
+            state))
+
+
+def generate_dataset(
+        session,
+        resources=10000,
+        users=1000,
+        reviews=20000,
+        category_groups=6,
+        categories_per_group=10,
+        population_groups=3,
+        resubmit_fraction=0.1,
+        seed=1):
+    """
+    Generates a synthetic dataset in an empty database.
+
+    Args:
+        session: The current database session.
+        resources: The number of resources to generate.
+        users: The number of users to generate.
+        reviews: The number of current reviews to generate.
+        category_groups: The number of category groups to generate.
+        categories_per_group: The number of categories in each group.
+        population_groups: The number of population groups to generate.
+        resubmit_fraction: The fraction of reviews that replace an
+            earlier review by the same user.
+        seed: The seed for the random number generator, so that the
+            same dataset can be regenerated.
+
+    Returns:
+        A dictionary of the number of rows generated for each model.
+    """
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+
+    # Categories and populations are few, so use the ORM for them
+    category_list = []
+
+    for group_index in xrange(category_groups):
+        group = CategoryGroup(
+            name=u'Group %d' % (group_index + 1),
+            grouporder=float(group_index))
+
+        for cat_index in xrange(categories_per_group):
+            # Number the names once the specialties have been used up
+            repeat, specialty_index = divmod(
+                len(category_list),
+                len(SPECIALTIES))
+            name = SPECIALTIES[specialty_index].title()
+
+            if repeat > 0:
+                name += u' ' + unicode(repeat + 1)
+
+            category_list.append(Category(
+                name=name,
+                keywords=u', '.join(rnd.sample(SPECIALTIES, 3)),
+                grouping=group))
+
+    population_list = []
+
+    for group_index in xrange(population_groups):
+        group = PopulationGroup(
+            name=u'Population Group %d' % (group_index + 1),
+            grouporder=float(group_index))
+
+        for pop_index in xrange(group_index, len(POPULATION_NAMES),
+                                population_groups):
+            population_list.append(Population(
+                name=POPULATION_NAMES[pop_index],
+                keywords=POPULATION_NAMES[pop_index].lower(),
+                grouping=group))
+
+    session.add_all(category_list + population_list)
+    session.flush()
+
+    category_keywords = dict(
+        (c.id, c.name + u' ' + (c.keywords or u'')) for c in category_list)
+    population_keywords = dict(
+        (p.id, p.name + u' ' + (p.keywords or u''))
+        for p in population_list)
+    category_ids = sorted(category_keywords)
+    population_ids = sorted(population_keywords)
+
+    # Resources, along with their categories and populations
+    resource_rows = []
+    resource_category_rows = []
+    resource_population_rows = []
+
+    for resource_id in xrange(1, resources + 1):
+        latitude, longitude, address = random_location(rnd)
+        name = u'%s %s %s' % (
+            rnd.choice(NAME_WORDS),
+            rnd.choice(SPECIALTIES).title(),
+            rnd.choice(NAME_WORDS))
+        npi = u'%010d' % resource_id if rnd.random() < 0.3 else None
+
+        flags = dict(
+            is_icath=rnd.random() < 0.4,
+            is_wpath=rnd.random() < 0.3,
+            is_accessible=rnd.random() < 0.6,
+            has_sliding_scale=rnd.random() < 0.35)
+
+        res_categories = rnd.sample(category_ids, rnd.randint(1, 3))
+        res_populations = rnd.sample(population_ids, rnd.randint(0, 2))
+
+        search_keywords = \
+            [category_keywords[i] for i in res_categories] + \
+            [population_keywords[i] for i in res_populations]
+
+        if flags['is_icath']:
+            search_keywords.append(u'informed consent ICATH')
+
+        if flags['is_wpath']:
+            search_keywords.append(u'WPATH standards of care harry benjamin')
+
+        if flags['has_sliding_scale']:
+            search_keywords.append(u'sliding scale sliding fee')
+
+        if flags['is_accessible']:
+            search_keywords.append(u'ADA accessible wheelchair accessible')
+            search_keywords.append(u'handicap accessible')
+
+        created = now - timedelta(days=rnd.randint(0, 2000))
+
+        row = dict(
+            id=resource_id,
+            name=name,
+            organization=u'%s Health Network' % rnd.choice(NAME_WORDS),
+            description=u' '.join(
+                rnd.choice(DESCRIPTION_WORDS) for _ in xrange(25)),
+            visible=rnd.random() < 0.97,
+            is_approved=rnd.random() < 0.98,
+            address=address,
+            latitude=latitude,
+            longitude=longitude,
+            location=address,
+            geohash=unicode(geohash_encode(latitude, longitude)),
+            phone=u'555-%04d' % rnd.randint(0, 9999),
+            url=u'http://example.org/%d' % resource_id,
+            npi=npi,
+            category_text=u', '.join(search_keywords),
+            normalized_name=get_duplicate_key(name),
+            normalized_npi=get_duplicate_key(npi),
+            date_created=created,
+            last_updated=created + timedelta(days=rnd.randint(0, 365)))
+
+        row.update(flags)
+        resource_rows.append(row)
+
+        resource_category_rows.extend(
+            dict(resource_id=resource_id, category_id=i)
+            for i in res_categories)
+        resource_population_rows.extend(
+            dict(resource_id=resource_id, population_id=i)
+            for i in res_populations)
+
+    insert_rows(session, Resource.__table__, resource_rows)
+    insert_rows(session, resourcecategory, resource_category_rows)
+    insert_rows(session, resourcepopulation, resource_population_rows)
+
+    # Users. Passwords aren't hashed, since nobody logs in as them.
+    user_rows = []
+    user_population_rows = []
+
+    for user_id in xrange(1, users + 1):
+        user_rows.append(dict(
+            id=user_id,
+            username=u'user%d' % user_id,
+            email=u'user%d@example.org' % user_id,
+            password=u'',
+            display_name=u'User %d' % user_id,
+            email_activated=True,
+            date_created=now - timedelta(days=rnd.randint(0, 2000))))
+
+        user_population_rows.extend(
+            dict(user_id=user_id, population_id=i)
+            for i in rnd.sample(population_ids, rnd.randint(0, 2)))
+
+    insert_rows(session, User.__table__, user_rows)
+    insert_rows(session, userpopulation, user_population_rows)
+
+    # Reviews, with a few popular resources getting many of them
+    review_rows = []
+    reviewed = {}
+    popular = max(resources // 100, 1)
+
+    def add_review(resource_id, user_id, date_created):
+        ratings = [rnd.randint(1, 5) for _ in xrange(3)]
+        review_rows.append(dict(
+            id=len(review_rows) + 1,
+            text=u' '.join(
+                rnd.choice(DESCRIPTION_WORDS) for _ in xrange(40)),
+            rating=ratings[0],
+            staff_rating=ratings[1],
+            intake_rating=ratings[2],
+            composite_rating=sum(ratings) / 3.0,
+            visible=rnd.random() < 0.97,
+            resource_id=resource_id,
+            user_id=user_id,
+            is_old_review=False,
+            date_created=date_created))
+
+        return review_rows[-1]
+
+    if resources > 0 and users > 0:
+        for _ in xrange(reviews):
+            if rnd.random() < 0.3:
+                resource_id = rnd.randint(1, popular)
+            else:
+                resource_id = rnd.randint(1, resources)
+
+            user_id = rnd.randint(1, users)
+            date_created = now - timedelta(days=rnd.randint(0, 1000))
+            previous = reviewed.get((resource_id, user_id))
+
+            if previous is not None or rnd.random() < resubmit_fraction:
+                # Replace the user's earlier review(s), as the site does
+                if previous is None:
+                    previous = [add_review(
+                        resource_id,
+                        user_id,
+                        date_created - timedelta(days=rnd.randint(1, 300)))]
+
+                review = add_review(resource_id, user_id, date_created)
+
+                for old_review in previous:
+                    old_review['is_old_review'] = True
+                    old_review['new_review_id'] = review['id']
+
+                previous.append(review)
+            else:
+                reviewed[(resource_id, user_id)] = \
+                    [add_review(resource_id, user_id, date_created)]
+
+    # Rows referring to newer reviews need those to be inserted first
+    for row in review_rows:
+        row.setdefault('new_review_id', None)
+
+    insert_rows(
+        session,
+        Review.__table__,
+        sorted(review_rows, key=lambda r: r['new_review_id'] is not None))
+
+    rebuild_aggregates(session)
+    get_backend().rebuild(session)
+    session.commit()
+
+    return {
+        'resources': len(resource_rows),
+        'categories': len(category_list),
+        'populations': len(population_list),
+        'users': len(user_rows),
+        'reviews': len(review_rows),
+        'old_reviews': sum(1 for r in review_rows if r['is_old_review'])
+    }
+
+
+def get_dataset_counts(session):
+    """
+    Counts the rows in an existing dataset.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        A dictionary of the number of rows for each model.
+    """
+    return {
+        'resources': session.query(Resource).count(),
+        'categories': session.query(Category).count(),
+        'populations': session.query(Population).count(),
+        'users': session.query(User).count(),
+        'reviews': session.query(Review).count(),
+        'old_reviews': session.query(Review).
+        filter(Review.is_old_review == True).count()
+    }
+
+
+def create_schema():
+    """
+    Creates the tables for a new benchmark database.
+    """
+    db.create_all()
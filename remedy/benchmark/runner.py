@@ -0,0 +1,669 @@
+"""
+runner.py
+
+Times the core operations of the site - searching, resource pages,
+search suggestions, CSV imports, aggregate recalculation and sitemap
+generation - against a synthetic SQLite dataset.
+
+Each operation is run a number of times after a warm-up run, and the
+minimum, median, 95th percentile and maximum durations are recorded.
+Results are saved as JSON so that they can be compared between
+revisions with compare_results.
+"""
+from datetime import datetime
+from timeit import default_timer
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+
+from sqlalchemy import func
+import sqlalchemy
+
+from remedy.rad.models import db, Resource, Category, Review
+from remedy.rad.aggregateservice import rebuild_aggregates, \
+    update_resource_aggregates
+from remedy.rad.db_fun import bulk_import_resources
+import remedy.rad.resourceservice
+from remedy.caching import init_cache
+from remedy.sitemap import create_sitemap
+from datagen import generate_dataset, get_dataset_counts, create_schema, \
+    CITIES, DESCRIPTION_WORDS
+
+# The version of the results format.
+RESULTS_VERSION = 1
+
+# The number of resources in each page of search results.
+SEARCH_PAGE_SIZE = 20
+
+# The prefixes timed against the search suggestions.
+AUTOCOMPLETE_PREFIXES = (u'h', u'co', u'hor', u'ther', u'trans', u'xyz')
+
+# The number of resources to recalculate aggregates for at a time.
+AGGREGATE_SAMPLE_SIZE = 100
+
+# The changes in median duration, as a fraction, that are reported
+# as regressions or improvements when comparing results.
+COMPARE_THRESHOLD = 0.1
+
+
+def summarize(durations):
+    """
+    Summarizes a list of durations.
+
+    Args:
+        durations: The durations, in seconds.
+
+    Returns:
+        A dictionary of the number of runs and the minimum, median,
+        mean, 95th percentile and maximum durations in milliseconds.
+    """
+    ordered = sorted(durations)
+    count = len(ordered)
+
+    def percentile(fraction):
+        return ordered[min(int(fraction * count), count - 1)] * 1000
+
+    return {
+        'runs': count,
+        'min_ms': ordered[0] * 1000,
+        'median_ms': percentile(0.5),
+        'mean_ms': sum(ordered) * 1000 / count,
+        'p95_ms': percentile(0.95),
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def time_calls(func, repeat, warmup=1, setup=None):
+    """
+    Times repeated calls to a function.
+
+    Args:
+        func: The function to time, which is passed the zero-based
+            number of the run.
+        repeat: The number of timed runs.
+        warmup: The number of untimed runs to make first. Optional.
+        setup: A function to call, untimed, before each run. It is
+            passed the number of the run. Optional.
+
+    Returns:
+        The summary of the durations, as returned by summarize.
+    """
+    durations = []
+
+    for run in xrange(warmup + repeat):
+        if setup is not None:
+            setup(run)
+
+        start = default_timer()
+        func(run)
+        elapsed = default_timer() - start
+
+        if run >= warmup:
+            durations.append(elapsed)
+
+    return summarize(durations)
+
+
+def get_revision():
+    """
+    Gets the git revision of the working tree.
+
+    Returns:
+        The commit hash, or None if it can't be determined.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_app(app, database_path):
+    """
+    Points an application at the benchmark database. This must be done
+    before the application has connected to its database.
+
+    An in-process cache is used, so that planner statistics and the
+    autocomplete index are kept between runs as they would be on the
+    site, but search results and counts aren't cached so that the
+    searches themselves are timed.
+
+    Args:
+        app: The application.
+        database_path: The path to the SQLite database.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.abspath(database_path)
+    app.config['CACHE_TYPE'] = 'simple'
+    app.config['SEARCH_RESULT_CACHE_ENABLED'] = False
+    app.config['SEARCH_COUNT_MODE'] = 'exact'
+    app.config['SQL_SLOW_REQUEST_LOG'] = None
+    app.config['SQL_SERVER_TIMING'] = False
+    app.config['JOBS_ASYNC'] = False
+    app.config['GAZETTEER_PATH'] = None
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    init_cache(app)
+
+
+def get_search_mixes(session):
+    """
+    Builds the searches to time, using the categories and
+    locations in the dataset.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        A list of tuples of the name of each search and its
+        searching parameters.
+    """
+    category_counts = session.query(Category.id, func.count()). \
+        join(Category.resources). \
+        group_by(Category.id). \
+        order_by(func.count().desc(), Category.id). \
+        all()
+
+    common_category = category_counts[0][0]
+    rare_category = category_counts[-1][0]
+    name, state, lat, lng, weight = CITIES[0]
+    other_name, other_state, other_lat, other_lng, other_weight = CITIES[-1]
+
+    def params(**kwargs):
+        search_params = {
+            'visible': True,
+            'is_approved': True
+        }
+
+        search_params.update(kwargs)
+        return search_params
+
+    return [
+        ('all', params()),
+        ('text', params(search=u'hormone therapy')),
+        ('text-prefix', params(search=u'coun')),
+        ('text-rare', params(search=DESCRIPTION_WORDS[-1] + u' dental')),
+        ('category-common', params(categories=[common_category])),
+        ('category-rare', params(categories=[rare_category])),
+        ('flags', params(icath=True, sliding_scale=True)),
+        ('location', params(lat=lat, long=lng, dist=25.0)),
+        ('location-small-city',
+            params(lat=other_lat, long=other_lng, dist=10.0)),
+        ('location-wide', params(lat=lat, long=lng, dist=250.0)),
+        ('location-category', params(
+            lat=lat, long=lng, dist=25.0, categories=[common_category])),
+        ('location-text', params(
+            lat=lat, long=lng, dist=50.0, search=u'counseling')),
+        ('location-distance-order', params(
+            lat=lat, long=lng, dist=25.0, order_by='distance')),
+        ('rating-order', params(order_by='rating')),
+        ('name-order', params(order_by='name', wpath=True))
+    ]
+
+
+def benchmark_search(app, repeat):
+    """
+    Times resourceservice.search for each of the search mixes.
+
+    Args:
+        app: The application.
+        repeat: The number of timed runs of each search.
+
+    Returns:
+        A dictionary of benchmark names to their summaries.
+    """
+    results = {}
+
+    with app.test_request_context():
+        for name, search_params in get_search_mixes(db.session):
+            def run(run_number):
+                # Each run gets a fresh copy, in case it's normalized
+                remedy.rad.resourceservice.search(
+                    dict(search_params),
+                    page_size=SEARCH_PAGE_SIZE,
+                    page_number=1)
+
+                db.session.remove()
+
+            results['search.' + name] = time_calls(run, repeat)
+
+    return results
+
+
+def benchmark_pages(app, repeat, resource_ids):
+    """
+    Times the resource page and the search suggestions through
+    the test client.
+
+    Args:
+        app: The application.
+        repeat: The number of timed runs of each benchmark.
+        resource_ids: The IDs of the resources to show pages for,
+            which are used in turn.
+
+    Returns:
+        A dictionary of benchmark names to their summaries.
+    """
+    results = {}
+    client = app.test_client()
+
+    def get(url):
+        response = client.get(url)
+
+        if response.status_code != 200:
+            raise RuntimeError(
+                url + ' returned ' + str(response.status_code))
+
+    # Pages are cached for logged-out users, so time them uncached
+    def clear_cache(run):
+        app.extensions['remedy_cache'].clear()
+
+    results['page.resource'] = time_calls(
+        lambda run: get(
+            '/resource/' + str(resource_ids[run % len(resource_ids)]) + '/'),
+        repeat,
+        setup=clear_cache)
+
+    # Building the index is part of the first suggestion after a change
+    def clear_index(run):
+        app.extensions.pop('remedy_autocomplete', None)
+
+    results['autocomplete.build'] = time_calls(
+        lambda run: get('/search-suggest/' + AUTOCOMPLETE_PREFIXES[0]),
+        repeat,
+        setup=clear_index)
+
+    results['autocomplete.lookup'] = time_calls(
+        lambda run: get(
+            '/search-suggest/' +
+            AUTOCOMPLETE_PREFIXES[run % len(AUTOCOMPLETE_PREFIXES)]),
+        repeat * len(AUTOCOMPLETE_PREFIXES))
+
+    return results
+
+
+def benchmark_aggregates(app, repeat):
+    """
+    Times the recalculation of aggregate review scores.
+
+    Args:
+        app: The application.
+        repeat: The number of timed runs of each benchmark.
+
+    Returns:
+        A dictionary of benchmark names to their summaries.
+    """
+    results = {}
+
+    with app.app_context():
+        reviewed_ids = [
+            r[0] for r in db.session.query(Review.resource_id).distinct()
+        ]
+
+        def rebuild(run):
+            rebuild_aggregates(db.session)
+            db.session.commit()
+
+        def update(run):
+            rnd = random.Random(run)
+            update_resource_aggregates(
+                db.session,
+                rnd.sample(
+                    reviewed_ids,
+                    min(AGGREGATE_SAMPLE_SIZE, len(reviewed_ids))))
+            db.session.commit()
+
+        results['aggregates.rebuild'] = time_calls(rebuild, repeat)
+
+        if len(reviewed_ids) > 0:
+            results['aggregates.update'] = time_calls(update, repeat)
+
+    return results
+
+
+def benchmark_sitemap(app, repeat, work_dir):
+    """
+    Times the generation of the sitemap.
+
+    Args:
+        app: The application.
+        repeat: The number of timed runs.
+        work_dir: The directory to write the sitemap to.
+
+    Returns:
+        A dictionary of benchmark names to their summaries.
+    """
+    dest_folder = os.path.join(work_dir, 'robots')
+
+    return {
+        'sitemap': time_calls(
+            lambda run: create_sitemap(app, dest_folder),
+            repeat)
+    }
+
+
+def write_import_file(file_path, rows, category_names, seed):
+    """
+    Writes a CSV file of new resources to import.
+
+    Args:
+        file_path: The path of the file to write.
+        rows: The number of resources to write.
+        category_names: The names of the categories to assign
+            the resources to.
+        seed: The seed for the random number generator.
+    """
+    rnd = random.Random(seed)
+
+    with open(file_path, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([
+            'name', 'organization', 'description', 'address',
+            'phone', 'url', 'npi', 'category'])
+
+        for row in xrange(rows):
+            writer.writerow([
+                'Imported Clinic %d-%d' % (seed, row),
+                'Imported Health Network',
+                ' '.join(rnd.choice(DESCRIPTION_WORDS) for _ in xrange(25)),
+                '%d Main St, Anytown' % rnd.randint(1, 9999),
+                '555-%04d' % rnd.randint(0, 9999),
+                'example.org/imported/%d/%d' % (seed, row),
+                '',
+                rnd.choice(category_names).encode('utf-8')])
+
+
+def benchmark_import(app, repeat, rows, work_dir):
+    """
+    Times importing a CSV file of new resources. The imported
+    resources are left in the database.
+
+    Args:
+        app: The application.
+        repeat: The number of timed runs.
+        rows: The number of resources in each file.
+        work_dir: The directory to write the files to.
+
+    Returns:
+        A dictionary of benchmark names to their summaries, or to the
+        reason the benchmark was skipped.
+    """
+    try:
+        from remedy.data_importer.data_importer import iter_radrecords
+    except ImportError as ex:
+        return {'import.csv': {'skipped': str(ex)}}
+
+    with app.test_request_context():
+        category_names = [c[0] for c in db.session.query(Category.name)]
+        file_paths = []
+
+        # Each run imports its own file, so that nothing is a duplicate
+        for run in xrange(repeat + 1):
+            file_path = os.path.join(work_dir, 'import-%d.csv' % run)
+            write_import_file(file_path, rows, category_names, run)
+            file_paths.append(file_path)
+
+        def run(run_number):
+            bulk_import_resources(
+                db.session,
+                iter_radrecords(file_paths[run_number]),
+                create_categories=False,
+                chunk_size=app.config.get('IMPORT_CHUNK_SIZE', 500))
+
+            db.session.remove()
+
+        return {'import.csv': time_calls(run, repeat)}
+
+
+def run_benchmarks(
+        app,
+        database_path=None,
+        resources=10000,
+        users=1000,
+        reviews=20000,
+        seed=1,
+        repeat=5,
+        import_rows=500,
+        only=None):
+    """
+    Runs the benchmark suite.
+
+    Args:
+        app: The application, which must not have connected to its
+            database yet.
+        database_path: The path to the SQLite database to use. If the
+            file doesn't exist, a dataset is generated in it. If not
+            provided, a dataset is generated in a temporary file that
+            is removed afterwards.
+        resources: The number of resources to generate.
+        users: The number of users to generate.
+        reviews: The number of reviews to generate.
+        seed: The seed used to generate the dataset.
+        repeat: The number of timed runs of each benchmark.
+        import_rows: The number of resources in each imported CSV file.
+        only: A list of benchmark groups ("search", "pages",
+            "aggregates", "sitemap" or "import") to run. Optional;
+            all groups are run by default.
+
+    Returns:
+        A dictionary of the benchmark results, which can be saved
+        as JSON.
+    """
+    work_dir = tempfile.mkdtemp(prefix='remedy-benchmark-')
+
+    if database_path is None:
+        database_path = os.path.join(work_dir, 'benchmark.db')
+
+    configure_app(app, database_path)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'revision': get_revision(),
+        'created': datetime.utcnow().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'sqlite': __import__('sqlite3').sqlite_version,
+            'platform': platform.platform(),
+            'search_backend': app.config.get('SEARCH_BACKEND')
+        },
+        'settings': {
+            'repeat': repeat,
+            'seed': seed,
+            'import_rows': import_rows
+        },
+        'benchmarks': {}
+    }
+
+    try:
+        with app.app_context():
+            is_new = not os.path.exists(database_path) or \
+                os.path.getsize(database_path) == 0
+
+            if is_new:
+                create_schema()
+                start = default_timer()
+                generate_dataset(
+                    db.session,
+                    resources=resources,
+                    users=users,
+                    reviews=reviews,
+                    seed=seed)
+                results['generate_seconds'] = default_timer() - start
+
+            results['dataset'] = get_dataset_counts(db.session)
+
+            # Show the pages of the most-reviewed resources
+            page_ids = [
+                r[0] for r in
+                db.session.query(Resource.id).
+                join(Review, Review.resource_id == Resource.id).
+                filter(Resource.visible == True).
+                filter(Resource.is_approved == True).
+                group_by(Resource.id).
+                order_by(func.count(Review.id).desc(), Resource.id).
+                limit(10)
+            ] or [
+                r[0] for r in db.session.query(Resource.id).limit(10)
+            ]
+
+            db.session.remove()
+
+        benchmarks = results['benchmarks']
+        groups = (
+            ('search', lambda: benchmark_search(app, repeat)),
+            ('pages', lambda: benchmark_pages(app, repeat, page_ids)),
+            ('aggregates', lambda: benchmark_aggregates(app, repeat)),
+            ('sitemap', lambda: benchmark_sitemap(app, repeat, work_dir)),
+            # Imports change the dataset, so they're run last
+            ('import', lambda: benchmark_import(
+                app, repeat, import_rows, work_dir))
+        )
+
+        for group, benchmark in groups:
+            if only is None or group in only:
+                benchmarks.update(benchmark())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def save_results(results, file_path):
+    """
+    Saves benchmark results as JSON.
+
+    Args:
+        results: The benchmark results.
+        file_path: The path of the file to write.
+    """
+    with open(file_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(file_path):
+    """
+    Loads benchmark results saved with save_results.
+
+    Args:
+        file_path: The path of the file to read.
+
+    Returns:
+        The benchmark results.
+    """
+    with open(file_path, 'r') as results_file:
+        return json.load(results_file)
+
+
+def compare_results(baseline, current, threshold=COMPARE_THRESHOLD):
+    """
+    Compares the median durations of two sets of benchmark results.
+
+    Args:
+        baseline: The earlier benchmark results.
+        current: The later benchmark results.
+        threshold: The fractional change in median duration that is
+            reported as a regression or improvement. Optional.
+
+    Returns:
+        A list of tuples, ordered by benchmark name, containing the
+        benchmark name, the baseline and current median durations in
+        milliseconds (or None if the benchmark wasn't run), the
+        fractional change and a status of "slower", "faster", "same"
+        or "missing".
+    """
+    def median(results, name):
+        summary = results.get('benchmarks', {}).get(name)
+
+        if summary is None or 'median_ms' not in summary:
+            return None
+
+        return summary['median_ms']
+
+    names = sorted(
+        set(baseline.get('benchmarks', {})) |
+        set(current.get('benchmarks', {})))
+    comparison = []
+
+    for name in names:
+        before = median(baseline, name)
+        after = median(current, name)
+
+        if before is None or after is None:
+            comparison.append((name, before, after, None, 'missing'))
+            continue
+
+        change = (after - before) / before if before > 0 else 0.0
+
+        if change > threshold:
+            status = 'slower'
+        elif change < -threshold:
+            status = 'faster'
+        else:
+            status = 'same'
+
+        comparison.append((name, before, after, change, status))
+
+    return comparison
+
+
+def format_comparison(comparison):
+    """
+    Formats a comparison from compare_results as a table.
+
+    Args:
+        comparison: The comparison.
+
+    Returns:
+        The table, as a string.
+    """
+    def format_ms(value):
+        return '-' if value is None else '%.2f' % value
+
+    lines = ['%-32s %12s %12s %8s  %s' % (
+        'benchmark', 'before (ms)', 'after (ms)', 'change', 'status')]
+
+    for name, before, after, change, status in comparison:
+        lines.append('%-32s %12s %12s %8s  %s' % (
+            name,
+            format_ms(before),
+            format_ms(after),
+            '-' if change is None else '%+.0f%%' % (change * 100),
+            status))
+
+    return '\n'.join(lines)
+
+
+def format_results(results):
+    """
+    Formats benchmark results as a table.
+
+    Args:
+        results: The benchmark results.
+
+    Returns:
+        The table, as a string.
+    """
+    lines = ['%-32s %10s %10s %10s %10s' % (
+        'benchmark', 'min (ms)', 'median', 'p95', 'max')]
+
+    for name, summary in sorted(results['benchmarks'].iteritems()):
+        if 'skipped' in summary:
+            lines.append('%-32s skipped: %s' % (name, summary['skipped']))
+            continue
+
+        lines.append('%-32s %10.2f %10.2f %10.2f %10.2f' % (
+            name,
+            summary['min_ms'],
+            summary['median_ms'],
+            summary['p95_ms'],
+            summary['max_ms']))
+
+    return '\n'.join(lines)
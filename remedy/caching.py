@@ -0,0 +1,589 @@
+"""
+caching.py
+
+Contains the setup of the application-wide cache and helper methods
+for working with versioned cache namespaces and tags.
+
+A namespace groups related cache entries (such as the grouped category
+options) under a shared version number. Bumping the version invalidates
+every entry in the namespace at once, since subsequent lookups will use
+keys containing the new version. When the cache is shared between
+worker processes (as with the filesystem, memcached and redis backends),
+so are the namespace versions.
+
+Tags work the same way, but an entry can depend on any number of them.
+Each model's table name is a tag, and committing changes to a model
+invalidates every entry tagged with its table name.
+"""
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+import hashlib
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+from flask import current_app, has_app_context, request, session, \
+    make_response
+from flask.ext.login import current_user
+from sqlalchemy.orm import Session
+from sqlalchemy.event import listens_for
+from werkzeug.contrib.cache import BaseCache, NullCache, SimpleCache, \
+    FileSystemCache, MemcachedCache, RedisCache
+
+from metrics import CACHE_LOOKUPS
+
+# The namespace for grouped category options.
+CATEGORY_OPTIONS = 'category-options'
+
+# The namespace for grouped population options.
+POPULATION_OPTIONS = 'population-options'
+
+# How long namespace versions should be kept, in seconds. This is
+# the longest relative timeout that memcached supports.
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# How long to wait, in seconds, for another process to create a
+# coalesced entry before creating it anyway.
+COALESCE_WAIT = 10
+
+# How often to check for a coalesced entry created by another
+# process, in seconds.
+COALESCE_POLL_INTERVAL = 0.05
+
+
+class LRUCache(BaseCache):
+    """
+    An in-memory cache for a single process that evicts the least
+    recently used entries once it reaches its threshold. Values are
+    pickled, as with SimpleCache, so that callers can't modify
+    cached values in place.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self._cache = OrderedDict()
+        self._threshold = threshold
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.pop(key, None)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires != 0 and expires <= time.time():
+                return None
+
+            # Re-insert the entry to mark it as most recently used
+            self._cache[key] = entry
+
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        expires = time.time() + timeout if timeout > 0 else 0
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (expires, value)
+
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            entry = self._cache.get(key)
+
+            if entry is not None and \
+                    (entry[0] == 0 or entry[0] > time.time()):
+                return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+        return True
+
+
+class CacheStats(object):
+    """
+    Tracks cache hits and misses for each namespace in this process.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counts = {}
+
+    def record(self, namespace, hit):
+        """
+        Records a cache lookup.
+
+        Args:
+            namespace: The namespace of the entry.
+            hit: A boolean indicating if the entry was found.
+        """
+        with self._lock:
+            counts = self.counts.setdefault(namespace, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def snapshot(self):
+        """
+        Gets the current counts.
+
+        Returns:
+            A dictionary of namespaces to dictionaries containing
+            "hits" and "misses" counts.
+        """
+        with self._lock:
+            return dict(
+                (namespace, {'hits': counts[0], 'misses': counts[1]})
+                for namespace, counts in self.counts.iteritems())
+
+
+class Flight(object):
+    """
+    Tracks the creation of a cache entry in this process, so that
+    concurrent requests for the same missing entry share one result.
+    The result is kept pickled, so that each request gets its own copy.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.waiting = 0
+        self.value = None
+
+
+# The entries currently being created in this process, keyed on
+# their full cache keys, and the lock that guards them.
+_flights = {}
+_flights_lock = Lock()
+
+
+def init_cache(app):
+    """
+    Creates the cache for the provided application, based on its
+    CACHE_TYPE configuration value.
+
+    Args:
+        app: The application.
+
+    Returns:
+        The created cache.
+    """
+    cache_type = app.config.get('CACHE_TYPE', 'simple')
+    timeout = app.config.get('CACHE_DEFAULT_TIMEOUT', 300)
+    key_prefix = app.config.get('CACHE_KEY_PREFIX', 'remedy:')
+
+    if cache_type == 'null':
+        cache = NullCache()
+    elif cache_type == 'lru':
+        cache = LRUCache(
+            threshold=app.config.get('CACHE_THRESHOLD', 500),
+            default_timeout=timeout)
+    elif cache_type == 'simple':
+        cache = SimpleCache(default_timeout=timeout)
+    elif cache_type == 'filesystem':
+        cache = FileSystemCache(
+            app.config['CACHE_DIR'],
+            threshold=app.config.get('CACHE_THRESHOLD', 500),
+            default_timeout=timeout)
+    elif cache_type == 'memcached':
+        cache = MemcachedCache(
+            app.config.get('CACHE_MEMCACHED_SERVERS') or ['127.0.0.1:11211'],
+            default_timeout=timeout,
+            key_prefix=key_prefix)
+    elif cache_type == 'redis':
+        cache = RedisCache(
+            host=app.config.get('CACHE_REDIS_HOST', 'localhost'),
+            port=app.config.get('CACHE_REDIS_PORT', 6379),
+            password=app.config.get('CACHE_REDIS_PASSWORD'),
+            db=app.config.get('CACHE_REDIS_DB', 0),
+            default_timeout=timeout,
+            key_prefix=key_prefix)
+    else:
+        raise ValueError(
+            'Unrecognized CACHE_TYPE "' + str(cache_type) + '".')
+
+    app.extensions['remedy_cache'] = cache
+    app.extensions['remedy_cache_stats'] = CacheStats()
+    return cache
+
+
+def get_cache():
+    """
+    Gets the cache for the current application.
+
+    Returns:
+        The cache.
+    """
+    return current_app.extensions['remedy_cache']
+
+
+def get_cache_stats():
+    """
+    Gets the hit/miss counts for the current application's cache
+    in this process.
+
+    Returns:
+        A dictionary of namespaces to dictionaries containing
+        "hits" and "misses" counts.
+    """
+    return current_app.extensions['remedy_cache_stats'].snapshot()
+
+
+def new_version():
+    """
+    Generates a new namespace version.
+
+    Versions are based on the current time so that a namespace
+    whose version was evicted from the cache won't start reusing
+    the keys of older entries.
+
+    Returns:
+        The new version, as a string.
+    """
+    return '%x' % int(time.time() * 1000000)
+
+
+def get_version(namespace):
+    """
+    Gets the current version of the specified cache namespace,
+    creating it if necessary.
+
+    Args:
+        namespace: The name of the namespace.
+
+    Returns:
+        The current version, as a string.
+    """
+    cache = get_cache()
+    version_key = 'version:' + namespace
+    version = cache.get(version_key)
+
+    if version is None:
+        # Use add so that concurrent requests settle on one version
+        cache.add(version_key, new_version(), timeout=VERSION_TIMEOUT)
+        version = cache.get(version_key) or new_version()
+
+    return version
+
+
+def bump_version(namespace):
+    """
+    Invalidates all entries in the specified cache namespace.
+
+    Args:
+        namespace: The name of the namespace.
+    """
+    get_cache().set(
+        'version:' + namespace,
+        new_version(),
+        timeout=VERSION_TIMEOUT)
+
+
+def invalidate_tags(tags):
+    """
+    Invalidates all cache entries with any of the specified tags.
+
+    Args:
+        tags: The tags to invalidate.
+    """
+    for tag in tags:
+        bump_version('tag:' + tag)
+
+
+def make_key(namespace, key, tags=()):
+    """
+    Builds the full cache key for an entry, incorporating the current
+    versions of its namespace and tags. The entry key is hashed so
+    that arbitrary text can be used with memcached.
+
+    Args:
+        namespace: The name of the namespace.
+        key: The key of the entry within the namespace.
+        tags: The tags of the entry.
+
+    Returns:
+        The full cache key.
+    """
+    parts = [namespace, get_version(namespace)]
+
+    for tag in sorted(tags):
+        parts.append(get_version('tag:' + tag))
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    parts.append(hashlib.sha1(key).hexdigest())
+    return ':'.join(parts)
+
+
+def create_coalesced(cache, full_key, creator, timeout=None):
+    """
+    Creates a missing cache entry, making sure that concurrent
+    requests for the same entry only create it once.
+
+    Requests in this process wait for the first one to finish and each
+    receive their own copy of its result, as they would from the cache.
+    Requests in other processes wait for a lock entry in the shared cache
+    to be released, for up to COALESCE_WAIT seconds, before creating the
+    entry themselves.
+
+    Args:
+        cache: The cache.
+        full_key: The full cache key of the entry.
+        creator: A function that returns the value of the entry.
+        timeout: The number of seconds to keep the entry.
+
+    Returns:
+        The newly-created value.
+    """
+    with _flights_lock:
+        flight = _flights.get(full_key)
+
+        if flight is None:
+            flight = _flights[full_key] = Flight()
+
+        flight.waiting += 1
+
+    try:
+        with flight.lock:
+            # Another request in this process may have finished first
+            if flight.value is not None:
+                return pickle.loads(flight.value)
+
+            lock_key = 'lock:' + full_key
+            deadline = time.time() + COALESCE_WAIT
+            locked = cache.add(lock_key, True, timeout=COALESCE_WAIT)
+
+            while not locked and time.time() < deadline:
+                time.sleep(COALESCE_POLL_INTERVAL)
+                value = cache.get(full_key)
+
+                if value is not None:
+                    flight.value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                    return value
+
+                locked = cache.add(lock_key, True, timeout=COALESCE_WAIT)
+
+            try:
+                value = creator()
+                cache.set(full_key, value, timeout=timeout)
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+
+            flight.value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            return value
+    finally:
+        with _flights_lock:
+            flight.waiting -= 1
+
+            if flight.waiting == 0:
+                del _flights[full_key]
+
+
+def get_versioned(
+        namespace,
+        key,
+        creator,
+        timeout=None,
+        tags=(),
+        coalesce=False):
+    """
+    Gets an entry from a versioned cache namespace, creating it
+    if it does not exist.
+
+    Args:
+        namespace: The name of the namespace.
+        key: The key of the entry within the namespace.
+        creator: A function that returns the value of the entry.
+            The value must be able to be pickled.
+        timeout: The number of seconds to keep the entry. Defaults
+            to the CACHE_DEFAULT_TIMEOUT configuration value.
+        tags: The tags of the entry. Optional.
+        coalesce: If true, concurrent requests for the same missing
+            entry will wait for it to be created once, rather than
+            each creating it. Optional.
+
+    Returns:
+        The cached (or newly-created) value.
+    """
+    cache = get_cache()
+    full_key = make_key(namespace, key, tags)
+    value = cache.get(full_key)
+
+    current_app.extensions['remedy_cache_stats']. \
+        record(namespace, value is not None)
+    CACHE_LOOKUPS.inc(
+        namespace=namespace,
+        result='miss' if value is None else 'hit')
+
+    if value is None:
+        if coalesce:
+            value = create_coalesced(cache, full_key, creator, timeout)
+        else:
+            value = creator()
+            cache.set(full_key, value, timeout=timeout)
+
+    return value
+
+
+def memoize(namespace, tags=(), timeout=None):
+    """
+    A decorator that caches the results of a function, keyed on
+    its arguments. Arguments must have a stable representation
+    (such as strings and numbers) and results must be able to be
+    pickled, so ORM instances should not be returned.
+
+    Args:
+        namespace: The name of the namespace for cached results.
+        tags: The tags of the cached results. Optional.
+        timeout: The number of seconds to keep results. Optional.
+
+    Returns:
+        The decorated function.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = repr((args, sorted(kwargs.items())))
+
+            return get_versioned(
+                namespace,
+                key,
+                lambda: f(*args, **kwargs),
+                timeout=timeout,
+                tags=tags)
+
+        return decorated_function
+
+    return decorator
+
+
+def cached_view(namespace, tags=(), timeout=None):
+    """
+    A decorator that caches the rendered output of a view for
+    logged-out users, keyed on the full request path. Requests
+    from logged-in users, non-GET requests and requests with pending
+    flashed messages bypass the cache.
+
+    Args:
+        namespace: The name of the namespace for cached pages.
+        tags: The tags of the cached pages. Optional.
+        timeout: The number of seconds to keep pages. Defaults
+            to the CACHE_VIEW_TIMEOUT configuration value.
+
+    Returns:
+        The decorated view.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET' or \
+                    current_user.is_authenticated or \
+                    session.get('_flashes'):
+                return f(*args, **kwargs)
+
+            def render():
+                response = make_response(f(*args, **kwargs))
+
+                return (
+                    response.get_data(),
+                    response.status_code,
+                    response.mimetype)
+
+            data, status, mimetype = get_versioned(
+                namespace,
+                request.full_path,
+                render,
+                timeout=timeout or
+                current_app.config.get('CACHE_VIEW_TIMEOUT'),
+                tags=tags)
+
+            return current_app.response_class(
+                data,
+                status=status,
+                mimetype=mimetype)
+
+        return decorated_function
+
+    return decorator
+
+
+def add_session_tags(db_session, tags):
+    """
+    Records tags to invalidate once the session's current transaction
+    is committed. Used for changes made without the ORM (such as
+    bulk statements), which won't be collected automatically.
+
+    Args:
+        db_session: The database session.
+        tags: The tags to invalidate.
+    """
+    db_session.info.setdefault('remedy_cache_tags', set()).update(tags)
+
+
+@listens_for(Session, 'after_flush')
+def collect_tags(db_session, flush_context):
+    """
+    Records the tables of all models changed in a flush, so that
+    their tags can be invalidated once the changes are committed.
+
+    Args:
+        db_session: The session being flushed.
+        flush_context: The flush context.
+    """
+    tags = db_session.info.setdefault('remedy_cache_tags', set())
+
+    for obj in db_session.new | db_session.dirty | db_session.deleted:
+        table = getattr(obj, '__table__', None)
+
+        if table is not None:
+            tags.add(table.name)
+
+
+@listens_for(Session, 'after_commit')
+def invalidate_committed_tags(db_session):
+    """
+    Invalidates the tags of all models changed in a transaction
+    after it has been committed.
+
+    Args:
+        db_session: The session that was committed.
+    """
+    tags = db_session.info.pop('remedy_cache_tags', None)
+
+    if tags and has_app_context() and \
+            'remedy_cache' in current_app.extensions:
+        invalidate_tags(tags)
+
+
+@listens_for(Session, 'after_rollback')
+def discard_tags(db_session):
+    """
+    Discards the tags collected for a transaction that
+    was rolled back.
+
+    Args:
+        db_session: The session that was rolled back.
+    """
+    db_session.info.pop('remedy_cache_tags', None)
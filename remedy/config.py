@@ -35,11 +35,290 @@ class BaseConfig(object):
     """
     SECRET_KEY = 'Our little secret'
 
+    """
+    The backend to use for free-text resource searching. One of:
+        like: Unindexed substring matching against each column.
+        mysql: A MySQL FULLTEXT index.
+        sqlite: An SQLite FTS5 virtual table.
+        python: An in-process inverted index, refreshed as needed.
+    """
+    SEARCH_BACKEND = 'python'
+
+    """
+    If true, resource searches against visible, approved resources
+    will be answered from an in-memory snapshot where possible.
+    """
+    SEARCH_INDEX_ENABLED = False
+
+    """
+    The number of seconds between incremental refreshes of the
+    in-memory search snapshot.
+    """
+    SEARCH_INDEX_REFRESH_SECONDS = 30
+
+    """
+    The number of seconds between full rebuilds of the
+    in-memory search snapshot.
+    """
+    SEARCH_INDEX_REBUILD_SECONDS = 3600
+
+    """
+    The maximum age, in seconds, of the in-memory search snapshot
+    before searches fall back to the database.
+    """
+    SEARCH_INDEX_MAX_AGE = 300
+
+    """
+    How search results are counted. One of:
+        exact: The results are counted for every search.
+        cached: Counts are cached until resources are changed.
+        none: Results are not counted.
+    """
+    SEARCH_COUNT_MODE = 'cached'
+
+    """
+    If true, the IDs of matching resources are cached for each
+    search and page until resources are changed.
+    """
+    SEARCH_RESULT_CACHE_ENABLED = True
+
+    """
+    The number of seconds to keep cached search results.
+    """
+    SEARCH_RESULT_CACHE_TIMEOUT = 300
+
+    """
+    If true, database searches will find their candidates using
+    whichever filter (location, categories/populations or text) is
+    estimated to be the most selective. Otherwise, searches with a
+    location always start from it.
+    """
+    SEARCH_PLANNER_ENABLED = True
+
+    """
+    The number of seconds to keep the statistics used to plan searches,
+    which are also refreshed when resources are changed.
+    """
+    SEARCH_PLANNER_STATS_TIMEOUT = 3600
+
+    """
+    The type of cache to use. One of:
+        null: No caching.
+        lru: An in-memory cache for each process, evicting the least
+            recently used entries.
+        simple: An in-memory cache for each process.
+        filesystem: A cache in the CACHE_DIR directory, shared
+            between processes.
+        memcached: The memcached servers in CACHE_MEMCACHED_SERVERS.
+        redis: The redis server at CACHE_REDIS_HOST/CACHE_REDIS_PORT.
+    """
+    CACHE_TYPE = 'lru'
+
+    """
+    The default number of seconds to keep cached items.
+    """
+    CACHE_DEFAULT_TIMEOUT = 300
+
+    """
+    The number of seconds to keep cached pages for logged-out users.
+    """
+    CACHE_VIEW_TIMEOUT = 60
+
+    """
+    The prefix used for cache keys on shared cache servers.
+    """
+    CACHE_KEY_PREFIX = 'remedy:'
+
+    """
+    The directory used by the filesystem cache.
+    """
+    CACHE_DIR = os.path.join(_basedir, 'cache')
+
+    """
+    The number of resources, with the most reviews, to include in
+    search suggestions.
+    """
+    AUTOCOMPLETE_RESOURCE_LIMIT = 500
+
+    """
+    The number of seconds that browsers and proxies can keep
+    search suggestions.
+    """
+    AUTOCOMPLETE_MAX_AGE = 300
+
+    """
+    If true, the SQL statements run for each request are counted and
+    timed, to flag likely N+1 queries and log slow requests.
+    """
+    SQL_INSTRUMENTATION_ENABLED = True
+
+    """
+    The number of times a statement must be repeated in a request
+    (differing only in its parameters) to be flagged as a likely
+    N+1 query.
+    """
+    SQL_N_PLUS_ONE_THRESHOLD = 10
+
+    """
+    The number of seconds after which a request is written to
+    the slow-request log.
+    """
+    SQL_SLOW_REQUEST_SECONDS = 1.0
+
+    """
+    The number of statements after which a request is written to
+    the slow-request log.
+    """
+    SQL_SLOW_REQUEST_QUERIES = 100
+
+    """
+    The file to write slow requests to. If not set, slow requests
+    are written to the application's log.
+    """
+    SQL_SLOW_REQUEST_LOG = None
+
+    """
+    If true, the time spent in the database and the application is
+    returned to browsers through the Server-Timing header.
+    """
+    SQL_SERVER_TIMING = False
+
+    """
+    If true, administrators can profile individual requests by sending
+    the X-Remedy-Profile header or adding "_profile=1" to the query
+    string, and requests are also profiled at random based on
+    PROFILING_SAMPLE_RATE. Profiles are browsed under Admin > Profiles.
+    """
+    PROFILING_ENABLED = True
+
+    """
+    The fraction of requests to profile at random, such as 0.01 to
+    profile 1% of requests. Defaults to none.
+    """
+    PROFILING_SAMPLE_RATE = 0.0
+
+    """
+    The number of seconds between call stack samples while
+    profiling a request.
+    """
+    PROFILING_INTERVAL = 0.005
+
+    """
+    The number of the most recent profiles to keep.
+    """
+    PROFILING_BUFFER_SIZE = 50
+
+    """
+    If true, request latencies, SQL statements, cache lookups, geocoding
+    requests, emails and imports are measured and exposed at /metrics
+    in the Prometheus text format.
+    """
+    METRICS_ENABLED = True
+
+    """
+    The directory where each process writes its metrics, so that the
+    metrics of every worker process can be reported together. This
+    should be emptied when the application is deployed. If not set,
+    each process only reports its own metrics.
+    """
+    METRICS_DIR = None
+
+    """
+    The number of seconds between writes of each process's metrics
+    to METRICS_DIR.
+    """
+    METRICS_FLUSH_SECONDS = 5
+
+    """
+    The token that must be provided, as a bearer token, to read the
+    metrics. If not set, the metrics can only be read by requests made
+    directly (not through a proxy) from METRICS_ALLOWED_ADDRESSES.
+    """
+    METRICS_TOKEN = None
+
+    """
+    The addresses that can read the metrics without a token.
+    """
+    METRICS_ALLOWED_ADDRESSES = ('127.0.0.1', '::1')
+
+    """
+    The number of resources to commit at a time when importing.
+    """
+    IMPORT_CHUNK_SIZE = 500
+
+    """
+    The number of rows to show on each page when previewing an import.
+    """
+    IMPORT_PREVIEW_PAGE_SIZE = 100
+
+    """
+    If true, long-running administrative jobs are queued for a worker
+    process (started with "python application.py worker"). Otherwise,
+    they are run immediately as part of the request that started them.
+    """
+    JOBS_ASYNC = False
+
+    """
+    The number of seconds a running job can go without recording its
+    progress before it is assumed that its worker has stopped, and the
+    job is marked as failed.
+    """
+    JOBS_STALE_SECONDS = 60 * 30
+
     """
     The key to use for server-side geocoding requests.
     """
     MAPS_SERVER_KEY = None
 
+    """
+    The number of seconds to keep cached geocoding results for
+    addresses that were found.
+    """
+    GEOCODE_CACHE_TTL = 60 * 60 * 24 * 90
+
+    """
+    The number of seconds to keep cached geocoding results for
+    addresses that were not found.
+    """
+    GEOCODE_CACHE_NEGATIVE_TTL = 60 * 60 * 24 * 7
+
+    """
+    The number of concurrent requests to make to the geocoding service.
+    """
+    GEOCODE_WORKERS = 4
+
+    """
+    The maximum number of requests to make to the geocoding service
+    each second, which should stay within the provider's quota.
+    """
+    GEOCODE_RATE_LIMIT = 10
+
+    """
+    The number of times to retry a geocoding request that timed out,
+    was rejected for exceeding the quota or found the service unavailable.
+    """
+    GEOCODE_MAX_RETRIES = 3
+
+    """
+    The number of seconds to wait before retrying a geocoding request.
+    The wait doubles with each subsequent retry.
+    """
+    GEOCODE_RETRY_BACKOFF = 1.0
+
+    """
+    The domain and scheme of the geocoding service. These can be changed
+    to use a local service for testing, such as scripts/fake_geocoder.py.
+    """
+    GEOCODER_DOMAIN = 'maps.googleapis.com'
+    GEOCODER_SCHEME = 'https'
+
+    """
+    The path to the offline gazetteer of ZIP code, city and state
+    centroids, which is built with "python application.py gazetteer".
+    If the file doesn't exist, the gazetteer isn't used.
+    """
+    GAZETTEER_PATH = os.path.join(_basedir, 'rad', 'gazetteer.bin')
+
     """
     The key to use for client-side geocoding requests.
     """
@@ -92,6 +371,9 @@ class DevelopmentConfig(BaseConfig):
     """
     BASE_URL = 'http://localhost:5000'
 
+    # Show database timings in the browser's developer tools
+    SQL_SERVER_TIMING = True
+
 
 class ProductionConfig(BaseConfig):
     """
@@ -117,6 +399,36 @@ class ProductionConfig(BaseConfig):
     if str(os.environ.get('RAD_MAPS_CLIENT_KEY')):
         MAPS_CLIENT_KEY = str(os.environ.get('RAD_MAPS_CLIENT_KEY'))
 
+    # Share the cache between worker processes
+    CACHE_TYPE = os.environ.get('RAD_CACHE_TYPE') or 'filesystem'
+
+    if os.environ.get('RAD_CACHE_DIR'):
+        CACHE_DIR = os.environ.get('RAD_CACHE_DIR')
+
+    if os.environ.get('RAD_CACHE_MEMCACHED_SERVERS'):
+        CACHE_MEMCACHED_SERVERS = \
+            os.environ.get('RAD_CACHE_MEMCACHED_SERVERS').split(',')
+
+    if os.environ.get('RAD_CACHE_REDIS_HOST'):
+        CACHE_REDIS_HOST = os.environ.get('RAD_CACHE_REDIS_HOST')
+
+    # Keep slow requests in their own log
+    SQL_SLOW_REQUEST_LOG = \
+        os.environ.get('RAD_SLOW_REQUEST_LOG') or 'slow_requests.log'
+
+    # Report the metrics of every worker process together
+    METRICS_DIR = os.environ.get('RAD_METRICS_DIR') or \
+        os.path.join(_basedir, 'metrics')
+
+    if os.environ.get('RAD_METRICS_TOKEN'):
+        METRICS_TOKEN = os.environ.get('RAD_METRICS_TOKEN')
+
+    # Queue jobs for a worker process if one has been set up
+    JOBS_ASYNC = os.environ.get('RAD_JOBS_ASYNC') == '1'
+
+    # Use the FULLTEXT index unless otherwise specified
+    SEARCH_BACKEND = os.environ.get('RAD_SEARCH_BACKEND') or 'mysql'
+
     SQLALCHEMY_DATABASE_URI = \
         'mysql+mysqldb://{0}:{1}@{2}/{3}?charset=utf8&use_unicode=0'. \
         format(
@@ -6,17 +6,74 @@ Manages the location of the saved .csv files.
 
 from radrecord import rad_record
 
-import chardet
+from chardet.universaldetector import UniversalDetector
 import csv
 import unicodecsv
 
 # force python lazy functions to act
 force = list
 
+# The maximum number of bytes to examine when detecting a file's encoding.
+DETECT_SAMPLE_SIZE = 64 * 1024
+
+
+def detect_encoding(csvfile, sample_size=DETECT_SAMPLE_SIZE):
+    """
+    Determines the encoding of a file by feeding lines to the
+    encoding detector until it is confident or it has examined a
+    maximum sample size past the first non-ASCII line. The file is
+    returned to its start afterwards.
+
+    Args:
+        csvfile: The file to examine, opened in binary mode.
+        sample_size: The maximum number of bytes to examine, starting
+            from the first line containing non-ASCII characters.
+
+    Returns:
+        The name of the encoding, in lowercase.
+    """
+    detector = UniversalDetector()
+    bytes_read = 0
+    found_non_ascii = False
+
+    for line in csvfile:
+        detector.feed(line)
+
+        # ASCII lines say nothing about the encoding, so don't
+        # count them towards the sample
+        if not found_non_ascii:
+            try:
+                line.decode('ascii')
+                continue
+            except UnicodeDecodeError:
+                found_non_ascii = True
+
+        bytes_read += len(line)
+
+        if detector.done or bytes_read >= sample_size:
+            break
+
+    detector.close()
+    csvfile.seek(0)
+
+    encoding = detector.result['encoding']
+
+    if encoding is None:
+        return 'utf-8'
+
+    encoding = encoding.lower()
+
+    # The whole file is ASCII, so use the superset instead
+    if encoding == 'ascii':
+        return 'utf-8'
+
+    return encoding
+
 
 def open_dict_csv(file_path):
     """
     Opens a CSV file and returns a dictionary reader.
+    The caller is responsible for closing the reader's file.
 
     Args:
         file_path: The path to the CSV file.
@@ -30,15 +87,7 @@ def open_dict_csv(file_path):
         csvfile = open(file_path, 'rb')
 
         # Determine the encoding
-        encoding = chardet.detect(csvfile.read())
-
-        if encoding['encoding'] is not None:
-            encoding = encoding['encoding'].lower()
-        else:
-            encoding = 'utf-8'
-
-        # Go back to the beginning
-        csvfile.seek(0)
+        encoding = detect_encoding(csvfile)
 
         # Get the equivalent reader using the determined encoding
         return unicodecsv.DictReader(csvfile, encoding=encoding)
@@ -113,26 +162,45 @@ def get_radrecord(d, resource_fields):
     return rad_record(**filtered_dict).normalize_record()
 
 
-def get_radrecords(file_path):
+def iter_radrecords(file_path):
     """
-    Opens a CSV file and returns the equivalent
-    RadRecords.
+    Opens a CSV file and yields the equivalent
+    RadRecords, one row at a time. The file is closed
+    once all rows have been read.
 
     Args:
         file_path: The path to the CSV file.
 
     Returns:
-        The RadRecords in the file.
+        A generator of the RadRecords in the file.
     """
     # Create a new RadRecord so we can get the field names
     dummy_record = rad_record(name='Ministry of Silly Walks')
     resource_fields = dummy_record._fields
 
-    # Now get resources from each row
-    return map(
-        lambda row:
-        get_radrecord(row, resource_fields),
-        open_dict_csv(file_path))
+    with open(file_path, 'rb') as csvfile:
+        # Determine the encoding and get the equivalent reader
+        reader = unicodecsv.DictReader(
+            csvfile,
+            encoding=detect_encoding(csvfile))
+
+        # Now get resources from each row
+        for row in reader:
+            yield get_radrecord(row, resource_fields)
+
+
+def get_radrecords(file_path):
+    """
+    Opens a CSV file and returns the equivalent
+    RadRecords.
+
+    Args:
+        file_path: The path to the CSV file.
+
+    Returns:
+        The RadRecords in the file.
+    """
+    return force(iter_radrecords(file_path))
 
 
 # Bump up the maximum field length
@@ -0,0 +1,356 @@
+"""
+importsession.py
+
+Stores the parsed rows of a CSV file on disk so that they can be
+previewed and imported without re-reading the file.
+
+Each session is a file of JSON lines, with one line for each row
+containing the row's values along with whether it is valid and any
+duplicate resources that were found. A separate JSON header file,
+written once the rows are complete, contains the RadRecord field names
+and the number of rows. Sessions are keyed on the path, modification
+time and size of the CSV file, so changing the file starts a new session.
+"""
+import glob
+import hashlib
+import json
+import os
+import os.path as op
+import tempfile
+from itertools import islice
+
+from data_importer import iter_radrecords
+from radrecord import rad_record
+from remedy.remedy_utils import replace_file
+
+# The number of rows to check for duplicates at a time when parsing.
+ANNOTATE_CHUNK_SIZE = 500
+
+
+class ImportSession(object):
+    """
+    The parsed rows of a CSV file being imported.
+
+    Attributes:
+        path: The base path of the session files.
+        fields: The names of the RadRecord fields.
+        row_count: The number of rows in the file.
+    """
+
+    def __init__(self, path, fields, row_count):
+        self.path = path
+        self.fields = fields
+        self.row_count = row_count
+
+    def iter_rows(self, start=0, stop=None):
+        """
+        Reads rows from the session.
+
+        Args:
+            start: The zero-based position of the first row to read.
+            stop: The position to stop reading at. If not specified,
+                all remaining rows will be read.
+
+        Returns:
+            A generator of rows. Each row is a dictionary with the
+            following fields:
+                row_index: The index of the row, starting with 1.
+                resource: The RadRecord read from the row.
+                valid: A boolean indicating if the record is valid.
+                has_dupes: A boolean indicating if there were
+                    pre-existing resources with the same name or NPI.
+                dupes: A list of dictionaries with the "id" and "name"
+                    of each resource detected as a duplicate.
+        """
+        with open(self.path + '.jsonl', 'rb') as rows_file:
+            lines = islice(rows_file, start, None)
+
+            if stop is not None:
+                lines = islice(lines, max(stop - start, 0))
+
+            for line in lines:
+                row = json.loads(line)
+
+                yield dict(
+                    row_index=row['i'],
+                    resource=rad_record(
+                        **dict(zip(self.fields, row['v']))),
+                    valid=row['valid'],
+                    has_dupes=len(row['dupes']) > 0,
+                    dupes=[
+                        dict(id=dupe[0], name=dupe[1])
+                        for dupe in row['dupes']
+                    ])
+
+    def selection_path(self):
+        """
+        Gets the path to the file storing the rows that the
+        user has explicitly selected or deselected.
+
+        Returns:
+            The path to the selection file.
+        """
+        return self.path + '.selection.json'
+
+    def get_selection(self):
+        """
+        Gets the rows that the user has explicitly selected or
+        deselected. Other valid rows are selected if they don't
+        have any duplicates.
+
+        Returns:
+            Two values. The first value is a set of the indices of rows
+            that have been selected. The second value is a set of the
+            indices of rows that have been deselected.
+        """
+        if not op.exists(self.selection_path()):
+            return set(), set()
+
+        with open(self.selection_path(), 'rb') as selection_file:
+            selection = json.load(selection_file)
+
+        return set(selection['include']), set(selection['exclude'])
+
+    def update_selection(self, shown_rows, selected_ids):
+        """
+        Updates the selected rows based on a submitted page of rows.
+
+        Args:
+            shown_rows: The rows that were shown on the page.
+            selected_ids: The indices of the rows that were
+                selected on the page.
+        """
+        include, exclude = self.get_selection()
+
+        for row in shown_rows:
+            row_index = row['row_index']
+            include.discard(row_index)
+            exclude.discard(row_index)
+
+            if row_index in selected_ids and not is_default_row(row):
+                include.add(row_index)
+            elif row_index not in selected_ids and is_default_row(row):
+                exclude.add(row_index)
+
+        write_json_atomic(
+            self.selection_path(),
+            dict(include=sorted(include), exclude=sorted(exclude)))
+
+    def is_selected(self, row, include=None, exclude=None):
+        """
+        Determines if a row is selected for importing.
+
+        Args:
+            row: The row to check.
+            include: The set of explicitly selected row indices.
+            exclude: The set of explicitly deselected row indices.
+
+        Returns:
+            A boolean indicating if the row is selected.
+        """
+        if include is None or exclude is None:
+            include, exclude = self.get_selection()
+
+        if not row['valid']:
+            return False
+
+        if row['row_index'] in include:
+            return True
+
+        if row['row_index'] in exclude:
+            return False
+
+        return is_default_row(row)
+
+    def iter_selected_rows(self):
+        """
+        Reads the rows that are selected for importing.
+
+        Returns:
+            A generator of the selected rows. See iter_rows
+            for the fields on each row.
+        """
+        include, exclude = self.get_selection()
+
+        for row in self.iter_rows():
+            if self.is_selected(row, include, exclude):
+                yield row
+
+    def delete(self):
+        """
+        Deletes the session and its selection.
+        """
+        for path in (
+                self.path + '.json',
+                self.path + '.jsonl',
+                self.selection_path()):
+            if op.exists(path):
+                os.remove(path)
+
+
+def is_default_row(row):
+    """
+    Determines if a row is selected by default, which is the
+    case for valid rows without any duplicates.
+
+    Args:
+        row: The row to check.
+
+    Returns:
+        A boolean indicating if the row is selected by default.
+    """
+    return row['valid'] and not row['has_dupes']
+
+
+def write_json_atomic(path, value):
+    """
+    Writes a value as JSON to a file, replacing it atomically.
+
+    Args:
+        path: The path to the file.
+        value: The value to write.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=op.dirname(path), suffix='.tmp')
+
+    with os.fdopen(fd, 'wb') as temp_file:
+        json.dump(value, temp_file)
+
+    replace_file(temp_path, path)
+
+
+def get_session_prefix(session_dir, file_path):
+    """
+    Gets the prefix shared by all session files for a CSV file.
+
+    Args:
+        session_dir: The directory containing import sessions.
+        file_path: The path to the CSV file.
+
+    Returns:
+        The path prefix of the session files.
+    """
+    file_path = op.abspath(file_path)
+
+    if isinstance(file_path, unicode):
+        file_path = file_path.encode('utf-8')
+
+    path_hash = hashlib.sha1(file_path).hexdigest()
+
+    return op.join(session_dir, path_hash)
+
+
+def get_session_path(session_dir, file_path):
+    """
+    Gets the base path of the session files for the current
+    version of a CSV file.
+
+    Args:
+        session_dir: The directory containing import sessions.
+        file_path: The path to the CSV file.
+
+    Returns:
+        The base path of the session files.
+    """
+    stat = os.stat(file_path)
+
+    return get_session_prefix(session_dir, file_path) + \
+        '-%x-%x' % (int(stat.st_mtime * 1000), stat.st_size)
+
+
+def write_session(session_path, file_path, find_dupes):
+    """
+    Parses a CSV file and writes its rows to a new session.
+
+    Args:
+        session_path: The base path of the session files.
+        file_path: The path to the CSV file.
+        find_dupes: A function that takes a list of RadRecords and
+            returns a list of the duplicate resources for each record.
+
+    Returns:
+        The header of the session.
+    """
+    records = iter_radrecords(file_path)
+    row_count = 0
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=op.dirname(session_path),
+        suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as rows_file:
+            while True:
+                chunk = list(islice(records, ANNOTATE_CHUNK_SIZE))
+
+                if len(chunk) == 0:
+                    break
+
+                for record, dupes in zip(chunk, find_dupes(chunk)):
+                    row_count += 1
+
+                    rows_file.write(json.dumps(dict(
+                        i=row_count,
+                        v=list(record),
+                        valid=record.is_valid(),
+                        dupes=[[res.id, res.name] for res in dupes])))
+                    rows_file.write('\n')
+
+        replace_file(temp_path, session_path + '.jsonl')
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    # Write the header last, since it indicates a complete session
+    header = dict(
+        fields=rad_record(name='Ministry of Silly Walks')._fields,
+        row_count=row_count)
+
+    write_json_atomic(session_path + '.json', header)
+
+    return header
+
+
+def get_import_session(session_dir, file_path, find_dupes):
+    """
+    Gets the import session for a CSV file, parsing the
+    file if it hasn't been parsed since it was last changed.
+
+    Args:
+        session_dir: The directory containing import sessions.
+        file_path: The path to the CSV file.
+        find_dupes: A function that takes a list of RadRecords and
+            returns a list of the duplicate resources for each record.
+            Each resource must have "id" and "name" fields.
+
+    Returns:
+        The import session.
+    """
+    session_path = get_session_path(session_dir, file_path)
+
+    if op.exists(session_path + '.json'):
+        with open(session_path + '.json', 'rb') as header_file:
+            header = json.load(header_file)
+    else:
+        # Clean up the sessions for older versions of the file
+        delete_import_sessions(session_dir, file_path)
+
+        header = write_session(session_path, file_path, find_dupes)
+
+    return ImportSession(
+        session_path,
+        header['fields'],
+        header['row_count'])
+
+
+def delete_import_sessions(session_dir, file_path):
+    """
+    Deletes all import sessions for a CSV file.
+
+    Args:
+        session_dir: The directory containing import sessions.
+        file_path: The path to the CSV file.
+    """
+    prefix = get_session_prefix(session_dir, file_path)
+
+    for path in glob.glob(prefix + '-*'):
+        os.remove(path)
@@ -4,11 +4,13 @@ email_utils.py
 Contains functionality for sending emails.
 """
 import smtplib
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formataddr
 
 from .remedy_utils import get_ip
+from .metrics import EMAIL_SEND_DURATION
 
 from flask import current_app, render_template, url_for
 from flask.ext.login import current_user
@@ -73,12 +75,20 @@ def send_email(toaddr, subject, message_text, message_html):
     msg.attach(MIMEText(message_html, 'html'))
 
     # Send the email.
-    server = smtplib.SMTP(server)
-    server.ehlo()
-    server.starttls()
-    server.login(username, password)
-    server.sendmail(fromaddr, toaddr, msg.as_string())
-    server.quit()
+    start = time.time()
+
+    try:
+        server = smtplib.SMTP(server)
+        server.ehlo()
+        server.starttls()
+        server.login(username, password)
+        server.sendmail(fromaddr, toaddr, msg.as_string())
+        server.quit()
+    except Exception:
+        EMAIL_SEND_DURATION.observe(time.time() - start, result='error')
+        raise
+
+    EMAIL_SEND_DURATION.observe(time.time() - start, result='sent')
 
 
 def send_resource_error(resource, comments):
@@ -0,0 +1,323 @@
+"""
+instrumentation.py
+
+Contains request-scoped instrumentation of the SQL statements run while
+handling each request.
+
+Statements are timed once through SQLAlchemy engine events, which also
+pass each statement's duration on to any registered statement observers
+(such as the metrics). For requests, statements are grouped by
+their shape (the statement with literals and lists of parameters
+collapsed), so that a statement repeated for each item in a loop - a
+likely N+1 query - can be flagged. Requests that are slow or run many
+statements are written to the slow-request log, and the totals can be
+returned to browsers through the Server-Timing header.
+"""
+from logging.handlers import RotatingFileHandler
+import logging
+import re
+import time
+
+from flask import g, request, has_request_context, current_app
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listens_for
+
+# Matches parenthesized lists of bind parameters, as in IN clauses.
+PARAM_LIST_RE = re.compile(
+    r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)')
+
+# Matches string and numeric literals.
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# Matches runs of whitespace.
+WHITESPACE_RE = re.compile(r'\s+')
+
+# The number of statement shapes to include in the slow-request log.
+SLOW_LOG_SHAPES = 5
+
+# The longest statement shape to log, in characters.
+MAX_SHAPE_LENGTH = 500
+
+# The functions called with each statement run and the time taken to run
+# it, in seconds, regardless of whether there is a current request.
+_statement_observers = []
+
+
+def get_statement_shape(statement):
+    """
+    Gets the shape of a SQL statement, so that statements differing only
+    in their literals or number of parameters are grouped together.
+
+    Args:
+        statement: The SQL statement.
+
+    Returns:
+        The statement shape.
+    """
+    shape = PARAM_LIST_RE.sub('(?)', statement)
+    shape = LITERAL_RE.sub('?', shape)
+    return WHITESPACE_RE.sub(' ', shape).strip()
+
+
+class RequestStats(object):
+    """
+    The SQL statements run while handling a request.
+
+    Attributes:
+        start: The time the request started.
+        count: The number of statements run.
+        duration: The total time spent running statements, in seconds.
+        shapes: A dictionary of statement shapes to a list containing
+            the number of times the shape was run and the total time
+            spent running it.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = {}
+
+    def record(self, statement, duration):
+        """
+        Records a statement that was run.
+
+        Args:
+            statement: The SQL statement.
+            duration: The time spent running it, in seconds.
+        """
+        self.count += 1
+        self.duration += duration
+
+        shape_stats = self.shapes.setdefault(
+            get_statement_shape(statement),
+            [0, 0.0])
+
+        shape_stats[0] += 1
+        shape_stats[1] += duration
+
+    def top_shapes(self, limit=None, min_count=1):
+        """
+        Gets the statement shapes that were run most often.
+
+        Args:
+            limit: The maximum number of shapes to return. Optional.
+            min_count: The minimum number of times a shape must have
+                been run to be included. Optional.
+
+        Returns:
+            A list of tuples containing the shape, the number of times
+            it was run and the total time spent running it, in
+            descending order of the number of times run.
+        """
+        shapes = sorted(
+            (
+                (shape, count, duration)
+                for shape, (count, duration) in self.shapes.iteritems()
+                if count >= min_count
+            ),
+            key=lambda s: (s[1], s[2]),
+            reverse=True)
+
+        if limit is not None:
+            shapes = shapes[:limit]
+
+        return shapes
+
+
+def get_request_stats():
+    """
+    Gets the SQL statistics for the current request.
+
+    Returns:
+        The RequestStats, or None if there is no current request or
+        instrumentation is disabled.
+    """
+    if not has_request_context():
+        return None
+
+    return getattr(g, 'remedy_sql_stats', None)
+
+
+def add_statement_observer(observer):
+    """
+    Registers a function to be called with each SQL statement run and
+    the time taken to run it, in seconds.
+
+    Args:
+        observer: The function to call.
+    """
+    if observer not in _statement_observers:
+        _statement_observers.append(observer)
+
+
+@listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    """
+    Records the time a statement started running.
+    """
+    if _statement_observers or get_request_stats() is not None:
+        conn.info.setdefault('remedy_statement_start', []). \
+            append(time.time())
+
+
+@listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """
+    Records a statement in the current request's statistics and
+    passes it on to the statement observers.
+    """
+    starts = conn.info.get('remedy_statement_start')
+
+    if not starts:
+        return
+
+    duration = time.time() - starts.pop()
+    stats = get_request_stats()
+
+    if stats is not None:
+        stats.record(statement, duration)
+
+    for observer in _statement_observers:
+        observer(statement, duration)
+
+
+@listens_for(Engine, 'dbapi_error')
+def fail_statement(conn, cursor, statement, parameters, context,
+                   exception):
+    """
+    Discards the start time of a statement that raised an error,
+    since after_cursor_execute won't be called for it.
+    """
+    starts = conn.info.get('remedy_statement_start')
+
+    if starts:
+        starts.pop()
+
+
+def start_request():
+    """
+    Starts collecting SQL statistics for the current request.
+    """
+    g.remedy_sql_stats = RequestStats()
+
+
+def finish_request(response):
+    """
+    Flags likely N+1 queries, logs slow requests and adds the
+    Server-Timing header to the response, as configured.
+
+    Args:
+        response: The response to the current request.
+
+    Returns:
+        The response.
+    """
+    stats = get_request_stats()
+
+    if stats is None:
+        return response
+
+    g.remedy_sql_stats = None
+    config = current_app.config
+    elapsed = time.time() - stats.start
+
+    # Flag statements repeated enough to suggest a lazy load in a loop
+    repeated = stats.top_shapes(
+        min_count=config.get('SQL_N_PLUS_ONE_THRESHOLD', 10))
+
+    for shape, count, duration in repeated:
+        current_app.logger.warning(
+            'Possible N+1 query in %s %s: %d executions (%.1f ms) of %s',
+            request.method,
+            request.path,
+            count,
+            duration * 1000,
+            shape[:MAX_SHAPE_LENGTH])
+
+    if elapsed >= config.get('SQL_SLOW_REQUEST_SECONDS', 1.0) or \
+            stats.count >= config.get('SQL_SLOW_REQUEST_QUERIES', 100):
+        lines = [
+            '%s %s took %.1f ms with %d statements (%.1f ms in the '
+            'database)' % (
+                request.method,
+                request.full_path,
+                elapsed * 1000,
+                stats.count,
+                stats.duration * 1000)
+        ]
+
+        for shape, count, duration in stats.top_shapes(SLOW_LOG_SHAPES):
+            lines.append('    %dx %.1f ms: %s' % (
+                count,
+                duration * 1000,
+                shape[:MAX_SHAPE_LENGTH]))
+
+        get_slow_request_logger(current_app).warning('\n'.join(lines))
+
+    if config.get('SQL_SERVER_TIMING', False):
+        response.headers.add(
+            'Server-Timing',
+            'db;dur=%.1f;desc="%d statements"' % (
+                stats.duration * 1000,
+                stats.count))
+        response.headers.add(
+            'Server-Timing',
+            'app;dur=%.1f' % (elapsed * 1000))
+
+    return response
+
+
+def get_slow_request_logger(app):
+    """
+    Gets the logger for slow requests, which writes to the file in the
+    SQL_SLOW_REQUEST_LOG configuration value or, if that isn't set,
+    to the application's log.
+
+    Args:
+        app: The application.
+
+    Returns:
+        The logger.
+    """
+    logger = app.extensions.get('remedy_slow_request_log')
+
+    if logger is not None:
+        return logger
+
+    log_path = app.config.get('SQL_SLOW_REQUEST_LOG')
+
+    if log_path:
+        logger = logging.getLogger('remedy.slowrequests')
+        logger.propagate = False
+
+        if not logger.handlers:
+            file_handler = RotatingFileHandler(
+                log_path,
+                maxBytes=1024 * 1024 * 100,
+                backupCount=5)
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s - %(message)s'))
+            logger.addHandler(file_handler)
+    else:
+        logger = app.logger
+
+    app.extensions['remedy_slow_request_log'] = logger
+    return logger
+
+
+def init_instrumentation(app):
+    """
+    Sets up SQL instrumentation for the provided application, if it is
+    enabled by the SQL_INSTRUMENTATION_ENABLED configuration value.
+
+    Args:
+        app: The application.
+    """
+    if not app.config.get('SQL_INSTRUMENTATION_ENABLED', False):
+        return
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
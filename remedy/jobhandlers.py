@@ -0,0 +1,430 @@
+"""
+jobhandlers.py
+
+Contains the handlers for background jobs queued from the
+administrative interface. See jobs.py for how jobs are run.
+"""
+from datetime import datetime
+import os
+
+from flask import current_app
+import geopy
+import geopy.exc
+
+from jobs import job_handler
+from caching import bump_version, CATEGORY_OPTIONS
+from rad.models import db, Resource, Category, Population
+from rad.db_fun import bulk_import_resources, find_record_duplicates
+from rad.geocoder import Geocoder, DEFAULT_TTL, DEFAULT_NEGATIVE_TTL
+from rad.gazetteer import get_gazetteer
+from data_importer.importsession import get_import_session, \
+    delete_import_sessions
+
+# The number of items to process between checkpoints.
+BATCH_SIZE = 100
+
+# The number of resources to geocode between checkpoints. Lookups
+# within a batch are made concurrently and committed together.
+GEOCODE_BATCH_SIZE = 100
+
+
+def iter_batches(items, batch_size=BATCH_SIZE):
+    """
+    Splits a list into batches.
+
+    Args:
+        items: The list to split.
+        batch_size: The maximum number of items in each batch.
+
+    Returns:
+        A generator of lists of items.
+    """
+    for start in xrange(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def get_resource_str(resource):
+    """
+    Builds a helpful string to use for messages about a resource.
+
+    Args:
+        resource: The resource.
+
+    Returns:
+        The message string.
+    """
+    return u'resource #' + unicode(resource.id) + \
+        u' (' + resource.name + u')'
+
+
+def get_geocoder_error_type(gpex):
+    """
+    Attempts to infer some extra information about
+    a geocoding error based on its exception type.
+
+    Args:
+        gpex: The Geopy exception.
+
+    Returns:
+        A description of the type of error, or an empty string.
+    """
+    if isinstance(gpex, geopy.exc.GeocoderQuotaExceeded):
+        return 'quota exceeded'
+    elif isinstance(gpex, geopy.exc.GeocoderAuthenticationFailure):
+        return 'authentication failure'
+    elif isinstance(gpex, geopy.exc.GeocoderInsufficientPrivileges):
+        return 'insufficient privileges'
+    elif isinstance(gpex, geopy.exc.GeocoderUnavailable):
+        return 'server unavailable'
+    elif isinstance(gpex, geopy.exc.GeocoderTimedOut):
+        return 'timed out'
+    elif isinstance(gpex, geopy.exc.GeocoderQueryError):
+        return 'query error'
+
+    return ''
+
+
+@job_handler('geocode')
+def geocode_resources(context, resource_ids):
+    """
+    Attempts to geocode each of the specified resources.
+
+    Args:
+        context: The job context.
+        resource_ids: The IDs of the resources to geocode.
+    """
+    context.set_total(len(resource_ids))
+
+    # Set up the geocoder, and then try to geocode each resource.
+    # Results are cached, so addresses that have already been
+    # geocoded won't be looked up again.
+    config = current_app.config
+    geocoder = Geocoder(
+        api_key=config.get('MAPS_SERVER_KEY'),
+        session=db.session,
+        ttl=config.get('GEOCODE_CACHE_TTL', DEFAULT_TTL),
+        negative_ttl=config.get(
+            'GEOCODE_CACHE_NEGATIVE_TTL',
+            DEFAULT_NEGATIVE_TTL),
+        max_workers=config.get('GEOCODE_WORKERS', 1),
+        rate_limit=config.get('GEOCODE_RATE_LIMIT'),
+        max_retries=config.get('GEOCODE_MAX_RETRIES', 0),
+        retry_backoff=config.get('GEOCODE_RETRY_BACKOFF', 1.0),
+        domain=config.get('GEOCODER_DOMAIN', 'maps.googleapis.com'),
+        scheme=config.get('GEOCODER_SCHEME', 'https'),
+        gazetteer=get_gazetteer(current_app))
+
+    for id_batch in iter_batches(resource_ids, GEOCODE_BATCH_SIZE):
+        target_resources = Resource.query. \
+            filter(Resource.id.in_(id_batch)). \
+            order_by(Resource.id). \
+            all()
+
+        for resource, ex, source in geocoder.geocode_all(target_resources):
+            resource_str = get_resource_str(resource)
+
+            if ex is None and source == 'gazetteer':
+                resource.last_updated = datetime.utcnow()
+                context.log(
+                    'Geocoded ' + resource_str +
+                    ' approximately using the offline gazetteer.')
+            elif ex is None:
+                resource.last_updated = datetime.utcnow()
+                context.log('Geocoded ' + resource_str + '.')
+            elif isinstance(ex, geopy.exc.GeopyError):
+                # Handle Geopy errors separately
+                exc_type = get_geocoder_error_type(ex)
+
+                if len(exc_type) > 0:
+                    exc_type = '(' + exc_type + ') '
+
+                context.log(
+                    'Error geocoding ' + resource_str + ': ' +
+                    exc_type + str(ex))
+            else:
+                context.log(
+                    'Error geocoding ' + resource_str + ': ' + str(ex))
+
+        # Save our changes.
+        context.checkpoint(len(id_batch))
+
+
+@job_handler('import')
+def import_resources(
+        context,
+        file_path,
+        session_dir,
+        create_categories,
+        delete_after):
+    """
+    Imports the selected rows of a CSV file's import session
+    as new resources.
+
+    Args:
+        context: The job context.
+        file_path: The path to the CSV file.
+        session_dir: The directory containing import sessions.
+        create_categories: If true, new categories will be created
+            for each resource if it lists any that do not already exist.
+        delete_after: If true, the file will be deleted
+            after a successful import.
+    """
+    import_session = get_import_session(
+        session_dir,
+        file_path,
+        lambda rad_records: find_record_duplicates(db.session, rad_records))
+
+    context.set_total(
+        sum(1 for row in import_session.iter_selected_rows()))
+
+    # Keep track of the indices of the selected rows
+    # so we can report on them.
+    row_indices = []
+    error_positions = []
+
+    def get_selected_records():
+        for row in import_session.iter_selected_rows():
+            row_indices.append(row['row_index'])
+            yield row['resource']
+
+    def report_chunk(chunk_result):
+        chunk_str = 'rows #' + \
+            str(row_indices[chunk_result['start']]) + '-' + \
+            str(row_indices[chunk_result['end'] - 1])
+
+        for position, error in chunk_result['row_errors']:
+            context.log(
+                'Error importing row #' +
+                str(row_indices[position]) + ': ' + error)
+            error_positions.append(position)
+
+        if chunk_result['error'] is not None:
+            context.log(
+                'Error committing ' + chunk_str + ': ' +
+                chunk_result['error'])
+            error_positions.append(chunk_result['start'])
+        else:
+            context.log(
+                'Imported ' + str(chunk_result['imported']) +
+                ' resources from ' + chunk_str + '.')
+
+        context.checkpoint(chunk_result['end'] - chunk_result['start'])
+
+    # Buckle up. It's time.
+    chunk_results = bulk_import_resources(
+        db.session,
+        get_selected_records(),
+        create_categories=create_categories,
+        chunk_size=current_app.config.get('IMPORT_CHUNK_SIZE', 500),
+        chunk_callback=report_chunk)
+
+    if len(chunk_results) == 0:
+        context.log('No rows were selected.')
+        return
+
+    # The duplicate information in the session is now out
+    # of date, so start over if the file is imported again
+    delete_import_sessions(session_dir, file_path)
+
+    # If specified, clean up afterwards,
+    # since we didn't get a fatal error
+    if delete_after and len(error_positions) == 0:
+        try:
+            os.remove(file_path)
+        except Exception as ex:
+            context.log(
+                'The import was successful, but there was ' +
+                'an error deleting the file afterwards: ' +
+                str(ex))
+
+
+@job_handler('merge-categories')
+def merge_categories(context, primary_category_id, category_ids):
+    """
+    Merges categories into a primary category, moving their
+    resources to the primary category and deleting them.
+
+    Args:
+        context: The job context.
+        primary_category_id: The ID of the category to merge into.
+        category_ids: The IDs of the categories to merge.
+    """
+    primary_category = Category.query.get(primary_category_id)
+
+    if primary_category is None:
+        context.log('The selected category was not found.')
+        return
+
+    context.set_total(len(category_ids))
+    context.log(
+        'Primary category: ' + primary_category.name +
+        ' (#' + str(primary_category.id) + ').')
+
+    try:
+        for category_id in category_ids:
+            # Skip over the primary category.
+            if category_id == primary_category_id:
+                context.checkpoint(1)
+                continue
+
+            category = Category.query.get(category_id)
+
+            if category is None:
+                context.checkpoint(1)
+                continue
+
+            # Build a helpful message string to use for messages.
+            category_str = 'category #' + str(category.id) + \
+                ' (' + category.name + ')'
+            try:
+                # Delegate all resources
+                for resource in category.resources:
+
+                    # Make sure we're not double-adding
+                    if resource not in primary_category.resources:
+                        primary_category.resources.append(resource)
+
+                # Delete the category
+                db.session.delete(category)
+
+            except Exception as ex:
+                context.log(
+                    'Error merging ' + category_str + ': ' + str(ex))
+            else:
+                context.log('Merged ' + category_str + '.')
+
+            # Save our changes.
+            context.checkpoint(1)
+    finally:
+        bump_version(CATEGORY_OPTIONS)
+
+
+def assign_to_resources(context, resource_ids, items, collection_name):
+    """
+    Assigns categories or populations to resources.
+
+    Args:
+        context: The job context.
+        resource_ids: The IDs of the resources to update.
+        items: The categories or populations to assign.
+        collection_name: The name of the resource collection
+            to update, such as "categories" or "populations".
+    """
+    context.set_total(len(resource_ids))
+
+    for id_batch in iter_batches(resource_ids):
+        target_resources = Resource.query. \
+            filter(Resource.id.in_(id_batch)). \
+            order_by(Resource.name.asc()). \
+            all()
+
+        for resource in target_resources:
+            resource_str = get_resource_str(resource)
+            collection = getattr(resource, collection_name)
+
+            try:
+                # Assign all items
+                for item in items:
+
+                    # Make sure we're not double-adding
+                    if item not in collection:
+                        collection.append(item)
+                        resource.last_updated = datetime.utcnow()
+
+            except Exception as ex:
+                context.log(
+                    'Error updating ' + resource_str + ': ' + str(ex))
+            else:
+                context.log('Updated ' + resource_str + '.')
+
+        # Save our changes. This expires the items, but they
+        # will be reloaded as needed for the next batch.
+        context.checkpoint(len(id_batch))
+
+
+@job_handler('assign-categories')
+def assign_categories(context, resource_ids, category_ids):
+    """
+    Assigns categories to resources.
+
+    Args:
+        context: The job context.
+        resource_ids: The IDs of the resources to update.
+        category_ids: The IDs of the categories to assign.
+    """
+    target_categories = Category.query. \
+        filter(Category.id.in_(category_ids)). \
+        all()
+
+    assign_to_resources(
+        context,
+        resource_ids,
+        target_categories,
+        'categories')
+
+
+@job_handler('assign-populations')
+def assign_populations(context, resource_ids, population_ids):
+    """
+    Assigns populations to resources.
+
+    Args:
+        context: The job context.
+        resource_ids: The IDs of the resources to update.
+        population_ids: The IDs of the populations to assign.
+    """
+    target_populations = Population.query. \
+        filter(Population.id.in_(population_ids)). \
+        all()
+
+    assign_to_resources(
+        context,
+        resource_ids,
+        target_populations,
+        'populations')
+
+
+@job_handler('touch-resources')
+def touch_resources(context, category_ids, population_ids):
+    """
+    Updates the last-updated date of every resource in any of the
+    specified categories and populations.
+
+    Args:
+        context: The job context.
+        category_ids: The IDs of the categories to filter on.
+            If empty, resources will not be filtered by category.
+        population_ids: The IDs of the populations to filter on.
+            If empty, resources will not be filtered by population.
+    """
+    query = db.session.query(Resource.id)
+
+    if len(category_ids) > 0:
+        query = query.filter(Resource.categories.any(
+            Category.id.in_(category_ids)))
+
+    if len(population_ids) > 0:
+        query = query.filter(Resource.populations.any(
+            Population.id.in_(population_ids)))
+
+    resource_ids = [row.id for row in query.order_by(Resource.id)]
+
+    if len(resource_ids) == 0:
+        context.log('No resources matched the provided query.')
+        return
+
+    context.set_total(len(resource_ids))
+
+    for id_batch in iter_batches(resource_ids):
+        target_resources = Resource.query. \
+            filter(Resource.id.in_(id_batch)). \
+            all()
+
+        # Touch the last-updated date.
+        for resource in target_resources:
+            resource.last_updated = datetime.utcnow()
+
+        context.checkpoint(len(id_batch))
+
+    # Indicate how many we changed.
+    context.log('Updated ' + str(len(resource_ids)) + ' resource(s).')
@@ -0,0 +1,362 @@
+"""
+jobs.py
+
+Contains the background job queue used for long-running
+administrative tasks.
+
+Jobs are stored in the database and claimed by worker processes,
+which are started with the "worker" manager command. Each job type
+has a handler, registered with the job_handler decorator, which is
+called with a JobContext and the job's parameters. Handlers should
+commit their work in batches through JobContext.checkpoint, which
+also records progress and stops the job if it has been cancelled.
+
+If the JOBS_ASYNC configuration value is false, jobs are run
+immediately in the process that queued them instead.
+
+Running jobs record a heartbeat at each checkpoint. Jobs that go longer
+than JOBS_STALE_SECONDS without one are assumed to have lost their
+worker and are marked as failed, since their work may have been
+partially committed.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import socket
+import time
+
+from flask import current_app
+
+from rad.models import db, Job
+
+# The registered job handlers, keyed on job type.
+JOB_HANDLERS = {}
+
+# The statuses of jobs that have not yet finished.
+ACTIVE_STATUSES = (u'queued', u'running')
+
+
+class JobCancelled(Exception):
+    """
+    Raised within a job when an administrator has cancelled it.
+    """
+    pass
+
+
+class JobContext(object):
+    """
+    Provides a running job's handler with ways to report
+    progress and save its work.
+
+    Attributes:
+        job: The job being run.
+        session: The database session to use.
+        messages: The messages produced by the job so far.
+    """
+
+    def __init__(self, job, session):
+        self.job = job
+        self.session = session
+        self.messages = []
+
+    def set_total(self, total):
+        """
+        Sets the total number of items the job will process.
+
+        Args:
+            total: The total number of items.
+        """
+        self.job.total = total
+
+    def log(self, message):
+        """
+        Records a message to display with the job's results.
+
+        Args:
+            message: The message to record.
+        """
+        self.messages.append(message)
+
+    def checkpoint(self, processed=0):
+        """
+        Commits the job's work so far along with its progress, and
+        then makes sure that the job hasn't been cancelled.
+
+        Args:
+            processed: The number of items processed since
+                the last checkpoint.
+
+        Raises:
+            JobCancelled: The job has been cancelled.
+        """
+        self.job.progress += processed
+        self.job.messages = u'\n'.join(self.messages)
+        self.job.date_heartbeat = datetime.utcnow()
+        self.session.commit()
+
+        # Committing expires the job, so this picks up
+        # any cancellation from another process
+        if self.job.cancel_requested:
+            raise JobCancelled()
+
+
+def job_handler(job_type):
+    """
+    A decorator that registers a function as the handler
+    for a type of job.
+
+    Args:
+        job_type: The type of job handled by the function.
+
+    Returns:
+        The decorator.
+    """
+    def decorator(f):
+        JOB_HANDLERS[job_type] = f
+        return f
+
+    return decorator
+
+
+def get_worker_name():
+    """
+    Gets the name used to identify the current worker process.
+
+    Returns:
+        The host name and process ID.
+    """
+    return unicode(socket.gethostname() + ':' + str(os.getpid()))
+
+
+def get_error_message(ex):
+    """
+    Gets the message of an exception as unicode, regardless of
+    whether it was raised with a unicode or encoded message.
+
+    Args:
+        ex: The exception.
+
+    Returns:
+        The message.
+    """
+    try:
+        return unicode(ex)
+    except UnicodeError:
+        pass
+
+    try:
+        return unicode(str(ex), 'utf-8', 'replace')
+    except UnicodeError:
+        return unicode(repr(ex))
+
+
+def enqueue_job(job_type, description, params, user=None):
+    """
+    Queues a job to be run by a worker. If jobs are not configured
+    to run asynchronously, the job will be run immediately.
+
+    Args:
+        job_type: The type of job, which must have a registered handler.
+        description: The description of the job.
+        params: A dictionary of JSON-serializable keyword arguments
+            that will be passed to the job's handler.
+        user: The user that queued the job. Optional.
+
+    Returns:
+        The job.
+    """
+    if job_type not in JOB_HANDLERS:
+        raise ValueError('Unrecognized job type "' + job_type + '".')
+
+    job = Job(
+        job_type=job_type,
+        description=description[:250],
+        params=unicode(json.dumps(params)),
+        status=u'queued',
+        progress=0,
+        cancel_requested=False,
+        created_by=user)
+
+    db.session.add(job)
+    db.session.commit()
+
+    if not current_app.config.get('JOBS_ASYNC'):
+        fail_stale_jobs(db.session)
+
+        job.status = u'running'
+        job.worker = get_worker_name()
+        job.date_heartbeat = datetime.utcnow()
+        db.session.commit()
+
+        run_job(job)
+
+    return job
+
+
+def cancel_job(session, job):
+    """
+    Cancels a job. Queued jobs are cancelled immediately, while
+    running jobs will stop at their next checkpoint.
+
+    Args:
+        session: The current database session.
+        job: The job to cancel.
+
+    Returns:
+        A boolean indicating if the job was still active.
+    """
+    if job.status == u'queued':
+        job.status = u'cancelled'
+        job.date_finished = datetime.utcnow()
+    elif job.status == u'running':
+        job.cancel_requested = True
+    else:
+        return False
+
+    session.commit()
+    return True
+
+
+def claim_next_job(session, worker_name):
+    """
+    Claims the oldest queued job for a worker. Claiming is done with
+    a conditional update, so only one worker can claim a given job.
+
+    Args:
+        session: The current database session.
+        worker_name: The name of the claiming worker.
+
+    Returns:
+        The claimed job, or None if there are no queued jobs.
+    """
+    job_table = Job.__table__
+
+    while True:
+        job_id = session.query(Job.id). \
+            filter(Job.status == u'queued'). \
+            order_by(Job.id). \
+            limit(1). \
+            scalar()
+
+        if job_id is None:
+            return None
+
+        claimed = session.execute(
+            job_table.update().
+            where(job_table.c.id == job_id).
+            where(job_table.c.status == u'queued').
+            values(
+                status=u'running',
+                worker=worker_name,
+                date_heartbeat=datetime.utcnow()))
+
+        session.commit()
+
+        # Another worker got to it first - try the next one
+        if claimed.rowcount == 1:
+            return session.query(Job).get(job_id)
+
+
+def fail_stale_jobs(session):
+    """
+    Marks running jobs as failed if they haven't recorded their
+    progress within the number of seconds specified by the
+    JOBS_STALE_SECONDS configuration value.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        The number of jobs that were marked as failed.
+    """
+    job_table = Job.__table__
+    now = datetime.utcnow()
+    cutoff = now - timedelta(
+        seconds=current_app.config.get('JOBS_STALE_SECONDS', 60 * 30))
+
+    failed = session.execute(
+        job_table.update().
+        where(job_table.c.status == u'running').
+        where(db.func.coalesce(
+            job_table.c.date_heartbeat,
+            job_table.c.date_started) < cutoff).
+        values(
+            status=u'failed',
+            error=u'The worker running the job stopped responding.',
+            date_finished=now))
+
+    session.commit()
+    return failed.rowcount
+
+
+def run_job(job):
+    """
+    Runs a job that has been marked as running, recording
+    its final status once it is complete.
+
+    Args:
+        job: The job to run.
+    """
+    session = db.session
+    job_id = job.id
+
+    job.date_started = datetime.utcnow()
+    job.date_heartbeat = job.date_started
+    session.commit()
+
+    context = JobContext(job, session)
+
+    try:
+        JOB_HANDLERS[job.job_type](context, **json.loads(job.params))
+        context.checkpoint()
+    except JobCancelled:
+        session.rollback()
+        job = session.query(Job).get(job_id)
+        job.status = u'cancelled'
+    except Exception as ex:
+        session.rollback()
+        current_app.logger.exception('Job #' + str(job_id) + ' failed.')
+
+        job = session.query(Job).get(job_id)
+        job.status = u'failed'
+        job.error = get_error_message(ex)
+    else:
+        job.status = u'succeeded'
+
+    job.messages = u'\n'.join(context.messages)
+    job.date_finished = datetime.utcnow()
+    session.commit()
+
+
+def run_worker(poll_interval=5, once=False):
+    """
+    Runs queued jobs until stopped. Must be run within
+    an application context.
+
+    Args:
+        poll_interval: The number of seconds to wait between
+            checks for new jobs.
+        once: If true, the worker will stop once there are no
+            more queued jobs.
+    """
+    worker_name = get_worker_name()
+
+    while True:
+        stale_count = fail_stale_jobs(db.session)
+
+        if stale_count > 0:
+            current_app.logger.warning(
+                'Marked ' + str(stale_count) + ' stale job(s) as failed.')
+
+        job = claim_next_job(db.session, worker_name)
+
+        if job is not None:
+            current_app.logger.info(
+                'Running job #' + str(job.id) + ': ' + job.description)
+            run_job(job)
+            db.session.remove()
+        elif once:
+            return
+        else:
+            db.session.remove()
+            time.sleep(poll_interval)
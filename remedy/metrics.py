@@ -0,0 +1,586 @@
+"""
+metrics.py
+
+Contains counters and histograms of the application's activity, which
+are exposed at /metrics in the Prometheus text exposition format.
+
+Metrics are recorded in the memory of each process. When the METRICS_DIR
+configuration value is set, each process also writes its values to its
+own file in that directory every METRICS_FLUSH_SECONDS, and the metrics
+endpoint adds up the files of every process. This allows pre-forked
+worker processes, each of which only sees its own requests, to be
+reported together. The files of processes that have exited are kept so
+that counters never go backwards, so the directory should be emptied
+when the application is deployed.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock, Thread
+from uuid import uuid4
+import atexit
+import glob
+import json
+import os
+import time
+
+from flask import g, request, current_app, abort, Response
+
+from instrumentation import add_statement_observer
+from remedy_utils import replace_file
+
+# The default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The histogram buckets used for SQL statements, in seconds.
+QUERY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# The statement types that SQL statements are counted by.
+STATEMENT_TYPES = ('select', 'insert', 'update', 'delete')
+
+# The content type of the text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The registered metrics, by name, in the order they were registered.
+_metrics = OrderedDict()
+
+# The values recorded by this process, keyed on the name of each metric
+# and its label values. Counters have a number, and histograms have a
+# list of the count in each bucket followed by the sum and count of all
+# observations.
+_values = {}
+
+# Guards the values of this process and the state below.
+_lock = Lock()
+
+# Held while writing this process's file, which is done by both the
+# flusher thread and requests for the metrics.
+_write_lock = Lock()
+
+# The state of this process: its ID (to detect when it has been forked),
+# the name of its file in the metrics directory, the metrics directory,
+# and the number of seconds between writes.
+_state = {
+    'pid': None,
+    'filename': None,
+    'directory': None,
+    'flush_seconds': 5
+}
+
+
+def get_process_values():
+    """
+    Gets the values recorded by this process. If the process was forked
+    from the one that recorded the current values, they are discarded so
+    that they're only counted once. The lock must be held.
+
+    Returns:
+        The dictionary of values.
+    """
+    pid = os.getpid()
+
+    if _state['pid'] != pid:
+        _values.clear()
+        _state['pid'] = pid
+        _state['filename'] = 'metrics-' + str(pid) + '-' + \
+            uuid4().hex[:8] + '.json'
+
+        if _state['directory'] is not None:
+            start_flusher()
+
+    return _values
+
+
+class Metric(object):
+    """
+    A metric, identified by its name and label names.
+
+    Attributes:
+        name: The name of the metric.
+        documentation: The description of the metric.
+        labelnames: The names of the labels that the metric is
+            recorded with.
+    """
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        _metrics[name] = self
+
+    def get_key(self, labels):
+        """
+        Gets the key of the metric's value for a set of labels.
+
+        Args:
+            labels: A dictionary of label names to values.
+
+        Returns:
+            A tuple of the metric name and its label values.
+        """
+        return (
+            self.name,
+            tuple(unicode(labels.get(n, '')) for n in self.labelnames))
+
+    def format_samples(self, label_values, value):
+        """
+        Formats a value of the metric in the text exposition format.
+
+        Args:
+            label_values: The tuple of label values.
+            value: The value.
+
+        Returns:
+            A list of the lines of the value's samples.
+        """
+        raise NotImplementedError()
+
+    def merge(self, value, other):
+        """
+        Adds together two values of the metric.
+
+        Args:
+            value: The first value.
+            other: The second value.
+
+        Returns:
+            The combined value.
+        """
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """
+    A metric that counts events.
+    """
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increments the counter.
+
+        Args:
+            amount: The amount to increment by. Defaults to 1.
+            **labels: The values of the counter's labels.
+        """
+        key = self.get_key(labels)
+
+        with _lock:
+            values = get_process_values()
+            values[key] = values.get(key, 0) + amount
+
+    def format_samples(self, label_values, value):
+        return [
+            self.name + format_labels(self.labelnames, label_values) +
+            ' ' + format_value(value)
+        ]
+
+    def merge(self, value, other):
+        return value + other
+
+
+class Histogram(Metric):
+    """
+    A metric that counts observations, such as durations, in buckets.
+
+    Attributes:
+        buckets: The upper bounds of the buckets.
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Records an observation.
+
+        Args:
+            value: The observed value.
+            **labels: The values of the histogram's labels.
+        """
+        key = self.get_key(labels)
+        pos = bisect_left(self.buckets, value)
+
+        with _lock:
+            values = get_process_values()
+            entry = values.get(key)
+
+            if entry is None:
+                entry = values[key] = [0] * len(self.buckets) + [0.0, 0]
+
+            # Observations above the last bucket only count towards +Inf
+            if pos < len(self.buckets):
+                entry[pos] += 1
+
+            entry[-2] += value
+            entry[-1] += 1
+
+    def format_samples(self, label_values, value):
+        lines = []
+        cumulative = 0
+        labelnames = self.labelnames + ('le',)
+
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(
+                self.name + '_bucket' +
+                format_labels(labelnames, label_values + (repr(bound),)) +
+                ' ' + format_value(cumulative))
+
+        labels = format_labels(self.labelnames, label_values)
+
+        lines.append(
+            self.name + '_bucket' +
+            format_labels(labelnames, label_values + ('+Inf',)) +
+            ' ' + format_value(value[-1]))
+        lines.append(self.name + '_sum' + labels + ' ' +
+                     format_value(value[-2]))
+        lines.append(self.name + '_count' + labels + ' ' +
+                     format_value(value[-1]))
+
+        return lines
+
+    def merge(self, value, other):
+        return [a + b for a, b in zip(value, other)]
+
+
+def format_labels(labelnames, label_values):
+    """
+    Formats the labels of a sample.
+
+    Args:
+        labelnames: The names of the labels.
+        label_values: The values of the labels.
+
+    Returns:
+        The labels, in braces, or an empty string if there are none.
+    """
+    if len(labelnames) == 0:
+        return ''
+
+    return '{' + ','.join(
+        name + '="' + value.
+        replace('\\', '\\\\').
+        replace('\n', '\\n').
+        replace('"', '\\"') + '"'
+        for name, value in zip(labelnames, label_values)) + '}'
+
+
+def format_value(value):
+    """
+    Formats the value of a sample.
+
+    Args:
+        value: The value.
+
+    Returns:
+        The formatted value.
+    """
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def write_process_values():
+    """
+    Writes the values recorded by this process to its file in the
+    metrics directory. The file is replaced atomically, so it can be
+    read by other processes at any time. Writes from different threads
+    are serialized, so that older values can't replace newer ones.
+    """
+    directory = _state['directory']
+
+    if directory is None:
+        return
+
+    with _write_lock:
+        with _lock:
+            values = get_process_values()
+            rows = [
+                [name, list(label_values), value]
+                for (name, label_values), value in values.iteritems()
+            ]
+            filename = _state['filename']
+
+        path = os.path.join(directory, filename)
+
+        with open(path + '.tmp', 'w') as values_file:
+            json.dump(rows, values_file)
+
+        replace_file(path + '.tmp', path)
+
+
+def start_flusher():
+    """
+    Starts a thread that periodically writes the values recorded by
+    this process to the metrics directory.
+    """
+    def flush():
+        while True:
+            time.sleep(_state['flush_seconds'])
+
+            try:
+                write_process_values()
+            except (IOError, OSError):
+                pass
+
+    thread = Thread(target=flush, name='remedy-metrics')
+    thread.daemon = True
+    thread.start()
+
+
+@atexit.register
+def flush_at_exit():
+    """
+    Writes the final values recorded by this process when it exits.
+    """
+    if _state['pid'] == os.getpid():
+        try:
+            write_process_values()
+        except (IOError, OSError):
+            pass
+
+
+def collect():
+    """
+    Collects the values of every metric. If there is a metrics
+    directory, the values of every process are added together.
+
+    Returns:
+        A dictionary of metric names and label values to their values.
+    """
+    directory = _state['directory']
+
+    if directory is None:
+        with _lock:
+            return dict(
+                (key, list(value) if isinstance(value, list) else value)
+                for key, value in get_process_values().iteritems())
+
+    # Include everything this process has recorded so far. If that
+    # fails, its last written values are used instead.
+    try:
+        write_process_values()
+    except (IOError, OSError):
+        current_app.logger.exception('Error writing metrics.')
+
+    combined = {}
+
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path, 'r') as values_file:
+                rows = json.load(values_file)
+        except (IOError, OSError, ValueError):
+            continue
+
+        for name, label_values, value in rows:
+            metric = _metrics.get(name)
+
+            # Skip metrics that have since been removed or changed
+            if metric is None or len(label_values) != len(metric.labelnames):
+                continue
+
+            key = (name, tuple(label_values))
+
+            if key in combined:
+                combined[key] = metric.merge(combined[key], value)
+            else:
+                combined[key] = value
+
+    return combined
+
+
+def generate_text():
+    """
+    Generates the text exposition format of every metric.
+
+    Returns:
+        The text of the metrics.
+    """
+    values = collect()
+    lines = []
+
+    for name, metric in _metrics.iteritems():
+        lines.append('# HELP ' + name + ' ' + metric.documentation)
+        lines.append('# TYPE ' + name + ' ' + metric.type_name)
+
+        for key in sorted(k for k in values if k[0] == name):
+            lines.extend(metric.format_samples(key[1], values[key]))
+
+    return '\n'.join(lines) + '\n'
+
+
+# The metrics recorded throughout the application.
+HTTP_REQUESTS = Counter(
+    'remedy_http_requests_total',
+    'HTTP requests handled, by endpoint, method and status code.',
+    ('endpoint', 'method', 'status'))
+
+HTTP_REQUEST_DURATION = Histogram(
+    'remedy_http_request_duration_seconds',
+    'Time taken to handle HTTP requests, by endpoint.',
+    ('endpoint',))
+
+DB_QUERY_DURATION = Histogram(
+    'remedy_db_query_duration_seconds',
+    'Time taken to run SQL statements, by statement type.',
+    ('statement',),
+    buckets=QUERY_BUCKETS)
+
+CACHE_LOOKUPS = Counter(
+    'remedy_cache_lookups_total',
+    'Cache lookups, by namespace and result (hit or miss).',
+    ('namespace', 'result'))
+
+GEOCODER_REQUESTS = Counter(
+    'remedy_geocoder_requests_total',
+    'Requests to the external geocoding service, by result ' +
+    '(found, not_found, retried or error).',
+    ('result',))
+
+EMAIL_SEND_DURATION = Histogram(
+    'remedy_email_send_duration_seconds',
+    'Time taken to send emails, by result (sent or error).',
+    ('result',))
+
+IMPORT_RESOURCES = Counter(
+    'remedy_import_resources_total',
+    'Resources read by imports, by result (imported or failed).',
+    ('result',))
+
+IMPORT_CHUNK_DURATION = Histogram(
+    'remedy_import_chunk_duration_seconds',
+    'Time taken to import each chunk of resources.')
+
+
+def record_statement(statement, duration):
+    """
+    Records the time taken to run a SQL statement.
+
+    Args:
+        statement: The SQL statement.
+        duration: The time taken to run it, in seconds.
+    """
+    statement_type = statement.lstrip()[:6].lower()
+
+    if statement_type not in STATEMENT_TYPES:
+        statement_type = 'other'
+
+    DB_QUERY_DURATION.observe(duration, statement=statement_type)
+
+
+def start_request():
+    """
+    Records the time the current request started.
+    """
+    g.remedy_metrics_start = time.time()
+
+
+def record_request(status_code):
+    """
+    Records the current request, if it hasn't already been recorded.
+
+    Args:
+        status_code: The status code of the response.
+    """
+    start = getattr(g, 'remedy_metrics_start', None)
+
+    if start is None:
+        return
+
+    g.remedy_metrics_start = None
+    endpoint = request.endpoint or 'none'
+
+    HTTP_REQUESTS.inc(
+        endpoint=endpoint,
+        method=request.method,
+        status=status_code)
+    HTTP_REQUEST_DURATION.observe(time.time() - start, endpoint=endpoint)
+
+
+def finish_request(response):
+    """
+    Records the current request.
+
+    Args:
+        response: The response to the current request.
+
+    Returns:
+        The response.
+    """
+    record_request(response.status_code)
+    return response
+
+
+def teardown_request(exception):
+    """
+    Records the current request if it failed before a response
+    was returned.
+
+    Args:
+        exception: The exception that ended the request, if any.
+    """
+    if exception is not None:
+        record_request(500)
+
+
+def metrics_view():
+    """
+    Returns the metrics in the text exposition format.
+
+    If the METRICS_TOKEN configuration value is set, requests must
+    provide it as a bearer token. Otherwise, requests must come directly
+    (not through a proxy) from one of the METRICS_ALLOWED_ADDRESSES.
+    """
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+
+    if token:
+        if request.headers.get('Authorization') != 'Bearer ' + token:
+            abort(404)
+    elif request.remote_addr not in \
+            config.get('METRICS_ALLOWED_ADDRESSES', ()) or \
+            'X-Forwarded-For' in request.headers:
+        abort(404)
+
+    return Response(generate_text(), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """
+    Sets up metrics for the provided application, if they are enabled
+    by the METRICS_ENABLED configuration value.
+
+    Args:
+        app: The application.
+    """
+    if not app.config.get('METRICS_ENABLED', False):
+        return
+
+    directory = app.config.get('METRICS_DIR')
+
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with _lock:
+        _state['flush_seconds'] = app.config.get('METRICS_FLUSH_SECONDS', 5)
+
+        # Make sure this process writes its values from now on
+        if directory is not None and _state['directory'] is None:
+            _state['directory'] = directory
+
+            if _state['pid'] == os.getpid():
+                start_flusher()
+
+    add_statement_observer(record_statement)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -2,36 +2,65 @@
 pagination.py
 
 Defines a basic pagination structure that can be used when displaying
-a list of search results.
+a list of search results, along with helpers for the opaque cursors
+used when paging by keyset rather than by page number.
 
 Based on http://flask.pocoo.org/snippets/44/
 """
 
 from math import ceil
 
+from flask import abort, current_app
+from itsdangerous import URLSafeSerializer, BadData
+
+from rad.keyset import seek, dump_values, load_values
+
 
 class Pagination(object):
     """
     A basic pagination structure.
+
+    When paging by keyset, next_cursor and prev_cursor hold dictionaries
+    describing how to seek to the adjacent pages, and total may be None
+    if the number of items isn't known.
     """
-    def __init__(self, page, per_page, total):
+    def __init__(self, page, per_page, total, items=None,
+                 next_cursor=None, prev_cursor=None):
         """
         Sets up the pagination structure.
 
         Args:
             page: The current page number, starting at 1.
             per_page: The number of items allowed per page.
-            total: The total number of items being paged.
+            total: The total number of items being paged, or None
+                if not known.
+            items: The items on the current page. Optional.
+            next_cursor: The cursor for the next page, if any. Optional.
+            prev_cursor: The cursor for the previous page, if any.
+                Optional.
         """
         self.page = page
         self.per_page = per_page
         self.total = total
+        self.items = items if items is not None else []
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def uses_cursors(self):
+        """
+        Determines if adjacent pages are linked by cursor.
+        """
+        return self.next_cursor is not None or self.prev_cursor is not None
 
     @property
     def pages(self):
         """
-        Gets the total number of pages.
+        Gets the total number of pages, or None if not known.
         """
+        if self.total is None:
+            return None
+
         return int(ceil(self.total / float(self.per_page)))
 
     @property
@@ -39,6 +68,9 @@ class Pagination(object):
         """
         Determines if there is a previous page available.
         """
+        if self.uses_cursors:
+            return self.prev_cursor is not None
+
         return self.page > 1
 
     @property
@@ -46,7 +78,10 @@ class Pagination(object):
         """
         Determines if there is a next page available.
         """
-        return self.page < self.pages
+        if self.uses_cursors:
+            return self.next_cursor is not None
+
+        return self.pages is not None and self.page < self.pages
 
     def iter_pages(self, left_edge=2, left_current=2,
                    right_current=3, right_edge=2):
@@ -64,13 +99,252 @@ class Pagination(object):
         Returns:
             An iterator for the page numbers to display.
         """
+        # Without a total, only show up to the current page
+        pages = self.pages if self.pages is not None else self.page
+
         last = 0
-        for num in xrange(1, self.pages + 1):
+        for num in xrange(1, pages + 1):
             if num <= left_edge or \
                     (num > self.page - left_current - 1 and
                         num < self.page + right_current) or \
-                    num > self.pages - right_edge:
+                    num > pages - right_edge:
                 if last + 1 != num:
                     yield None
                 yield num
                 last = num
+
+
+def get_cursor_serializer():
+    """
+    Gets the serializer used to sign cursors.
+
+    Returns:
+        The serializer.
+    """
+    return URLSafeSerializer(current_app.secret_key, salt='pagination-cursor')
+
+
+def encode_cursor(cursor):
+    """
+    Converts a cursor into a signed string suitable for URLs.
+
+    Args:
+        cursor: The cursor dictionary.
+
+    Returns:
+        The encoded cursor.
+    """
+    return get_cursor_serializer().dumps(cursor)
+
+
+def decode_cursor(token):
+    """
+    Converts a string from encode_cursor back into a cursor.
+
+    Args:
+        token: The encoded cursor.
+
+    Returns:
+        The cursor dictionary, or None if the token is
+        missing or invalid.
+    """
+    if not token:
+        return None
+
+    try:
+        cursor = get_cursor_serializer().loads(token)
+    except BadData:
+        return None
+
+    if not isinstance(cursor, dict):
+        return None
+
+    return cursor
+
+
+def get_cursor_page(cursor):
+    """
+    Gets the page number stored in a cursor.
+
+    Args:
+        cursor: The cursor dictionary.
+
+    Returns:
+        The page number, which will be at least 1.
+    """
+    try:
+        return max(int(cursor.get('p', 1)), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def seek_paginate(query, sort_keys, page_size, page_number=1,
+                  cursor=None, sort_name=None, total=None):
+    """
+    Gets a page of results from a query, seeking by keyset when a
+    cursor is provided and otherwise falling back to the page number.
+    Cursors for the adjacent pages will be included in the result.
+
+    Args:
+        query: The query to page through.
+        sort_keys: The list of SortKey instances that define the
+            ordering. The last key must be unique.
+        page_size: The number of items on each page.
+        page_number: The 1-indexed page number to use if no valid
+            cursor is provided.
+        cursor: The cursor dictionary. Optional.
+        sort_name: The name of the ordering in use, which is used
+            to ignore cursors from other orderings. Optional.
+        total: The total number of items, if known. Optional.
+
+    Returns:
+        A Pagination object whose items are the sort value
+        tuples of each row on the page.
+    """
+    values = None
+
+    if cursor is not None and \
+            cursor.get('s') == sort_name and \
+            cursor.get('d') in ('a', 'b'):
+        values = load_values(sort_keys, cursor.get('k'))
+
+    if values is not None:
+        page_number = get_cursor_page(cursor)
+
+        if cursor['d'] == 'a':
+            rows, has_next = seek(query, sort_keys, page_size, after=values)
+            has_prev = True
+        else:
+            rows, has_prev = seek(
+                query,
+                sort_keys,
+                page_size,
+                before=values)
+            has_next = True
+
+            if not has_prev:
+                page_number = 1
+    else:
+        # Mirror the behavior of Flask-SQLAlchemy's paginate()
+        if page_number < 1:
+            abort(404)
+
+        rows, has_next = seek(
+            query,
+            sort_keys,
+            page_size,
+            offset=(page_number - 1) * page_size)
+        has_prev = page_number > 1
+
+        if len(rows) == 0 and page_number != 1:
+            abort(404)
+
+    next_cursor = None
+    prev_cursor = None
+
+    if has_next and len(rows) > 0:
+        next_cursor = {
+            's': sort_name,
+            'd': 'a',
+            'k': dump_values(sort_keys, rows[-1]),
+            'p': page_number + 1
+        }
+
+    if has_prev and len(rows) > 0:
+        prev_cursor = {
+            's': sort_name,
+            'd': 'b',
+            'k': dump_values(sort_keys, rows[0]),
+            'p': page_number - 1
+        }
+
+    return Pagination(
+        page_number,
+        page_size,
+        total,
+        rows,
+        next_cursor,
+        prev_cursor)
+
+
+def list_paginate(ids, page_size, page_number=1, cursor=None,
+                  sort_name=None):
+    """
+    Gets a page of IDs from an ordered list, seeking past the ID in
+    the cursor when one is provided and otherwise falling back to the
+    page number. Cursors for the adjacent pages will be included in
+    the result.
+
+    Args:
+        ids: The ordered list of all IDs.
+        page_size: The number of items on each page.
+        page_number: The 1-indexed page number to use if no valid
+            cursor is provided.
+        cursor: The cursor dictionary. Optional.
+        sort_name: The name of the ordering in use, which is used
+            to ignore cursors from other orderings. Optional.
+
+    Returns:
+        A Pagination object whose items are the IDs on the page.
+    """
+    if cursor is not None and \
+            cursor.get('s') == sort_name and \
+            cursor.get('d') in ('a', 'b'):
+        page_number = get_cursor_page(cursor)
+
+        # Find the ID, falling back to its last-known position
+        # if it is no longer in the list
+        try:
+            anchor = ids.index(cursor.get('i'))
+        except ValueError:
+            try:
+                anchor = max(int(cursor.get('o', 0)), 0)
+            except (TypeError, ValueError):
+                anchor = 0
+
+        if cursor['d'] == 'a':
+            start = anchor + 1
+        else:
+            start = max(anchor - page_size, 0)
+
+            if start == 0:
+                page_number = 1
+    else:
+        # Mirror the behavior of Flask-SQLAlchemy's paginate()
+        if page_number < 1:
+            abort(404)
+
+        start = (page_number - 1) * page_size
+
+        if start >= len(ids) and page_number != 1:
+            abort(404)
+
+    page_ids = ids[start:start + page_size]
+    next_cursor = None
+    prev_cursor = None
+
+    if start + page_size < len(ids) and len(page_ids) > 0:
+        next_cursor = {
+            's': sort_name,
+            'd': 'a',
+            'i': page_ids[-1],
+            'o': start + len(page_ids) - 1,
+            'p': page_number + 1
+        }
+
+    if start > 0 and len(page_ids) > 0:
+        prev_cursor = {
+            's': sort_name,
+            'd': 'b',
+            'i': page_ids[0],
+            'o': start,
+            'p': page_number - 1
+        }
+
+    return Pagination(
+        page_number,
+        page_size,
+        len(ids),
+        page_ids,
+        next_cursor,
+        prev_cursor)
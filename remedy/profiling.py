@@ -0,0 +1,450 @@
+"""
+profiling.py
+
+Contains an opt-in sampling profiler for individual requests.
+
+A request is profiled when an administrator asks for it, through the
+X-Remedy-Profile header or the _profile query argument, or when it is
+picked at random based on the PROFILING_SAMPLE_RATE configuration value.
+While the request is handled, a background thread periodically samples
+the call stack of the thread handling it. The samples are kept as
+collapsed stacks (the frames of each distinct stack joined by semicolons,
+along with the number of times it was seen), which can be turned into
+flame graphs by tools such as flamegraph.pl or speedscope. The SQL
+statements run during the request are recorded alongside them.
+
+Profiles are kept in the cache as a ring of the most recent
+PROFILING_BUFFER_SIZE requests, so that profiles from every worker
+process can be browsed when the cache is shared between them.
+"""
+from datetime import datetime
+from thread import get_ident
+from threading import Thread
+from uuid import uuid4
+import os
+import random
+import sys
+import time
+
+from flask import g, request, current_app
+from flask.ext.login import current_user
+
+from caching import get_cache
+from instrumentation import RequestStats, get_request_stats
+
+# The request header used to ask for a profile.
+PROFILE_HEADER = 'X-Remedy-Profile'
+
+# The query argument used to ask for a profile.
+PROFILE_ARG = '_profile'
+
+# The response header containing the ID of the request's profile.
+PROFILE_ID_HEADER = 'X-Remedy-Profile-Id'
+
+# The cache key of the list of stored profile IDs, newest first.
+PROFILE_INDEX_KEY = 'profiles:index'
+
+# The number of seconds to keep profiles.
+PROFILE_TIMEOUT = 60 * 60 * 24 * 7
+
+# The deepest stack to record. Deeper stacks keep their innermost frames.
+MAX_STACK_DEPTH = 100
+
+# The number of statement shapes to keep with each profile.
+PROFILE_SQL_SHAPES = 20
+
+# The labels of each code object that has been sampled.
+_frame_labels = {}
+
+
+def get_frame_label(code):
+    """
+    Gets the label of a frame in a collapsed stack, containing the
+    shortened path of its file and the name of its function.
+
+    Args:
+        code: The code object of the frame.
+
+    Returns:
+        The label of the frame.
+    """
+    label = _frame_labels.get(code)
+
+    if label is None:
+        filename = code.co_filename
+
+        # Show paths relative to the longest containing import path
+        for path in sorted(sys.path, key=len, reverse=True):
+            if path and filename.startswith(path + os.sep):
+                filename = filename[len(path) + 1:]
+                break
+
+        # Semicolons and spaces separate frames and counts
+        label = (filename + ':' + code.co_name). \
+            replace(';', ':'). \
+            replace(' ', '_')
+
+        _frame_labels[code] = label
+
+    return label
+
+
+def collapse_stack(frame):
+    """
+    Collapses a call stack into a single line, with the outermost
+    frame first.
+
+    Args:
+        frame: The innermost frame of the stack.
+
+    Returns:
+        The labels of the frames, joined by semicolons.
+    """
+    labels = []
+
+    while frame is not None:
+        labels.append(get_frame_label(frame.f_code))
+        frame = frame.f_back
+
+    if len(labels) > MAX_STACK_DEPTH:
+        labels = labels[:MAX_STACK_DEPTH]
+        labels.append('...')
+
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class StackSampler(Thread):
+    """
+    A thread that samples the call stack of another thread.
+
+    Attributes:
+        thread_id: The ID of the thread being sampled.
+        interval: The number of seconds between samples.
+        samples: The number of samples taken.
+        stacks: A dictionary of collapsed stacks to the number of
+            samples in which they were seen.
+    """
+
+    def __init__(self, thread_id, interval):
+        super(StackSampler, self).__init__(name='remedy-profiler')
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self._running = True
+
+    def run(self):
+        while self._running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is None or not self._running:
+                continue
+
+            stack = collapse_stack(frame)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+            # Don't keep the sampled thread's frames alive
+            del frame
+
+    def stop(self):
+        """
+        Stops sampling and waits for the thread to finish.
+        """
+        self._running = False
+        self.join()
+
+
+class RequestProfile(object):
+    """
+    The profile of a single request.
+
+    Attributes:
+        id: The unique ID of the profile.
+        method: The HTTP method of the request.
+        path: The full path of the request, including the query string.
+        endpoint: The endpoint that handled the request.
+        reason: Why the request was profiled: "requested" if it was
+            asked for by an administrator, or "sampled" if it was
+            picked at random.
+        user: The username of the logged-in user, if any.
+        date_created: The time the request started.
+        duration: The number of seconds taken to handle the request.
+        status_code: The status code of the response.
+        interval: The number of seconds between samples.
+        samples: The number of samples taken.
+        stacks: A dictionary of collapsed stacks to the number of
+            samples in which they were seen.
+        sql_count: The number of SQL statements run.
+        sql_duration: The number of seconds spent running them.
+        sql_shapes: A list of tuples of the most frequently run
+            statement shapes, the number of times they were run and the
+            number of seconds spent running them.
+    """
+
+    def __init__(self, reason, interval):
+        self.id = uuid4().hex[:12]
+        self.method = request.method
+        self.path = request.full_path
+        self.endpoint = request.endpoint
+        self.reason = reason
+        self.user = None
+        self.date_created = datetime.utcnow()
+        self.duration = 0.0
+        self.status_code = None
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.sql_count = 0
+        self.sql_duration = 0.0
+        self.sql_shapes = []
+
+    def collapsed(self):
+        """
+        Gets the profile in the collapsed stack format used by
+        flame graph tools.
+
+        Returns:
+            The collapsed stacks and their sample counts, one per line,
+            in descending order of sample count.
+        """
+        return '\n'.join(
+            stack + ' ' + str(count)
+            for stack, count in sorted(
+                self.stacks.iteritems(),
+                key=lambda s: s[1],
+                reverse=True))
+
+    def top_functions(self, limit=25):
+        """
+        Gets the functions that appeared in the most samples.
+
+        Args:
+            limit: The maximum number of functions to return.
+
+        Returns:
+            A list of tuples containing the label of each function,
+            the number of samples in which it was running (its self
+            samples) and the number of samples in which it was anywhere
+            on the stack (its total samples), in descending order of
+            self samples.
+        """
+        functions = {}
+
+        for stack, count in self.stacks.iteritems():
+            frames = stack.split(';')
+
+            for label in set(frames):
+                functions.setdefault(label, [0, 0])[1] += count
+
+            functions[frames[-1]][0] += count
+
+        return sorted(
+            (
+                (label, self_count, total_count)
+                for label, (self_count, total_count) in functions.iteritems()
+            ),
+            key=lambda f: (f[1], f[2]),
+            reverse=True)[:limit]
+
+
+def get_profiles():
+    """
+    Gets the stored profiles.
+
+    Returns:
+        A list of the RequestProfiles, newest first.
+    """
+    cache = get_cache()
+    profiles = []
+
+    for profile_id in cache.get(PROFILE_INDEX_KEY) or []:
+        profile = cache.get('profiles:' + profile_id)
+
+        if profile is not None:
+            profiles.append(profile)
+
+    return profiles
+
+
+def get_profile(profile_id):
+    """
+    Gets a stored profile.
+
+    Args:
+        profile_id: The ID of the profile.
+
+    Returns:
+        The RequestProfile, or None if it doesn't exist.
+    """
+    if profile_id not in (get_cache().get(PROFILE_INDEX_KEY) or []):
+        return None
+
+    return get_cache().get('profiles:' + profile_id)
+
+
+def save_profile(profile):
+    """
+    Stores a profile, discarding the oldest profiles once there are
+    more than PROFILING_BUFFER_SIZE of them.
+
+    Args:
+        profile: The RequestProfile.
+    """
+    cache = get_cache()
+    size = current_app.config.get('PROFILING_BUFFER_SIZE', 50)
+    profile_ids = [profile.id] + (cache.get(PROFILE_INDEX_KEY) or [])
+
+    cache.set('profiles:' + profile.id, profile, timeout=PROFILE_TIMEOUT)
+    cache.set(PROFILE_INDEX_KEY, profile_ids[:size], timeout=PROFILE_TIMEOUT)
+
+    for profile_id in profile_ids[size:]:
+        cache.delete('profiles:' + profile_id)
+
+
+def clear_profiles():
+    """
+    Removes all stored profiles.
+    """
+    cache = get_cache()
+
+    for profile_id in cache.get(PROFILE_INDEX_KEY) or []:
+        cache.delete('profiles:' + profile_id)
+
+    cache.delete(PROFILE_INDEX_KEY)
+
+
+def get_profile_reason():
+    """
+    Determines if the current request should be profiled.
+
+    Returns:
+        "requested" if an administrator asked for the request to be
+        profiled, "sampled" if it was picked at random, or None if
+        it shouldn't be profiled.
+    """
+    # Don't profile static files or the profiles themselves
+    if request.endpoint == 'static' or request.blueprint == 'profileview':
+        return None
+
+    if request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_ARG):
+        if current_user.is_authenticated and current_user.admin:
+            return 'requested'
+
+    sample_rate = current_app.config.get('PROFILING_SAMPLE_RATE', 0)
+
+    if sample_rate > 0 and random.random() < sample_rate:
+        return 'sampled'
+
+    return None
+
+
+def start_request():
+    """
+    Starts profiling the current request, if it should be profiled.
+    """
+    reason = get_profile_reason()
+
+    if reason is None:
+        return
+
+    # Record SQL statements even if instrumentation is otherwise disabled
+    if get_request_stats() is None:
+        g.remedy_sql_stats = RequestStats()
+
+    interval = current_app.config.get('PROFILING_INTERVAL', 0.005)
+    sampler = StackSampler(get_ident(), interval)
+
+    g.remedy_profile = (RequestProfile(reason, interval), sampler)
+    sampler.start()
+
+
+def stop_profile(status_code):
+    """
+    Stops profiling the current request and stores its profile.
+
+    Args:
+        status_code: The status code of the response.
+
+    Returns:
+        The RequestProfile, or None if the request wasn't profiled.
+    """
+    current = getattr(g, 'remedy_profile', None)
+
+    if current is None:
+        return None
+
+    g.remedy_profile = None
+    profile, sampler = current
+    sampler.stop()
+
+    profile.duration = \
+        (datetime.utcnow() - profile.date_created).total_seconds()
+    profile.status_code = status_code
+    profile.samples = sampler.samples
+    profile.stacks = sampler.stacks
+
+    if current_user.is_authenticated:
+        profile.user = current_user.username
+
+    stats = get_request_stats()
+
+    if stats is not None:
+        profile.sql_count = stats.count
+        profile.sql_duration = stats.duration
+        profile.sql_shapes = stats.top_shapes(PROFILE_SQL_SHAPES)
+
+    save_profile(profile)
+    return profile
+
+
+def finish_request(response):
+    """
+    Stores the profile of the current request, if it was profiled,
+    and adds its ID to the response.
+
+    Args:
+        response: The response to the current request.
+
+    Returns:
+        The response.
+    """
+    profile = stop_profile(response.status_code)
+
+    if profile is not None:
+        response.headers[PROFILE_ID_HEADER] = profile.id
+
+    return response
+
+
+def teardown_request(exception):
+    """
+    Stores the profile of the current request if it failed before
+    a response was returned.
+
+    Args:
+        exception: The exception that ended the request, if any.
+    """
+    if exception is not None:
+        stop_profile(500)
+
+
+def init_profiling(app):
+    """
+    Sets up request profiling for the provided application, if it is
+    enabled by the PROFILING_ENABLED configuration value. This should be
+    set up after SQL instrumentation, so that the request's statistics
+    are still available when its profile is stored.
+
+    Args:
+        app: The application.
+    """
+    if not app.config.get('PROFILING_ENABLED', False):
+        return
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(teardown_request)
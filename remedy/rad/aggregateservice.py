@@ -0,0 +1,232 @@
+"""
+aggregateservice.py
+
+This module contains functionality for maintaining the aggregated review
+scores (ResourceReviewScore) for resources.
+
+Aggregates are recalculated for individual resources as reviews and user
+populations change. Each resource has an overall aggregate (with a
+population ID of 0) built from its visible, top-level reviews, and an
+aggregate for each population that those reviewers belong to.
+"""
+from sqlalchemy import select, func, literal_column
+
+from models import Review, ResourceReviewScore, userpopulation
+from remedy.caching import add_session_tags
+
+# The number of resource IDs to include in a single IN clause.
+ID_CHUNK_SIZE = 500
+
+# The tolerance used when comparing averages during verification.
+AVG_TOLERANCE = 0.0001
+
+
+def get_aggregate_selects(resource_ids=None):
+    """
+    Gets the queries that calculate aggregates from reviews.
+
+    Args:
+        resource_ids: The IDs of the resources to calculate aggregates
+            for. If not specified, all resources will be included.
+
+    Returns:
+        A list of SELECT statements whose columns match those of
+        the aggregate table.
+    """
+    review = Review.__table__
+
+    overall = select([
+        review.c.resource_id,
+        literal_column('0'),  # Special value used for top-level scores
+        func.count(review.c.id),
+        func.min(review.c.date_created),
+        func.max(review.c.date_created),
+        func.avg(review.c.rating),
+        func.avg(review.c.staff_rating),
+        func.avg(review.c.intake_rating)
+    ]). \
+        where(review.c.visible == True). \
+        where(review.c.is_old_review == False). \
+        group_by(review.c.resource_id)
+
+    by_population = select([
+        review.c.resource_id,
+        userpopulation.c.population_id,
+        func.count(review.c.id),
+        func.min(review.c.date_created),
+        func.max(review.c.date_created),
+        func.avg(review.c.rating),
+        func.avg(review.c.staff_rating),
+        func.avg(review.c.intake_rating)
+    ]). \
+        select_from(review.join(
+            userpopulation,
+            userpopulation.c.user_id == review.c.user_id)). \
+        where(review.c.visible == True). \
+        where(review.c.is_old_review == False). \
+        group_by(review.c.resource_id, userpopulation.c.population_id)
+
+    if resource_ids is not None:
+        overall = overall.where(review.c.resource_id.in_(resource_ids))
+        by_population = by_population.where(
+            review.c.resource_id.in_(resource_ids))
+
+    return [overall, by_population]
+
+
+def get_aggregate_columns():
+    """
+    Gets the aggregate table columns, in the same order as the
+    columns returned by get_aggregate_selects.
+
+    Returns:
+        The list of columns.
+    """
+    table = ResourceReviewScore.__table__
+
+    return [
+        table.c.resource_id,
+        table.c.population_id,
+        table.c.num_ratings,
+        table.c.first_reviewed,
+        table.c.last_reviewed,
+        table.c.rating_avg,
+        table.c.staff_rating_avg,
+        table.c.intake_rating_avg
+    ]
+
+
+def update_resource_aggregates(session, resource_ids):
+    """
+    Recalculates the aggregates for the specified resources.
+    Pending changes will be flushed first, and the updated
+    aggregates are committed along with the session.
+
+    Args:
+        session: The current database session.
+        resource_ids: The IDs of the resources to update.
+    """
+    resource_ids = list(set(resource_ids))
+
+    if len(resource_ids) == 0:
+        return
+
+    session.flush()
+
+    table = ResourceReviewScore.__table__
+
+    for start in xrange(0, len(resource_ids), ID_CHUNK_SIZE):
+        id_chunk = resource_ids[start:start + ID_CHUNK_SIZE]
+
+        session.execute(
+            table.delete().where(table.c.resource_id.in_(id_chunk)))
+
+        for aggregate_select in get_aggregate_selects(id_chunk):
+            session.execute(table.insert().from_select(
+                get_aggregate_columns(),
+                aggregate_select))
+
+    # These changes bypass the ORM, so make sure caches see them
+    add_session_tags(session, ('resource_review_score',))
+
+
+def update_user_aggregates(session, user_id):
+    """
+    Recalculates the aggregates for all resources that the specified
+    user has reviewed, such as when their populations change.
+
+    Args:
+        session: The current database session.
+        user_id: The ID of the user.
+    """
+    session.flush()
+
+    resource_ids = [
+        row.resource_id
+        for row in session.query(Review.resource_id).
+        filter(Review.user_id == user_id).
+        filter(Review.visible == True).
+        filter(Review.is_old_review == False).
+        distinct()
+    ]
+
+    update_resource_aggregates(session, resource_ids)
+
+
+def rebuild_aggregates(session):
+    """
+    Recalculates the aggregates for all resources.
+
+    Args:
+        session: The current database session.
+    """
+    session.flush()
+
+    table = ResourceReviewScore.__table__
+    session.execute(table.delete())
+
+    for aggregate_select in get_aggregate_selects():
+        session.execute(table.insert().from_select(
+            get_aggregate_columns(),
+            aggregate_select))
+
+    add_session_tags(session, ('resource_review_score',))
+
+
+def aggregate_values_match(expected, actual):
+    """
+    Determines if two rows of aggregate values match, allowing for
+    rounding differences in the averages.
+
+    Args:
+        expected: The expected row of values.
+        actual: The actual row of values.
+
+    Returns:
+        A boolean indicating if the values match.
+    """
+    for expected_value, actual_value in zip(expected, actual):
+        if isinstance(expected_value, float) or \
+                isinstance(actual_value, float):
+            if expected_value is None or actual_value is None:
+                if expected_value is not actual_value:
+                    return False
+            elif abs(float(expected_value) - float(actual_value)) > \
+                    AVG_TOLERANCE:
+                return False
+        elif expected_value != actual_value:
+            return False
+
+    return True
+
+
+def verify_aggregates(session):
+    """
+    Compares the stored aggregates against freshly-calculated ones.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        A sorted list of the IDs of resources whose stored
+        aggregates are missing, extraneous or out of date.
+    """
+    expected = {}
+
+    for aggregate_select in get_aggregate_selects():
+        for row in session.execute(aggregate_select):
+            expected[(row[0], int(row[1]))] = tuple(row[2:])
+
+    actual = {}
+
+    for row in session.execute(select(get_aggregate_columns())):
+        actual[(row[0], row[1])] = tuple(row[2:])
+
+    drifted = set()
+
+    for key in set(expected) | set(actual):
+        if key not in expected or key not in actual or \
+                not aggregate_values_match(expected[key], actual[key]):
+            drifted.add(key[0])
+
+    return sorted(drifted)
@@ -0,0 +1,269 @@
+"""
+autocomplete.py
+
+Contains the in-memory index used to suggest search text as users type.
+
+Suggestions come from the names and keywords of visible categories and
+populations, along with the names of the most-reviewed resources. Each
+suggestion is indexed under every word-aligned suffix of its name and
+keywords ("primary care" is indexed under "primary care" and "care"),
+and those terms are kept in a sorted array so that a prefix lookup is
+a binary search followed by a scan of the matching range.
+
+The index is kept in memory for each process and is rebuilt when the
+cache tags of the underlying tables are invalidated, such as when
+categories are edited in the administrative interface.
+"""
+import hashlib
+import re
+from bisect import bisect_left
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import and_
+
+from models import db, Category, CategoryGroup, Population, \
+    PopulationGroup, Resource, ResourceReviewScore
+from remedy.caching import make_key
+
+# The namespace used to version the index.
+AUTOCOMPLETE_NAMESPACE = 'autocomplete-index'
+
+# The tables that suggestions are built from.
+AUTOCOMPLETE_TAGS = (
+    'category',
+    'category_group',
+    'population',
+    'population_group',
+    'resource',
+    'resource_review_score'
+)
+
+# The maximum number of suggestions to return.
+MAX_SUGGESTIONS = 8
+
+# Prefixes up to this length have their suggestions precalculated,
+# since they match the largest ranges of terms.
+PRECALCULATED_PREFIX_LENGTH = 2
+
+# Guards rebuilding the index in each process.
+_index_lock = Lock()
+
+
+def normalize_text(text):
+    """
+    Normalizes text for indexing and lookups, ignoring case,
+    punctuation and extra whitespace.
+
+    Args:
+        text: The text to normalize.
+
+    Returns:
+        The normalized text.
+    """
+    return u' '.join(
+        re.sub(r'[^\w\s]+', u' ', text.lower(), flags=re.UNICODE).split())
+
+
+def get_word_suffixes(text):
+    """
+    Gets each suffix of the text that starts at a word, so that
+    lookups can match the start of any word.
+
+    Args:
+        text: The normalized text.
+
+    Returns:
+        A list of suffixes, starting with the full text.
+    """
+    words = text.split()
+    return [u' '.join(words[i:]) for i in xrange(len(words))]
+
+
+class AutocompleteIndex(object):
+    """
+    A sorted prefix array of search suggestions.
+
+    Attributes:
+        suggestions: The suggestions, in the order they should be returned.
+    """
+
+    def __init__(self, entries):
+        """
+        Builds the index from the provided entries.
+
+        Args:
+            entries: A list of tuples, in the order the suggestions should
+                be returned. Each tuple contains the suggestion and a list
+                of additional text (such as keywords) that it should be
+                found by.
+        """
+        self.suggestions = []
+        seen = set()
+        terms = []
+
+        for suggestion, extra_text in entries:
+            # Only include the first instance of each suggestion
+            normalized = normalize_text(suggestion)
+
+            if len(normalized) == 0 or normalized in seen:
+                continue
+
+            seen.add(normalized)
+            rank = len(self.suggestions)
+            self.suggestions.append(suggestion)
+
+            term_set = set(get_word_suffixes(normalized))
+
+            for text in extra_text:
+                # Keywords can be separated by commas or lines
+                for phrase in re.split(r'[,;\n]', text or u''):
+                    term_set.update(get_word_suffixes(normalize_text(phrase)))
+
+            terms.extend((term, rank) for term in term_set)
+
+        terms.sort()
+        self._terms = [term for term, term_rank in terms]
+        self._ranks = [term_rank for term, term_rank in terms]
+
+        # Precalculate the results for short prefixes
+        self._short_results = {}
+
+        for length in xrange(1, PRECALCULATED_PREFIX_LENGTH + 1):
+            prefixes = set(
+                term[:length]
+                for term in self._terms
+                if len(term) >= length)
+
+            for prefix in prefixes:
+                self._short_results[prefix] = self._search(prefix)
+
+    def _search(self, prefix):
+        """
+        Finds the suggestions with a term that starts with the prefix.
+
+        Args:
+            prefix: The normalized prefix.
+
+        Returns:
+            A list of up to MAX_SUGGESTIONS suggestions.
+        """
+        start = bisect_left(self._terms, prefix)
+        end = start
+        ranks = set()
+
+        while end < len(self._terms) and \
+                self._terms[end].startswith(prefix):
+            ranks.add(self._ranks[end])
+            end += 1
+
+        return [
+            self.suggestions[rank]
+            for rank in sorted(ranks)[:MAX_SUGGESTIONS]
+        ]
+
+    def search(self, text):
+        """
+        Finds suggestions for the provided search text.
+
+        Args:
+            text: The search text.
+
+        Returns:
+            A list of up to MAX_SUGGESTIONS suggestions.
+        """
+        prefix = normalize_text(text)
+
+        if len(prefix) == 0:
+            return []
+
+        if len(prefix) <= PRECALCULATED_PREFIX_LENGTH:
+            return self._short_results.get(prefix, [])
+
+        return self._search(prefix)
+
+
+def build_autocomplete_index(session, resource_limit=500):
+    """
+    Builds the autocomplete index from the current categories,
+    populations and resources.
+
+    Args:
+        session: The current database session.
+        resource_limit: The number of resources, with the most
+            reviews, to include.
+
+    Returns:
+        The AutocompleteIndex.
+    """
+    entries = []
+
+    # Categories come first, using the same order as the
+    # grouped category options
+    categories = session.query(Category.name, Category.keywords). \
+        filter(Category.visible == True). \
+        outerjoin(CategoryGroup, Category.grouping). \
+        order_by(
+            CategoryGroup.grouporder,
+            CategoryGroup.name,
+            Category.name)
+
+    entries.extend((c.name, [c.keywords]) for c in categories)
+
+    populations = session.query(Population.name, Population.keywords). \
+        filter(Population.visible == True). \
+        outerjoin(PopulationGroup, Population.grouping). \
+        order_by(
+            PopulationGroup.grouporder,
+            PopulationGroup.name,
+            Population.name)
+
+    entries.extend((p.name, [p.keywords]) for p in populations)
+
+    # Then include the resources with the most reviews
+    if resource_limit > 0:
+        resources = session.query(Resource.name). \
+            join(ResourceReviewScore, and_(
+                ResourceReviewScore.resource_id == Resource.id,
+                ResourceReviewScore.population_id == 0)). \
+            filter(Resource.visible == True). \
+            filter(Resource.is_approved == True). \
+            order_by(
+                ResourceReviewScore.num_ratings.desc(),
+                Resource.name). \
+            limit(resource_limit)
+
+        entries.extend((r.name, []) for r in resources)
+
+    return AutocompleteIndex(entries)
+
+
+def get_autocomplete_index():
+    """
+    Gets the autocomplete index for the current application, rebuilding
+    it if any of the underlying tables have changed since it was built.
+
+    Returns:
+        A tuple containing the AutocompleteIndex and a string that
+        identifies its version.
+    """
+    version = hashlib.sha1(
+        make_key(AUTOCOMPLETE_NAMESPACE, '', AUTOCOMPLETE_TAGS)).hexdigest()
+    current = current_app.extensions.get('remedy_autocomplete')
+
+    if current is None or current[1] != version:
+        with _index_lock:
+            current = current_app.extensions.get('remedy_autocomplete')
+
+            if current is None or current[1] != version:
+                current = (
+                    build_autocomplete_index(
+                        db.session,
+                        current_app.config.get(
+                            'AUTOCOMPLETE_RESOURCE_LIMIT',
+                            500)),
+                    version)
+
+                current_app.extensions['remedy_autocomplete'] = current
+
+    return current
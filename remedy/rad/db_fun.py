@@ -4,8 +4,12 @@ db_fun.py
 This module contains helper functions for database entry creation.
 """
 
-from models import Resource, Category, Population
+from models import Resource, Category, Population, get_duplicate_key
+from remedy.metrics import IMPORT_RESOURCES, IMPORT_CHUNK_DURATION
 from datetime import datetime
+from itertools import islice
+from werkzeug.datastructures import MultiDict
+import time
 
 
 def get_or_create(session, model, **kwargs):
@@ -122,6 +126,137 @@ def try_add_populations(session, record, population_tags):
             record.populations.append(population_record)
 
 
+def copy_resource_fields(record, rad_record, new_record=True):
+    """
+    Copies the fields (other than the name, categories and populations)
+    from a RadRecord to a resource.
+
+    Args:
+        record: The resource to update.
+        rad_record: The RadRecord to copy fields from.
+        new_record: A boolean indicating if the resource is new.
+            If false, the resource's geocoding information will be
+            invalidated when its address changes. Defaults to true.
+    """
+    # See if we have just a normal address field - if not,
+    # manually construct one by joining all available
+    # fields with commas
+    new_address = ''
+    if hasattr(rad_record, 'address') and \
+            rad_record.address is not None and \
+            rad_record.address != '' and \
+            not rad_record.address.isspace():
+
+        new_address = rad_record.address.strip()
+    else:
+        new_address = ", ".join(
+            a.strip()
+            for a in
+            [
+                rad_record.street,
+                rad_record.city,
+                rad_record.state,
+                rad_record.zipcode,
+                rad_record.country
+            ]
+            if a is not None and a != '' and not a.isspace())
+
+    # Address issue 131 - if we're updating an existing
+    # record, and are changing the address (using a lowercase comparison),
+    # invalidate the existing geocoding information.
+    if not new_record and \
+            record.address is not None and \
+            record.address.lower() != new_address.lower():
+        record.latitude = None
+        record.longitude = None
+        record.location = None
+
+    # Now set the new address
+    if new_address != '' and not new_address.isspace():
+        record.address = new_address
+    else:
+        record.address = None
+
+    # Try to parse out the date_verified field if it's provided
+    if rad_record.date_verified is not None and \
+            len(rad_record.date_verified) > 0 and \
+            not rad_record.date_verified.isspace():
+        # Try to parse it out using 'YYYY-MM-DD'
+        try:
+            record.date_verified = datetime.strptime(
+                rad_record.date_verified,
+                '%Y-%m-%d').date()
+        except ValueError:
+            # Parsing error, clear it out
+            record.date_verified = None
+    else:
+        # Not provided - clear it out
+        record.date_verified = None
+
+    # Copy over all the other fields verbatim
+    record.organization = rad_record.organization
+    record.description = rad_record.description
+
+    record.email = rad_record.email
+    record.phone = rad_record.phone
+    record.fax = rad_record.fax
+    record.url = rad_record.url
+    record.hours = rad_record.hours
+    record.hospital_affiliation = rad_record.hospital_affiliation
+
+    record.source = rad_record.source
+    record.npi = rad_record.npi
+    record.notes = rad_record.notes
+
+    record.is_icath = rad_record.is_icath
+    record.is_wpath = rad_record.is_wpath
+    record.is_accessible = rad_record.wheelchair_accessible
+    record.has_sliding_scale = rad_record.sliding_scale
+
+    record.visible = rad_record.visible
+
+
+def get_category_names(rad_record):
+    """
+    Gets the category names for a RadRecord, using its list of
+    category names or, failing that, its single category name.
+
+    Args:
+        rad_record: The RadRecord.
+
+    Returns:
+        The list of category names.
+    """
+    if hasattr(rad_record, 'category_names') and \
+            rad_record.category_names is not None and \
+            len(rad_record.category_names) > 0:
+        return rad_record.category_names
+
+    if hasattr(rad_record, 'category_name') and \
+            rad_record.category_name is not None and \
+            not rad_record.category_name.isspace():
+        return [rad_record.category_name]
+
+    return []
+
+
+def get_population_tags(rad_record):
+    """
+    Gets the population names for a RadRecord.
+
+    Args:
+        rad_record: The RadRecord.
+
+    Returns:
+        The list of population names.
+    """
+    if hasattr(rad_record, 'population_tags') and \
+            rad_record.population_tags is not None:
+        return rad_record.population_tags
+
+    return []
+
+
 def get_or_create_resource(
         session,
         rad_record,
@@ -167,116 +302,25 @@ def get_or_create_resource(
 
     if new_record or not lazy:
 
-        # See if we have just a normal address field - if not,
-        # manually construct one by joining all available
-        # fields with commas
-        new_address = ''
-        if hasattr(rad_record, 'address') and \
-                rad_record.address is not None and \
-                rad_record.address != '' and \
-                not rad_record.address.isspace():
-
-            new_address = rad_record.address.strip()
-        else:
-            new_address = ", ".join(
-                a.strip()
-                for a in
-                [
-                    rad_record.street,
-                    rad_record.city,
-                    rad_record.state,
-                    rad_record.zipcode,
-                    rad_record.country
-                ]
-                if a is not None and a != '' and not a.isspace())
-
-        # Address issue 131 - if we're updating an existing
-        # record, and are changing the address (using a lowercase comparison),
-        # invalidate the existing geocoding information.
-        if not new_record and \
-                record.address is not None and \
-                record.address.lower() != new_address.lower():
-            record.latitude = None
-            record.longitude = None
-            record.location = None
-
-        # Now set the new address
-        if new_address != '' and not new_address.isspace():
-            record.address = new_address
-        else:
-            record.address = None
-
-        # Try to parse out the date_verified field if it's provided
-        if rad_record.date_verified is not None and \
-                len(rad_record.date_verified) > 0 and \
-                not rad_record.date_verified.isspace():
-            # Try to parse it out using 'YYYY-MM-DD'
-            try:
-                record.date_verified = datetime.strptime(
-                    rad_record.date_verified,
-                    '%Y-%m-%d').date()
-            except ValueError:
-                # Parsing error, clear it out
-                record.date_verified = None
-        else:
-            # Not provided - clear it out
-            record.date_verified = None
-
-        # Copy over all the other fields verbatim
-        record.organization = rad_record.organization
-        record.description = rad_record.description
-
-        record.email = rad_record.email
-        record.phone = rad_record.phone
-        record.fax = rad_record.fax
-        record.url = rad_record.url
-        record.hours = rad_record.hours
-        record.hospital_affiliation = rad_record.hospital_affiliation
-
-        record.source = rad_record.source
-        record.npi = rad_record.npi
-        record.notes = rad_record.notes
-
-        record.is_icath = rad_record.is_icath
-        record.is_wpath = rad_record.is_wpath
-        record.is_accessible = rad_record.wheelchair_accessible
-        record.has_sliding_scale = rad_record.sliding_scale
-
-        record.visible = rad_record.visible
+        copy_resource_fields(record, rad_record, new_record)
 
-        # Do we have a list of category names?
-        # Failing that, do we have a single category name?
-        if hasattr(rad_record, 'category_names') and \
-                rad_record.category_names is not None and \
-                len(rad_record.category_names) > 0:
+        # Add the categories and populations, if provided
+        category_names = get_category_names(rad_record)
 
-            # Use the list of category names
+        if len(category_names) > 0:
             try_add_categories(
                 session,
                 record,
-                rad_record.category_names,
+                category_names,
                 create_categories)
 
-        elif hasattr(rad_record, 'category_name') and \
-                rad_record.category_name is not None and \
-                not rad_record.category_name.isspace():
-
-            # Use the single category name
-            try_add_categories(
-                session,
-                record,
-                [rad_record.category_name],
-                create_categories)
-
-        # Do we have a list of population tags?
-        if hasattr(rad_record, 'population_tags') and \
-                rad_record.population_tags is not None and \
-                len(rad_record.population_tags) > 0:
+        population_tags = get_population_tags(rad_record)
 
+        if len(population_tags) > 0:
             try_add_populations(
                 session,
                 record,
-                rad_record.population_tags)
+                population_tags)
 
         session.add(record)
 
@@ -287,3 +331,241 @@ def get_or_create_resource(
         session.flush()
 
     return new_record, record
+
+
+def get_name_map(session, model):
+    """
+    Loads all records of a model with a "name" field into a dictionary,
+    keyed on the lowercased, stripped name.
+
+    Args:
+        session: The current database session.
+        model: The model to load.
+
+    Returns:
+        A dictionary of normalized names to records.
+    """
+    return dict(
+        (record.name.strip().lower(), record)
+        for record in session.query(model).all())
+
+
+def bulk_import_resources(
+        session,
+        rad_records,
+        create_categories=True,
+        chunk_size=500,
+        chunk_callback=None):
+    """
+    Imports a sequence of RadRecords as new resources.
+
+    Categories and populations are looked up from maps that are loaded
+    once, instead of querying for them on every row. Resources are
+    flushed and committed in chunks, so an error will only roll back
+    the chunk that caused it.
+
+    Args:
+        session: The current database session.
+        rad_records: The RadRecords to import. This can be any iterable,
+            and only one chunk of records is read at a time.
+        create_categories: If true, will create categories if they
+            don't already exist.
+            If false, will skip over listed categories that
+            don't already exist.
+            Defaults to true.
+        chunk_size: The number of resources to commit at a time.
+            Defaults to 500.
+        chunk_callback: A function that will be called with the
+            result of each chunk once it is committed. Optional.
+
+    Returns:
+        A list of dictionaries, one for each chunk, with the
+        following fields:
+            start: The zero-based position of the chunk's first record.
+            end: The position after the chunk's last record.
+            imported: The number of resources that were imported.
+            row_errors: A list of tuples of the positions of records
+                that could not be converted and their error messages.
+            error: The error message if the chunk could not be
+                committed, or None if it was successful.
+    """
+    category_map = get_name_map(session, Category)
+    population_map = get_name_map(session, Population)
+
+    results = []
+    rad_records = iter(rad_records)
+    start = 0
+
+    while True:
+        chunk_records = list(islice(rad_records, chunk_size))
+
+        if len(chunk_records) == 0:
+            break
+
+        chunk_start = time.time()
+
+        chunk_result = dict(
+            start=start,
+            end=start + len(chunk_records),
+            imported=0,
+            row_errors=[],
+            error=None)
+
+        new_categories = []
+        new_resources = []
+
+        for position, rad_record in enumerate(chunk_records, start):
+            try:
+                record = Resource(name=rad_record.name.strip())
+                record.date_created = datetime.utcnow()
+                record.last_updated = record.date_created
+
+                copy_resource_fields(record, rad_record)
+
+                for category_name in get_category_names(rad_record):
+                    category_key = category_name.strip().lower()
+                    category_record = category_map.get(category_key)
+
+                    # Create the category if we're allowed to, and keep
+                    # track of it so that later rows will reuse it
+                    if category_record is None and create_categories:
+                        category_record = Category(
+                            name=category_name.strip())
+                        category_map[category_key] = category_record
+                        new_categories.append(category_key)
+
+                    if category_record is not None and \
+                            category_record not in record.categories:
+                        record.categories.append(category_record)
+
+                for population_name in get_population_tags(rad_record):
+                    population_record = population_map.get(
+                        population_name.strip().lower())
+
+                    if population_record is not None and \
+                            population_record not in record.populations:
+                        record.populations.append(population_record)
+
+            except Exception as ex:
+                chunk_result['row_errors'].append((position, str(ex)))
+            else:
+                new_resources.append(record)
+
+        # Add and commit the chunk all at once. Each resource is inserted
+        # separately so that the database assigns its ID, but the
+        # association rows for categories/populations are inserted in a
+        # single executemany for each table when the session is flushed.
+        try:
+            session.add_all(new_resources)
+            session.commit()
+        except Exception as ex:
+            session.rollback()
+            chunk_result['error'] = str(ex)
+
+            # Forget about any categories created in this chunk
+            # so that later chunks will try to create them again
+            for category_key in new_categories:
+                category_map.pop(category_key, None)
+        else:
+            chunk_result['imported'] = len(new_resources)
+
+        IMPORT_CHUNK_DURATION.observe(time.time() - chunk_start)
+        IMPORT_RESOURCES.inc(chunk_result['imported'], result='imported')
+        IMPORT_RESOURCES.inc(
+            len(chunk_records) - chunk_result['imported'],
+            result='failed')
+
+        results.append(chunk_result)
+        start = chunk_result['end']
+
+        if chunk_callback is not None:
+            chunk_callback(chunk_result)
+
+    return results
+
+
+def find_duplicate_resources(session, rad_records, chunk_size=500):
+    """
+    Finds existing resources that have the same name or NPI
+    as any of the provided RadRecords.
+
+    Args:
+        session: The current database session.
+        rad_records: The RadRecords to check.
+        chunk_size: The number of names or NPIs to look up at a time.
+            Defaults to 500.
+
+    Returns:
+        Two values. The first value is a MultiDict of duplicate
+        resources keyed on their normalized names. The second value
+        is a MultiDict of duplicate resources keyed on their
+        normalized NPIs. Names and NPIs are normalized
+        with get_duplicate_key.
+    """
+    names = set()
+    npis = set()
+
+    for rad_record in rad_records:
+        names.add(get_duplicate_key(rad_record.name))
+        npis.add(get_duplicate_key(rad_record.npi))
+
+    names.discard(None)
+    npis.discard(None)
+
+    dup_name_dict = MultiDict()
+    dup_npi_dict = MultiDict()
+
+    for keys, key_field, dup_dict in (
+            (list(names), 'normalized_name', dup_name_dict),
+            (list(npis), 'normalized_npi', dup_npi_dict)):
+
+        key_column = getattr(Resource, key_field)
+
+        for start in xrange(0, len(keys), chunk_size):
+            dup_resources = session.query(Resource). \
+                filter(key_column.in_(keys[start:start + chunk_size])). \
+                all()
+
+            for res in dup_resources:
+                dup_dict.add(getattr(res, key_field), res)
+
+    return dup_name_dict, dup_npi_dict
+
+
+def find_record_duplicates(session, rad_records):
+    """
+    Finds the existing resources that have the same name
+    or NPI as each of the provided records.
+
+    Args:
+        session: The current database session.
+        rad_records: The list of RadRecords to check.
+
+    Returns:
+        A list containing a set of duplicate resources
+        for each record.
+    """
+    # Look up existing resources that share a name or NPI
+    # with any of the records, keyed on the normalized value
+    dup_name_dict, dup_npi_dict = find_duplicate_resources(
+        session,
+        rad_records)
+
+    dupes = []
+
+    for record in rad_records:
+        # Find duplicates - build a set, starting with
+        # any duplicate names
+        dup_set = set(
+            dup_name_dict.getlist(get_duplicate_key(record.name)))
+
+        # If the record has an NPI field as well, include
+        # any duplicates on the basis of NPI in the set
+        npi_key = get_duplicate_key(record.npi)
+
+        if npi_key is not None:
+            dup_set.update(dup_npi_dict.getlist(npi_key))
+
+        dupes.append(dup_set)
+
+    return dupes
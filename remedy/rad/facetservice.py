@@ -0,0 +1,143 @@
+"""
+facetservice.py
+
+This module contains functionality for counting the categories,
+populations and flags (facets) of resources matching a search.
+
+Counts are calculated from the bitsets of the in-memory search index
+where possible. Otherwise, they are counted with a single grouped query
+for each type of facet, joined to the filtered search as a subquery,
+and the counts are cached until resources are changed.
+"""
+from sqlalchemy import func, case
+
+from models import Resource, resourcecategory, resourcepopulation, db
+from remedy.caching import get_versioned
+from searchindex import FLAG_FIELDS
+import resourceservice
+import searchindex
+
+
+def empty_facet_counts():
+    """
+    Gets a dictionary of facet counts with nothing counted.
+
+    Returns:
+        A dictionary of facet counts, in the same format as count_facets.
+    """
+    return {
+        'total': 0,
+        'categories': {},
+        'populations': {},
+        'flags': dict((param, 0) for param in FLAG_FIELDS)
+    }
+
+
+def count_facets(session, id_query, resource_ids=None):
+    """
+    Counts the facets of the provided resources in the database,
+    using a single grouped query for each type of facet.
+
+    Args:
+        session: The current database session.
+        id_query: The query of the IDs of the resources to count.
+        resource_ids: The set of IDs to restrict the count to, for
+            searches that are finished outside of the database. If
+            specified, the memberships of the resources in the query
+            are loaded and counted here instead. Optional.
+
+    Returns:
+        A dictionary containing:
+            total: The number of resources.
+            categories: A dictionary of category IDs to the number of
+                resources in that category. Categories without any
+                resources are omitted.
+            populations: A dictionary of population IDs to the number
+                of resources in that population, in the same format.
+            flags: A dictionary of boolean search parameters (such as
+                "icath") to the number of resources with that flag set.
+    """
+    counts = empty_facet_counts()
+    ids = id_query.subquery()
+
+    for table, target in (
+            (resourcecategory, counts['categories']),
+            (resourcepopulation, counts['populations'])):
+        other_col = [c for c in table.c if c.name != 'resource_id'][0]
+        query = session.query(other_col). \
+            join(ids, ids.c.id == table.c.resource_id)
+
+        if resource_ids is None:
+            for other_id, count in query. \
+                    add_columns(func.count()). \
+                    group_by(other_col):
+                target[other_id] = count
+        else:
+            for other_id, resource_id in query. \
+                    add_columns(table.c.resource_id):
+                if resource_id in resource_ids:
+                    target[other_id] = target.get(other_id, 0) + 1
+
+    flag_fields = [getattr(Resource, f) for f in FLAG_FIELDS.itervalues()]
+    query = session.query(Resource). \
+        join(ids, ids.c.id == Resource.id)
+
+    if resource_ids is None:
+        flag_counts = query.with_entities(
+            func.count(),
+            *[func.sum(case([(field == True, 1)], else_=0))
+              for field in flag_fields]).one()
+
+        counts['total'] = flag_counts[0]
+
+        for param, count in zip(FLAG_FIELDS.iterkeys(), flag_counts[1:]):
+            counts['flags'][param] = int(count or 0)
+    else:
+        counts['total'] = len(resource_ids)
+
+        for row in query.with_entities(Resource.id, *flag_fields):
+            if row[0] not in resource_ids:
+                continue
+
+            for param, value in zip(FLAG_FIELDS.iterkeys(), row[1:]):
+                if value:
+                    counts['flags'][param] += 1
+
+    return counts
+
+
+def get_facet_counts(search_params):
+    """
+    Counts the facets of the resources matching a search.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        A dictionary of facet counts, in the same format as count_facets.
+    """
+    if search_params is None or len(search_params) == 0:
+        return empty_facet_counts()
+
+    counts = searchindex.facet_counts(db.session, search_params)
+
+    if counts is not None:
+        return counts
+
+    def count():
+        id_query, inexact = resourceservice.get_candidate_query(
+            search_params)
+        resource_ids = None
+
+        # Only count the candidates that are in the results
+        if inexact:
+            resource_ids = set(
+                resourceservice.search(search_params, ids_only=True))
+
+        return count_facets(db.session, id_query, resource_ids)
+
+    return get_versioned(
+        'facet-counts',
+        resourceservice.get_params_key(search_params),
+        count,
+        tags=('resource', 'category', 'population'))
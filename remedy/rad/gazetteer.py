@@ -0,0 +1,552 @@
+"""
+gazetteer.py
+
+Contains an offline gazetteer of US ZIP code, city and state centroids,
+which is used to geocode addresses without the external geocoding service.
+
+The gazetteer is stored in a compact binary file that is memory-mapped
+when it's loaded, so lookups only read the records that they need.
+The file is built from the GeoNames US postal code file
+(http://download.geonames.org/export/zip/US.zip) with the
+"gazetteer" manager command.
+
+The file contains (in little-endian order):
+    A header with the file version, the number of ZIP codes,
+        the number of places and the size of the string pool.
+    The ZIP code records, sorted by ZIP code.
+    The place records, for cities and states, sorted by key.
+    The string pool, containing UTF-8 place keys and names.
+"""
+import mmap
+import os
+import os.path as op
+import re
+import struct
+import tempfile
+from collections import namedtuple, defaultdict, Counter
+
+from remedy.remedy_utils import replace_file
+
+# Identifies the file format.
+MAGIC = 'RADGAZ01'
+
+# The magic string, the number of ZIP codes, the number of places
+# and the size of the string pool.
+HEADER = struct.Struct('<8sIII')
+
+# The ZIP code, latitude, longitude and the index of the ZIP's city.
+ZIP_RECORD = struct.Struct('<5sffI')
+
+# The offset and length of the place key, the offset and length
+# of the tab-separated city/county/state names, the latitude
+# and the longitude.
+PLACE_RECORD = struct.Struct('<IHIHff')
+
+# Indicates that a ZIP code doesn't have a city.
+NO_PLACE = 0xFFFFFFFF
+
+# Matches a ZIP code (with an optional ZIP+4 suffix)
+# at the end of a string.
+ZIP_PATTERN = re.compile(r'(?:^|\s)(\d{5})(?:-\d{4})?$')
+
+# Abbreviations that are expanded at the start of city names
+# so that "St. Louis" matches "Saint Louis".
+CITY_ABBREVIATIONS = {
+    u'st': u'saint',
+    u'ste': u'sainte',
+    u'ft': u'fort',
+    u'mt': u'mount'
+}
+
+# Country names that are ignored at the end of addresses.
+COUNTRY_NAMES = set([
+    u'us',
+    u'usa',
+    u'united states',
+    u'united states of america'
+])
+
+# The longest state name, in words ("District of Columbia").
+MAX_STATE_WORDS = 3
+
+GazetteerMatch = namedtuple(
+    'GazetteerMatch',
+    'latitude longitude city county state precision')
+
+ParsedLocality = namedtuple(
+    'ParsedLocality',
+    'zip_code city state has_street')
+
+
+def normalize_words(value):
+    """
+    Normalizes a string into lowercase words without punctuation.
+
+    Args:
+        value: The string to normalize.
+
+    Returns:
+        A list of words.
+    """
+    return re.sub(
+        r'[^\w\s]+',
+        u'',
+        value.lower().replace(u'-', u' '),
+        flags=re.UNICODE).split()
+
+
+def get_place_key(city, state):
+    """
+    Gets the key used to look up a city or state.
+
+    Args:
+        city: The name of the city, or an empty string for states.
+        state: The state abbreviation or name.
+
+    Returns:
+        The key, as a UTF-8 encoded string.
+    """
+    city_words = normalize_words(city)
+
+    if len(city_words) > 0 and city_words[0] in CITY_ABBREVIATIONS:
+        city_words[0] = CITY_ABBREVIATIONS[city_words[0]]
+
+    key = u' '.join(city_words) + u'|' + u' '.join(normalize_words(state))
+
+    return key.encode('utf-8')
+
+
+class Gazetteer(object):
+    """
+    A memory-mapped gazetteer of US ZIP code, city and state centroids.
+
+    Attributes:
+        path: The path to the gazetteer file.
+        zip_count: The number of ZIP codes.
+        place_count: The number of cities and states.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as gazetteer_file:
+            self._map = mmap.mmap(
+                gazetteer_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ)
+
+        magic, self.zip_count, self.place_count, strings_size = \
+            HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('"' + path + '" is not a gazetteer file.')
+
+        self._zips_offset = HEADER.size
+        self._places_offset = self._zips_offset + \
+            self.zip_count * ZIP_RECORD.size
+        self._strings_offset = self._places_offset + \
+            self.place_count * PLACE_RECORD.size
+
+    def close(self):
+        """
+        Unmaps the gazetteer file.
+        """
+        self._map.close()
+
+    def _get_string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._map[start:start + length]
+
+    def _get_zip(self, index):
+        return ZIP_RECORD.unpack_from(
+            self._map,
+            self._zips_offset + index * ZIP_RECORD.size)
+
+    def _get_place(self, index):
+        return PLACE_RECORD.unpack_from(
+            self._map,
+            self._places_offset + index * PLACE_RECORD.size)
+
+    def _get_place_key(self, index):
+        key_offset, key_length = self._get_place(index)[:2]
+        return self._get_string(key_offset, key_length)
+
+    def _bisect(self, count, get_key, key):
+        """
+        Finds the index of a key among sorted records.
+
+        Args:
+            count: The number of records.
+            get_key: A function that gets the key of a record by index.
+            key: The key to find.
+
+        Returns:
+            The index of the record, or None if it wasn't found.
+        """
+        low, high = 0, count
+
+        while low < high:
+            mid = (low + high) // 2
+
+            if get_key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < count and get_key(low) == key:
+            return low
+
+        return None
+
+    def _get_place_match(self, index, latitude, longitude, precision):
+        names_offset, names_length = self._get_place(index)[2:4]
+        city, county, state = self._get_string(names_offset, names_length). \
+            decode('utf-8').split(u'\t')
+
+        return GazetteerMatch(
+            latitude,
+            longitude,
+            city,
+            county,
+            state,
+            precision)
+
+    def find_zip(self, zip_code):
+        """
+        Finds the centroid of a ZIP code.
+
+        Args:
+            zip_code: The five-digit ZIP code.
+
+        Returns:
+            A GazetteerMatch, or None if the ZIP code wasn't found.
+        """
+        zip_code = str(zip_code)
+        index = self._bisect(
+            self.zip_count,
+            lambda i: self._get_zip(i)[0],
+            zip_code)
+
+        if index is None:
+            return None
+
+        zip_code, latitude, longitude, place_index = self._get_zip(index)
+
+        if place_index == NO_PLACE:
+            return GazetteerMatch(latitude, longitude, u'', u'', u'', 'zip')
+
+        return self._get_place_match(place_index, latitude, longitude, 'zip')
+
+    def find_place(self, city, state):
+        """
+        Finds the centroid of a city or state.
+
+        Args:
+            city: The name of the city, or an empty string to find a state.
+            state: The state abbreviation or name.
+
+        Returns:
+            A GazetteerMatch, or None if the place wasn't found.
+        """
+        # Cities are keyed on the state abbreviation, so
+        # look that up in case we were given the state's name
+        if city:
+            state_match = self.find_place(u'', state)
+
+            if state_match is None:
+                return None
+
+            state = state_match.state
+
+        index = self._bisect(
+            self.place_count,
+            self._get_place_key,
+            get_place_key(city, state))
+
+        if index is None:
+            return None
+
+        latitude, longitude = self._get_place(index)[4:6]
+
+        return self._get_place_match(
+            index,
+            latitude,
+            longitude,
+            'city' if city else 'state')
+
+    def is_state(self, state):
+        """
+        Determines if a string is a known state abbreviation or name.
+
+        Args:
+            state: The string to check.
+
+        Returns:
+            A boolean indicating if the string is a state.
+        """
+        return self._bisect(
+            self.place_count,
+            self._get_place_key,
+            get_place_key(u'', state)) is not None
+
+    def parse_locality(self, address):
+        """
+        Splits the city, state and ZIP code off the end of an address.
+
+        Args:
+            address: The address to parse.
+
+        Returns:
+            A ParsedLocality with the ZIP code, city and state (each of
+            which may be None) and whether the address has anything
+            before the city, such as a street.
+        """
+        parts = [
+            u' '.join(part.split())
+            for part in address.split(u',')
+            if len(part.strip()) > 0
+        ]
+
+        if len(parts) > 0 and parts[-1].lower().rstrip(u'.') in COUNTRY_NAMES:
+            parts.pop()
+
+        zip_code = None
+        state = None
+        city = None
+
+        # Look for a ZIP code at the end
+        if len(parts) > 0:
+            zip_match = ZIP_PATTERN.search(parts[-1])
+
+            if zip_match is not None:
+                zip_code = zip_match.group(1)
+                parts[-1] = parts[-1][:zip_match.start()].strip()
+
+                if len(parts[-1]) == 0:
+                    parts.pop()
+
+        # Look for a state, which may be more than one word
+        if len(parts) > 0:
+            words = parts[-1].split()
+
+            for num_words in xrange(
+                    min(MAX_STATE_WORDS, len(words)), 0, -1):
+                candidate = u' '.join(words[-num_words:])
+
+                if self.is_state(candidate):
+                    state = candidate
+                    parts[-1] = u' '.join(words[:-num_words])
+
+                    if len(parts[-1]) == 0:
+                        parts.pop()
+
+                    break
+
+        # The city comes right before the state
+        if state is not None and len(parts) > 0:
+            city = parts.pop()
+
+        return ParsedLocality(zip_code, city, state, len(parts) > 0)
+
+    def resolve(self, address, locality_only=False):
+        """
+        Finds the approximate location of an address, preferring the
+        centroid of its ZIP code, then its city, and then its state.
+
+        Args:
+            address: The address to resolve.
+            locality_only: If true, only addresses that consist
+                entirely of a ZIP code and/or a city and state
+                will be resolved.
+
+        Returns:
+            A GazetteerMatch, or None if the address couldn't be resolved.
+        """
+        if address is None or len(address.strip()) == 0:
+            return None
+
+        parsed = self.parse_locality(address)
+
+        if locality_only and parsed.has_street:
+            return None
+
+        if parsed.zip_code is not None:
+            match = self.find_zip(parsed.zip_code)
+
+            if match is not None:
+                return match
+
+        if parsed.state is None:
+            return None
+
+        if parsed.city is not None:
+            match = self.find_place(parsed.city, parsed.state)
+
+            if match is not None or locality_only:
+                return match
+
+        return self.find_place(u'', parsed.state)
+
+
+def get_gazetteer(app):
+    """
+    Gets the gazetteer for the provided application, based on its
+    GAZETTEER_PATH configuration value. The gazetteer is loaded
+    the first time it's needed.
+
+    Args:
+        app: The application.
+
+    Returns:
+        The gazetteer, or None if a gazetteer file hasn't been built.
+    """
+    if 'remedy_gazetteer' not in app.extensions:
+        path = app.config.get('GAZETTEER_PATH')
+
+        if path and op.exists(path):
+            app.extensions['remedy_gazetteer'] = Gazetteer(path)
+        else:
+            app.extensions['remedy_gazetteer'] = None
+
+    return app.extensions['remedy_gazetteer']
+
+
+def build_gazetteer(source_path, dest_path):
+    """
+    Builds a gazetteer file from the GeoNames US postal code file.
+    City and state centroids are calculated from the centroids
+    of their ZIP codes.
+
+    Args:
+        source_path: The path to the tab-separated GeoNames file.
+        dest_path: The path to write the gazetteer to.
+
+    Returns:
+        A tuple containing the number of ZIP codes and the number
+        of places in the gazetteer.
+    """
+    zips = {}
+    city_zips = defaultdict(list)
+    state_names = {}
+
+    with open(source_path, 'rb') as source_file:
+        for line in source_file:
+            fields = line.decode('utf-8').rstrip(u'\r\n').split(u'\t')
+
+            # Skip rows without coordinates, such as military ZIPs
+            if len(fields) < 11 or not fields[9] or not fields[10]:
+                continue
+
+            zip_code = fields[1].strip()
+
+            if len(zip_code) != 5 or not zip_code.isdigit():
+                continue
+
+            city = fields[2].strip()
+            state = fields[4].strip()
+            county = fields[5].strip()
+            latitude = float(fields[9])
+            longitude = float(fields[10])
+
+            zips[zip_code] = (latitude, longitude, city, state)
+
+            if city and state:
+                city_zips[(city, state)].append(
+                    (latitude, longitude, county))
+
+            if state:
+                state_names[state] = fields[3].strip()
+
+    # Build the places, each with a key, the names
+    # to display and the centroid
+    places = {}
+
+    for (city, state), city_points in city_zips.iteritems():
+        county = Counter(p[2] for p in city_points).most_common(1)[0][0]
+
+        places[get_place_key(city, state)] = (
+            u'\t'.join((city, county, state)),
+            sum(p[0] for p in city_points) / len(city_points),
+            sum(p[1] for p in city_points) / len(city_points))
+
+    for state, state_name in state_names.iteritems():
+        state_points = [z for z in zips.itervalues() if z[3] == state]
+        centroid = (
+            sum(p[0] for p in state_points) / len(state_points),
+            sum(p[1] for p in state_points) / len(state_points))
+
+        # States can be found by abbreviation or by name
+        for name in (state, state_name):
+            if name:
+                places[get_place_key(u'', name)] = \
+                    (u'\t'.join((u'', u'', state)),) + centroid
+
+    place_keys = sorted(places)
+    place_indices = dict((key, i) for i, key in enumerate(place_keys))
+
+    # Build the string pool, sharing the display names
+    strings = []
+    strings_size = [0]
+    string_offsets = {}
+
+    def add_string(value):
+        if value not in string_offsets:
+            string_offsets[value] = strings_size[0]
+            strings.append(value)
+            strings_size[0] += len(value)
+
+        return string_offsets[value], len(value)
+
+    place_records = []
+
+    for key in place_keys:
+        names, latitude, longitude = places[key]
+        key_offset, key_length = add_string(key)
+        names_offset, names_length = add_string(names.encode('utf-8'))
+
+        place_records.append(PLACE_RECORD.pack(
+            key_offset,
+            key_length,
+            names_offset,
+            names_length,
+            latitude,
+            longitude))
+
+    zip_records = []
+
+    for zip_code in sorted(zips):
+        latitude, longitude, city, state = zips[zip_code]
+        place_index = place_indices.get(get_place_key(city, state), NO_PLACE)
+
+        zip_records.append(ZIP_RECORD.pack(
+            str(zip_code),
+            latitude,
+            longitude,
+            place_index if city else NO_PLACE))
+
+    # Write to a temporary file first so that running
+    # processes don't see a partial file
+    fd, temp_path = tempfile.mkstemp(
+        dir=op.dirname(op.abspath(dest_path)),
+        suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as dest_file:
+            dest_file.write(HEADER.pack(
+                MAGIC,
+                len(zip_records),
+                len(place_records),
+                strings_size[0]))
+            dest_file.write(''.join(zip_records))
+            dest_file.write(''.join(place_records))
+            dest_file.write(''.join(strings))
+
+        # Temporary files are only readable by their owner
+        os.chmod(temp_path, 0o644)
+        replace_file(temp_path, dest_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return len(zip_records), len(place_records)
@@ -1,17 +1,208 @@
+import hashlib
+import random
+import re
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
 from geopy.geocoders import GoogleV3
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable, \
+    GeocoderQuotaExceeded
+
+from models import GeocodeCache
+from remedy.metrics import GEOCODER_REQUESTS
+
+# How long to keep the results for addresses that were found, in seconds.
+DEFAULT_TTL = 60 * 60 * 24 * 90
+
+# How long to keep the results for addresses that weren't found,
+# in seconds. These are kept for less time in case the geocoding
+# service learns about the address.
+DEFAULT_NEGATIVE_TTL = 60 * 60 * 24 * 7
+
+# The errors from the geocoding service that are worth retrying.
+RETRY_ERRORS = (GeocoderTimedOut, GeocoderUnavailable, GeocoderQuotaExceeded)
+
+
+# The result of geocoding a resource. The error is the exception that
+# occurred while geocoding it, or None if there was no error. The source
+# is "cache", "service" or "gazetteer", or None if it wasn't geocoded.
+GeocodeResult = namedtuple('GeocodeResult', 'resource error source')
+
+
+def get_location_string(city, county, state):
+    """
+    Builds the display location for a resource, such as "Chicago, IL",
+    preferring the city to the county.
+
+    Args:
+        city: The city, if known.
+        county: The county, if known.
+        state: The state, if known.
+
+    Returns:
+        The location string.
+    """
+    new_res_location = city or county or ''
+
+    if state:
+        # Add a comma and space between the city/county
+        # and state
+        if new_res_location:
+            new_res_location = new_res_location + ', '
+
+        new_res_location = new_res_location + state
+
+    return new_res_location
+
+
+class TokenBucket(object):
+    """
+    Limits the rate at which requests are made, allowing short
+    bursts up to the capacity of the bucket. Safe to share
+    between threads.
+
+    Attributes:
+        rate: The number of tokens added to the bucket each second.
+        capacity: The maximum number of tokens in the bucket.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_address_key(address):
+    """
+    Normalizes an address for use as a geocoding cache key, ignoring
+    case, punctuation and extra whitespace.
+
+    Args:
+        address: The address to normalize.
+
+    Returns:
+        The normalized address, or None if the address is empty.
+    """
+    if address is None:
+        return None
+
+    key = u' '.join(
+        re.sub(r'[^\w#]+', u' ', address.lower(), flags=re.UNICODE).split())
+
+    return key[:500] or None
+
+
+def get_address_hash(address_key):
+    """
+    Hashes a normalized address for looking up geocoding cache entries.
+
+    Args:
+        address_key: The normalized address.
+
+    Returns:
+        The hex digest of the address.
+    """
+    return hashlib.sha1(address_key.encode('utf-8')).hexdigest()
 
 
 class Geocoder:
     """
     Contains functionality for performing geocoding operations on locations.
 
+    If a database session is provided, results are cached in the
+    GeocodeCache table, keyed on the normalized address, and are only
+    looked up with the external geocoding service once they expire.
+    Results are also remembered for the lifetime of the geocoder, so
+    the same address is only looked up once.
+
+    When geocoding several resources at once, lookups can be made
+    concurrently, limited to a maximum rate, and retried if the
+    geocoding service times out or is unavailable.
+
+    If a gazetteer is provided, it's used to resolve ZIP code and
+    city/state addresses without the geocoding service, and to find
+    approximate locations when the geocoding service fails.
+
     Attributes:
         api_key: An API key to be used with the external geocoding service.
+        session: The database session used to read and store cached
+            results. Optional.
+        ttl: The number of seconds to keep the results
+            for addresses that were found.
+        negative_ttl: The number of seconds to keep the results
+            for addresses that were not found.
+        max_workers: The maximum number of concurrent lookups.
+        rate_limiter: The TokenBucket used to limit the rate of
+            lookups, or None if lookups are not limited.
+        max_retries: The number of times to retry a failed lookup.
+        retry_backoff: The number of seconds to wait before the first
+            retry. The wait doubles with each subsequent retry.
+        domain: The domain of the geocoding service, which can be
+            changed to use a local service for testing.
+        scheme: The scheme used to access the geocoding service.
+        timeout: The number of seconds to wait for each lookup.
+        gazetteer: The offline Gazetteer used for ZIP code and
+            city/state addresses, and as a fallback. Optional.
     """
 
-    def __init__(self, api_key=None):
+    def __init__(
+            self,
+            api_key=None,
+            session=None,
+            ttl=DEFAULT_TTL,
+            negative_ttl=DEFAULT_NEGATIVE_TTL,
+            max_workers=1,
+            rate_limit=None,
+            max_retries=0,
+            retry_backoff=1.0,
+            domain='maps.googleapis.com',
+            scheme='https',
+            timeout=None,
+            gazetteer=None):
         """Initializes the geocoder with the provided API key."""
         self.api_key = api_key
+        self.session = session
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max(max_workers, 1)
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.domain = domain
+        self.scheme = scheme
+        self.timeout = timeout
+        self.gazetteer = gazetteer
+        self.geolocator = None
+
+        # The cache entries used by this geocoder, keyed on address hash,
+        # along with the hashes that have been looked up in the database
+        self.entries = {}
+        self.loaded_hashes = set()
 
     def get_comp(self, addr_comp, key):
         """
@@ -88,64 +279,386 @@ class Geocoder:
         # Convert city/county/state into a tuple
         return (city_str, county_str, state_str)
 
-    def geocode(self, resource):
+    def get_geolocator(self):
         """
-        Performs geocoding on the provided resource and updates its formatted
-        address, latitude, and longitude.
+        Gets the client for the external geocoding service,
+        creating it if necessary.
+
+        Returns:
+            The geocoding client.
+        """
+        if self.geolocator is None:
+            kwargs = dict(
+                api_key=self.api_key,
+                domain=self.domain,
+                scheme=self.scheme)
+
+            if self.timeout is not None:
+                kwargs['timeout'] = self.timeout
+
+            self.geolocator = GoogleV3(**kwargs)
+
+        return self.geolocator
+
+    def load_entries(self, address_hashes):
+        """
+        Loads any stored cache entries for the provided addresses
+        that haven't already been loaded.
 
         Args:
-            resource: A resource from which the address components will be
-                retrieved and used to update its formatted address,
-                latitude, and longitude.
+            address_hashes: The hashes of the normalized addresses.
+        """
+        address_hashes = set(address_hashes) - self.loaded_hashes
+
+        if self.session is None or len(address_hashes) == 0:
+            return
+
+        for entry in self.session.query(GeocodeCache). \
+                filter(GeocodeCache.address_hash.in_(address_hashes)):
+            self.entries[entry.address_hash] = entry
+
+        self.loaded_hashes.update(address_hashes)
+
+    def is_fresh(self, entry):
+        """
+        Determines if a cache entry can still be used.
+
+        Args:
+            entry: The cache entry.
+
+        Returns:
+            A boolean indicating if the entry has not yet expired.
+        """
+        ttl = self.ttl if entry.found else self.negative_ttl
+
+        return entry.date_cached + timedelta(seconds=ttl) > datetime.utcnow()
+
+    def store_entry(self, address_key, location):
+        """
+        Stores the result of geocoding an address, replacing any
+        expired entry for the address.
+
+        Args:
+            address_key: The normalized address.
+            location: The location returned by the geocoding service,
+                or None if the address was not found.
+
+        Returns:
+            The cache entry.
+        """
+        address_hash = get_address_hash(address_key)
+        self.load_entries([address_hash])
+
+        entry = self.entries.get(address_hash)
+
+        if entry is None:
+            entry = GeocodeCache(address_hash=address_hash)
+            self.entries[address_hash] = entry
+
+            if self.session is not None:
+                self.session.add(entry)
+
+        entry.address = address_key
+        entry.found = location is not None
+        entry.formatted_address = None
+        entry.latitude = None
+        entry.longitude = None
+        entry.city = None
+        entry.county = None
+        entry.state = None
+        entry.date_cached = datetime.utcnow()
+
+        if location is None:
+            return entry
+
+        if location.address and not location.address.isspace():
+            entry.formatted_address = location.address
+
+        if location.latitude is not None and location.longitude is not None:
+            entry.latitude = location.latitude
+            entry.longitude = location.longitude
+
+        # Look at the raw response for address components
+        if location.raw:
+            address_components = location.raw.get('address_components')
+
+            if address_components:
+                # Get the city/county/state strings
+                entry.city, entry.county, entry.state = \
+                    self.get_locality_strings(address_components)
+
+        return entry
+
+    def remote_lookup(self, address):
+        """
+        Looks up an address with the external geocoding service,
+        waiting for the rate limiter and retrying errors as needed.
+        Safe to call from multiple threads.
+
+        Args:
+            address: The address to look up.
+
+        Returns:
+            The location returned by the geocoding service,
+            or None if the address was not found.
 
         Raises:
             geopy.exc.GeopyError: An error occurred attempting to access the
                 geocoder.
         """
+        geolocator = self.get_geolocator()
+        attempt = 0
+
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                location = geolocator.geocode(address, exactly_one=True)
+            except RETRY_ERRORS:
+                if attempt >= self.max_retries:
+                    GEOCODER_REQUESTS.inc(result='error')
+                    raise
+
+                GEOCODER_REQUESTS.inc(result='retried')
+
+                # Back off exponentially, with some jitter so that
+                # concurrent lookups don't retry in lockstep
+                time.sleep(
+                    self.retry_backoff * (2 ** attempt) *
+                    random.uniform(0.5, 1.5))
+                attempt += 1
+            except Exception:
+                GEOCODER_REQUESTS.inc(result='error')
+                raise
+            else:
+                GEOCODER_REQUESTS.inc(
+                    result='not_found' if location is None else 'found')
+                return location
+
+    def remote_lookup_all(self, addresses):
+        """
+        Looks up addresses with the external geocoding service,
+        using up to max_workers concurrent lookups.
+
+        Args:
+            addresses: The addresses to look up.
+
+        Returns:
+            A list with a tuple for each address, in the same order as
+            the provided addresses. Each tuple contains the location
+            (or None if the address was not found) and the exception
+            that occurred while looking it up (or None if there
+            was no error).
+        """
+        def lookup(address):
+            try:
+                return self.remote_lookup(address), None
+            except Exception as ex:
+                return None, ex
+
+        num_workers = min(self.max_workers, len(addresses))
+
+        if num_workers <= 1:
+            return [lookup(address) for address in addresses]
+
+        # Make sure the client is created before it's shared
+        self.get_geolocator()
+
+        pool = ThreadPool(num_workers)
+
+        try:
+            return pool.map(lookup, addresses)
+        finally:
+            pool.close()
+            pool.join()
+
+    def store_location(self, address, location):
+        """
+        Caches the location returned for an address by the geocoding
+        service. Successful results are also cached under the formatted
+        address, since that replaces the original address of
+        geocoded resources.
+
+        Args:
+            address: The address that was looked up.
+            location: The location returned by the geocoding service,
+                or None if the address was not found.
+
+        Returns:
+            The cache entry for the address.
+        """
+        entry = self.store_entry(get_address_key(address), location)
+
+        if location is not None:
+            formatted_key = get_address_key(location.address)
+
+            if formatted_key is not None and formatted_key != entry.address:
+                self.store_entry(formatted_key, location)
+
+        return entry
+
+    def apply_entry(self, resource, entry):
+        """
+        Updates a resource's formatted address, latitude, longitude
+        and location based on a cache entry.
+
+        Args:
+            resource: The resource to update.
+            entry: The cache entry for the resource's address.
+        """
+        # Leave the resource alone if the address wasn't found
+        if not entry.found:
+            return
+
+        if entry.formatted_address:
+            resource.address = entry.formatted_address
+
+        if entry.latitude is not None and entry.longitude is not None:
+            resource.latitude = entry.latitude
+            resource.longitude = entry.longitude
+
+        # After all of that, update the location
+        resource.location = get_location_string(
+            entry.city,
+            entry.county,
+            entry.state)
+
+    def apply_match(self, resource, match):
+        """
+        Updates a resource's latitude, longitude and location based on
+        an approximate location from the gazetteer. The resource's
+        address is left as-is.
+
+        Args:
+            resource: The resource to update.
+            match: The GazetteerMatch for the resource's address.
+        """
+        resource.latitude = match.latitude
+        resource.longitude = match.longitude
+        resource.location = get_location_string(
+            match.city,
+            match.county,
+            match.state)
+
+    def geocode_all(self, resources):
+        """
+        Performs geocoding on the provided resources and updates their
+        formatted addresses, latitudes, and longitudes. Resources that
+        share an address are geocoded together, cached results are
+        used when available, and the remaining addresses are looked
+        up concurrently.
+
+        If the geocoder has a gazetteer, addresses that only contain a
+        ZIP code or a city and state are resolved with the gazetteer
+        instead of the geocoding service. The gazetteer is also used
+        to find an approximate location when the geocoding service
+        fails.
+
+        Args:
+            resources: The resources to geocode.
+
+        Returns:
+            A list with a GeocodeResult for each resource, in the
+            same order as the provided resources.
+        """
+        # Group the resources by their normalized addresses
+        address_keys = [get_address_key(r.address) for r in resources]
+        resource_groups = OrderedDict()
+
+        for resource, address_key in zip(resources, address_keys):
+            # Make sure we have something meaningful
+            if address_key is not None:
+                resource_groups.setdefault(address_key, []).append(resource)
+
+        self.load_entries(get_address_hash(address_key)
+                          for address_key in resource_groups)
+
+        entries = {}
+        matches = {}
+        sources = {}
+        lookup_keys = []
+
+        for address_key, group in resource_groups.iteritems():
+            entry = self.entries.get(get_address_hash(address_key))
 
-        # Make sure we generated something meaningful
-        if resource.address is not None and not resource.address.isspace():
-            # Now query the geocoder with this formatted string
-            geolocator = GoogleV3(api_key=self.api_key)
+            if entry is not None and self.is_fresh(entry):
+                entries[address_key] = entry
+                sources[address_key] = 'cache'
+                continue
+
+            match = None
+
+            if self.gazetteer is not None:
+                match = self.gazetteer.resolve(
+                    group[0].address,
+                    locality_only=True)
+
+            if match is not None:
+                matches[address_key] = match
+                sources[address_key] = 'gazetteer'
+            else:
+                lookup_keys.append(address_key)
+
+        # Look up the rest concurrently, but update the cache from
+        # this thread since the database session isn't thread-safe
+        lookup_results = self.remote_lookup_all([
+            resource_groups[address_key][0].address
+            for address_key in lookup_keys
+        ])
 
-            new_location = geolocator.geocode(
-                resource.address,
-                exactly_one=True)
+        errors = {}
 
-            if new_location is not None:
-                new_res_location = ''
+        for address_key, (location, ex) in zip(lookup_keys, lookup_results):
+            address = resource_groups[address_key][0].address
 
-                if new_location.address and \
-                        not new_location.address.isspace():
-                    resource.address = new_location.address
+            if ex is None:
+                entries[address_key] = self.store_location(address, location)
+                sources[address_key] = 'service'
+                continue
+
+            # Fall back to an approximate location if we can
+            match = None
+
+            if self.gazetteer is not None:
+                match = self.gazetteer.resolve(address)
 
-                if new_location.latitude is not None and \
-                        new_location.longitude is not None:
-                    resource.latitude = new_location.latitude
-                    resource.longitude = new_location.longitude
+            if match is not None:
+                matches[address_key] = match
+                sources[address_key] = 'gazetteer'
+            else:
+                errors[address_key] = ex
 
-                # Look at the raw response for address components
-                if new_location.raw:
-                    address_components = new_location.raw.get(
-                        'address_components')
+        for address_key, entry in entries.iteritems():
+            for resource in resource_groups[address_key]:
+                self.apply_entry(resource, entry)
 
-                    if address_components:
-                        # Get the city/county/state strings
-                        city_str, county_str, state_str = \
-                            self.get_locality_strings(address_components)
+        for address_key, match in matches.iteritems():
+            for resource in resource_groups[address_key]:
+                self.apply_match(resource, match)
 
-                        # Now build the location based on those strings,
-                        # preferring city to county
-                        new_res_location = city_str or county_str or ''
+        return [
+            GeocodeResult(
+                resource,
+                errors.get(address_key),
+                sources.get(address_key))
+            for resource, address_key in zip(resources, address_keys)
+        ]
 
-                        if state_str:
-                            # Add a comma and space between the city/county
-                            # and state
-                            if new_res_location:
-                                new_res_location = new_res_location + ', '
+    def geocode(self, resource):
+        """
+        Performs geocoding on the provided resource and updates its formatted
+        address, latitude, and longitude.
 
-                            new_res_location = new_res_location + state_str
+        Args:
+            resource: A resource from which the address components will be
+                retrieved and used to update its formatted address,
+                latitude, and longitude.
 
-                # After all of that, update the location
-                resource.location = new_res_location
-        pass
+        Raises:
+            geopy.exc.GeopyError: An error occurred attempting to access the
+                geocoder.
+        """
+        for result in self.geocode_all([resource]):
+            if result.error is not None:
+                raise result.error
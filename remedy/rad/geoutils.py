@@ -4,9 +4,18 @@ geoutils.py
 Contains utility methods for performing geography-related calculations.
 
 Based from the code at http://stackoverflow.com/a/238558
+
+The batch functions accept sequences of coordinates and use NumPy to
+operate on them in a single vectorized call when it is available,
+falling back to plain Python otherwise.
 """
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def deg2rad(degrees):
     """
@@ -109,3 +118,341 @@ def boundingBox(latitudeInDegrees, longitudeInDegrees, halfSideInKm):
         rad2deg(latMax),
         rad2deg(lonMax)
     )
+
+
+def km2miles(km):
+    """
+    Converts kilometers to miles.
+
+    Args:
+        km: A distance in kilometers.
+
+    Returns:
+        The equivalent distance in miles.
+    """
+    return km / 1.60934
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """
+    Calculates the great-circle distance between two coordinate points
+    using the haversine formula, assuming the local approximation of the
+    Earth's surface as a sphere of radius determined by WGS84 at the
+    first point.
+
+    Args:
+        latitude1: The latitude of the first point, in degrees.
+        longitude1: The longitude of the first point, in degrees.
+        latitude2: The latitude of the second point, in degrees.
+        longitude2: The longitude of the second point, in degrees.
+
+    Returns:
+        The distance between the two points, in kilometers.
+    """
+    lat1 = deg2rad(latitude1)
+    lat2 = deg2rad(latitude2)
+    dlat = lat2 - lat1
+    dlon = deg2rad(longitude2 - longitude1)
+
+    a = math.sin(dlat / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+
+    # Clamp to guard against floating-point drift past 1.0
+    c = 2 * math.asin(math.sqrt(min(a, 1.0)))
+
+    return c * WGS84EarthRadius(lat1) / 1000
+
+
+# The alphabet used for geohash encoding
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# The precision at which geohashes are stored for resources
+GEOHASH_PRECISION = 9
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Encodes a coordinate point as a geohash string. Points that are close
+    together will generally share a common geohash prefix, and every
+    prefix identifies a rectangular cell containing the point.
+
+    Args:
+        latitude: The latitude of the point, in degrees.
+        longitude: The longitude of the point, in degrees.
+        precision: The number of characters in the geohash.
+
+    Returns:
+        The geohash string.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude
+        if even:
+            coord_range, value = lon_range, longitude
+        else:
+            coord_range, value = lat_range, latitude
+
+        mid = (coord_range[0] + coord_range[1]) / 2
+
+        if value >= mid:
+            bits = (bits << 1) | 1
+            coord_range[0] = mid
+        else:
+            bits = bits << 1
+            coord_range[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    """
+    Gets the size of a geohash cell at the provided precision.
+
+    Args:
+        precision: The number of characters in the geohash.
+
+    Returns:
+        A tuple of the height and width of the cell, in degrees.
+    """
+    lon_bits = int(math.ceil(precision * 5 / 2.0))
+    lat_bits = int(math.floor(precision * 5 / 2.0))
+
+    return (180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits))
+
+
+def geohash_cells(minLat, minLong, maxLat, maxLong, max_cells=32):
+    """
+    Gets the set of geohash cells covering the provided bounding box,
+    using the most precise cell size that requires no more than
+    the specified number of cells.
+
+    Args:
+        minLat: The minimum latitude of the box, in degrees.
+        minLong: The minimum longitude of the box, in degrees.
+        maxLat: The maximum latitude of the box, in degrees.
+        maxLong: The maximum longitude of the box, in degrees.
+        max_cells: The maximum number of cells to return.
+
+    Returns:
+        A sorted list of geohash prefixes. Any point within the box
+        will have a geohash starting with one of these prefixes.
+    """
+    # Clamp to valid coordinates
+    minLat = max(minLat, -90.0)
+    maxLat = min(maxLat, 90.0)
+    minLong = max(minLong, -180.0)
+    maxLong = min(maxLong, 180.0)
+
+    cells = None
+
+    for precision in xrange(1, GEOHASH_PRECISION + 1):
+        cell_height, cell_width = geohash_cell_size(precision)
+
+        # Estimate the cell count before enumerating anything
+        rows = int((maxLat - minLat) / cell_height) + 2
+        cols = int((maxLong - minLong) / cell_width) + 2
+
+        if cells is not None and rows * cols > max_cells:
+            break
+
+        precision_cells = set()
+        lat = minLat
+
+        while True:
+            lon = minLong
+
+            while True:
+                precision_cells.add(geohash_encode(lat, lon, precision))
+
+                if lon >= maxLong:
+                    break
+                lon = min(lon + cell_width, maxLong)
+
+            if lat >= maxLat:
+                break
+            lat = min(lat + cell_height, maxLat)
+
+        if cells is not None and len(precision_cells) > max_cells:
+            break
+
+        cells = precision_cells
+
+    return sorted(cells)
+
+
+def _as_arrays(*sequences):
+    """
+    Converts the provided coordinate sequences to float arrays.
+
+    Args:
+        *sequences: The sequences to convert. None values become NaN.
+
+    Returns:
+        A list of the equivalent NumPy arrays.
+    """
+    return [
+        numpy.array(
+            [numpy.nan if v is None else v for v in seq],
+            dtype=numpy.float64)
+        for seq in sequences
+    ]
+
+
+def WGS84EarthRadius_batch(lats):
+    """
+    Returns the earth radius at each of the given latitudes, according
+    to the WGS-84 ellipsoid model.
+
+    Args:
+        lats: The sequence of latitudes, in radians.
+
+    Returns:
+        The Earth radius at each latitude, as an array if NumPy is
+        available and a list otherwise.
+    """
+    if numpy is None:
+        return [WGS84EarthRadius(lat) for lat in lats]
+
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    An = WGS84_a * WGS84_a * numpy.cos(lats)
+    Bn = WGS84_b * WGS84_b * numpy.sin(lats)
+    Ad = WGS84_a * numpy.cos(lats)
+    Bd = WGS84_b * numpy.sin(lats)
+    return numpy.sqrt((An * An + Bn * Bn) / (Ad * Ad + Bd * Bd))
+
+
+def haversine_batch(latitude, longitude, latitudes, longitudes):
+    """
+    Calculates the great-circle distances between one coordinate point
+    and each of a sequence of points. Equivalent to calling haversine
+    for each point.
+
+    Args:
+        latitude: The latitude of the origin point, in degrees.
+        longitude: The longitude of the origin point, in degrees.
+        latitudes: The sequence of latitudes of the other points,
+            in degrees.
+        longitudes: The sequence of longitudes of the other points,
+            in degrees.
+
+    Returns:
+        The distance to each point in kilometers, as an array if NumPy
+        is available and a list otherwise. Points missing a latitude or
+        longitude will have a distance of NaN (or None without NumPy).
+    """
+    if numpy is None:
+        return [
+            haversine(latitude, longitude, lat, lon)
+            if lat is not None and lon is not None else None
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+
+    lats, lons = _as_arrays(latitudes, longitudes)
+
+    lat1 = deg2rad(latitude)
+    lat2 = numpy.radians(lats)
+    dlat = lat2 - lat1
+    dlon = numpy.radians(lons - longitude)
+
+    a = numpy.sin(dlat / 2) ** 2 + \
+        math.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+
+    # Clamp to guard against floating-point drift past 1.0
+    c = 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+    return c * WGS84EarthRadius(lat1) / 1000
+
+
+def within_radius_batch(
+        latitude,
+        longitude,
+        latitudes,
+        longitudes,
+        radiusInKm):
+    """
+    Determines which of a sequence of points are within the specified
+    great-circle distance of a coordinate point.
+
+    Args:
+        latitude: The latitude of the origin point, in degrees.
+        longitude: The longitude of the origin point, in degrees.
+        latitudes: The sequence of latitudes of the other points,
+            in degrees.
+        longitudes: The sequence of longitudes of the other points,
+            in degrees.
+        radiusInKm: The maximum distance, in kilometers.
+
+    Returns:
+        A tuple of the mask of points within the distance and the
+        distance to each point, as arrays if NumPy is available and
+        lists otherwise. Points missing a latitude or longitude are
+        never within the distance.
+    """
+    distances = haversine_batch(latitude, longitude, latitudes, longitudes)
+
+    if numpy is None:
+        return [d is not None and d <= radiusInKm for d in distances], \
+            distances
+
+    # NaN comparisons are always false
+    with numpy.errstate(invalid='ignore'):
+        return distances <= radiusInKm, distances
+
+
+def boundingBox_batch(latitudesInDegrees, longitudesInDegrees, halfSideInKm):
+    """
+    Calculates the bounding boxes surrounding each of a sequence of
+    coordinate points. Equivalent to calling boundingBox for each point.
+
+    Args:
+        latitudesInDegrees: The sequence of latitudes, in degrees.
+        longitudesInDegrees: The sequence of longitudes, in degrees.
+        halfSideInKm: Half the length/width of the desired bounding boxes,
+            in kilometers.
+
+    Returns:
+        A tuple of the minimum latitudes, minimum longitudes, maximum
+        latitudes and maximum longitudes of the boxes, as arrays if NumPy
+        is available and lists otherwise.
+    """
+    if numpy is None:
+        boxes = [
+            boundingBox(lat, lon, halfSideInKm)
+            for lat, lon in zip(latitudesInDegrees, longitudesInDegrees)
+        ]
+
+        return tuple(list(b) for b in zip(*boxes)) if boxes else \
+            ([], [], [], [])
+
+    lats, lons = _as_arrays(latitudesInDegrees, longitudesInDegrees)
+    lats = numpy.radians(lats)
+    lons = numpy.radians(lons)
+
+    # Convert to meters
+    halfSide = 1000 * halfSideInKm
+
+    # Radius of Earth at given latitudes
+    radius = WGS84EarthRadius_batch(lats)
+    # Radius of the parallel at given latitudes
+    pradius = radius * numpy.cos(lats)
+
+    return (
+        numpy.degrees(lats - halfSide / radius),
+        numpy.degrees(lons - halfSide / pradius),
+        numpy.degrees(lats + halfSide / radius),
+        numpy.degrees(lons + halfSide / pradius)
+    )
@@ -0,0 +1,181 @@
+"""
+keyset.py
+
+Contains helpers for keyset (or "seek") pagination, which pages through
+ordered results by filtering on the sort values of a row at the edge
+of the current page instead of using OFFSET. Unlike OFFSET, the cost of
+fetching a page doesn't grow with the page number.
+"""
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+# The format used to store dates in serialized sort values.
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class SortKey(object):
+    """
+    A single expression in a keyset ordering. The final sort key
+    in an ordering must be unique (such as the primary key).
+
+    Attributes:
+        expression: The SQL expression to sort on.
+        descending: A boolean indicating if the expression
+            is sorted in descending order.
+        is_datetime: A boolean indicating if the expression
+            produces dates/times.
+    """
+
+    def __init__(self, expression, descending=False, is_datetime=False):
+        self.expression = expression
+        self.descending = descending
+        self.is_datetime = is_datetime
+
+    def order_clause(self, forward=True):
+        """
+        Gets the ORDER BY clause for this key.
+
+        Args:
+            forward: If false, the clause will be reversed.
+
+        Returns:
+            The ORDER BY clause.
+        """
+        if self.descending == forward:
+            return self.expression.desc()
+
+        return self.expression.asc()
+
+    def dump(self, value):
+        """
+        Converts a sort value into a JSON-serializable value.
+        """
+        if self.is_datetime and value is not None:
+            return value.strftime(DATETIME_FORMAT)
+
+        return value
+
+    def load(self, value):
+        """
+        Converts a serialized sort value back into its original type.
+        """
+        if self.is_datetime and value is not None:
+            return datetime.strptime(value, DATETIME_FORMAT)
+
+        return value
+
+
+def dump_values(sort_keys, values):
+    """
+    Converts a row's sort values into a JSON-serializable list.
+
+    Args:
+        sort_keys: The list of SortKey instances.
+        values: The sort values of the row.
+
+    Returns:
+        The serializable list of values.
+    """
+    return [key.dump(value) for key, value in zip(sort_keys, values)]
+
+
+def load_values(sort_keys, values):
+    """
+    Converts a serialized list of sort values back into the
+    original values. The inverse of dump_values.
+
+    Args:
+        sort_keys: The list of SortKey instances.
+        values: The serialized list of values.
+
+    Returns:
+        The list of sort values, or None if the values
+        don't match the sort keys.
+    """
+    if not isinstance(values, list) or len(values) != len(sort_keys):
+        return None
+
+    try:
+        return [key.load(value) for key, value in zip(sort_keys, values)]
+    except (TypeError, ValueError):
+        return None
+
+
+def seek_filter(sort_keys, values, forward=True):
+    """
+    Builds the filter for rows that sort after (or before) the
+    row with the provided sort values.
+
+    Args:
+        sort_keys: The list of SortKey instances.
+        values: The sort values of the row to seek past.
+        forward: If true, matches rows after the provided row.
+            Otherwise, matches rows before it.
+
+    Returns:
+        The filter expression.
+    """
+    clauses = []
+
+    for i, key in enumerate(sort_keys):
+        # Rows match if all previous keys are equal
+        # and this one is past the value
+        conditions = [
+            prev_key.expression == prev_value
+            for prev_key, prev_value in zip(sort_keys[:i], values[:i])
+        ]
+
+        if key.descending == forward:
+            conditions.append(key.expression < values[i])
+        else:
+            conditions.append(key.expression > values[i])
+
+        clauses.append(and_(*conditions))
+
+    return or_(*clauses)
+
+
+def seek(query, sort_keys, page_size, after=None, before=None, offset=0):
+    """
+    Gets a page of sort values from the provided query.
+
+    Args:
+        query: The query to page through. Any existing
+            ordering will be replaced.
+        sort_keys: The list of SortKey instances.
+        page_size: The number of rows to return.
+        after: The sort values of the row to start after. Optional.
+        before: The sort values of the row to end before. Optional.
+            If specified, "after" is ignored.
+        offset: The number of rows to skip. Only intended for when
+            neither "after" or "before" are specified.
+
+    Returns:
+        A tuple of the list of sort value tuples for the page (always
+        in the forward order) and a boolean indicating if there are more
+        rows in the direction being paged.
+    """
+    forward = before is None
+    query = query. \
+        with_entities(*[key.expression for key in sort_keys]). \
+        order_by(None). \
+        order_by(*[key.order_clause(forward) for key in sort_keys])
+
+    if before is not None:
+        query = query.filter(seek_filter(sort_keys, before, False))
+    elif after is not None:
+        query = query.filter(seek_filter(sort_keys, after, True))
+
+    if offset > 0:
+        query = query.offset(offset)
+
+    # Get an extra row to see if there are any more
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if not forward:
+        rows.reverse()
+
+    return [tuple(row) for row in rows], has_more
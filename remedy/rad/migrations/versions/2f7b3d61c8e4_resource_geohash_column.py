@@ -0,0 +1,52 @@
+"""Adding Resource.geohash column.
+
+Revision ID: 2f7b3d61c8e4
+Revises: 4c2e8f1d7a90
+Create Date: 2026-10-17 11:40:02.530000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f7b3d61c8e4'
+down_revision = '4c2e8f1d7a90'
+
+from alembic import op
+import sqlalchemy as sa
+
+from remedy.rad.geoutils import geohash_encode
+
+
+def upgrade():
+    op.add_column(
+        'resource',
+        sa.Column('geohash', sa.Unicode(length=12), nullable=True))
+    op.create_index(
+        'ix_resource_geohash',
+        'resource',
+        ['geohash'],
+        unique=False)
+
+    # Backfill geohashes for resources that have already been geocoded
+    resource = sa.sql.table(
+        'resource',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('latitude', sa.Float),
+        sa.sql.column('longitude', sa.Float),
+        sa.sql.column('geohash', sa.Unicode))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([resource.c.id, resource.c.latitude, resource.c.longitude]).
+        where(resource.c.latitude != None).
+        where(resource.c.longitude != None)).fetchall()
+
+    for row in rows:
+        connection.execute(
+            resource.update().
+            where(resource.c.id == row.id).
+            values(geohash=unicode(geohash_encode(row.latitude, row.longitude))))
+
+
+def downgrade():
+    op.drop_index('ix_resource_geohash', 'resource')
+    op.drop_column('resource', 'geohash')
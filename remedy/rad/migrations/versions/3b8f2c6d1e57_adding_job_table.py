@@ -0,0 +1,49 @@
+"""Adding job table.
+
+Revision ID: 3b8f2c6d1e57
+Revises: 7d3e5b2a9c41
+Create Date: 2026-10-17 16:03:21.874000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8f2c6d1e57'
+down_revision = '7d3e5b2a9c41'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('job_type', sa.Unicode(length=50), nullable=False),
+    sa.Column('description', sa.Unicode(length=250), nullable=False),
+    sa.Column('params', sa.UnicodeText(), nullable=False),
+    sa.Column('status', sa.Unicode(length=20), nullable=False),
+    sa.Column('progress', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('messages', sa.UnicodeText(), nullable=True),
+    sa.Column('error', sa.UnicodeText(), nullable=True),
+    sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+    sa.Column('worker', sa.Unicode(length=100), nullable=True),
+    sa.Column('created_by_id', sa.Integer(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=False),
+    sa.Column('date_started', sa.DateTime(), nullable=True),
+    sa.Column('date_finished', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(
+        ['created_by_id'],
+        ['user.id'],
+        ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_job_status_id',
+        'job',
+        ['status', 'id'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_status_id', 'job')
+    op.drop_table('job')
@@ -0,0 +1,41 @@
+"""Adding full-text search indexes for resources.
+
+Revision ID: 4c2e8f1d7a90
+Revises: 26aa7051f714
+Create Date: 2026-10-17 09:12:44.120000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c2e8f1d7a90'
+down_revision = '26aa7051f714'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        op.execute(
+            'CREATE FULLTEXT INDEX ix_resource_fulltext ON resource '
+            '(name, organization, description, category_text)')
+    elif dialect == 'sqlite':
+        op.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS resource_fts USING fts5'
+            '(name, organization, description, category_text)')
+        op.execute(
+            'INSERT INTO resource_fts '
+            '(rowid, name, organization, description, category_text) '
+            'SELECT id, name, organization, description, category_text '
+            'FROM resource')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        op.drop_index('ix_resource_fulltext', 'resource')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS resource_fts')
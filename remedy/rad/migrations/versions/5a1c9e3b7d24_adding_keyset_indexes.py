@@ -0,0 +1,44 @@
+"""Adding indexes for keyset pagination.
+
+Revision ID: 5a1c9e3b7d24
+Revises: 2f7b3d61c8e4
+Create Date: 2026-10-17 15:12:47.108000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1c9e3b7d24'
+down_revision = '2f7b3d61c8e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index(
+        'ix_news_date_created_id',
+        'news',
+        ['date_created', 'id'],
+        unique=False)
+    op.create_index(
+        'ix_resource_name_id',
+        'resource',
+        ['name', 'id'],
+        unique=False)
+    op.create_index(
+        'ix_resource_date_created_id',
+        'resource',
+        ['date_created', 'id'],
+        unique=False)
+    op.create_index(
+        'ix_resource_last_updated_id',
+        'resource',
+        ['last_updated', 'id'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_resource_last_updated_id', table_name='resource')
+    op.drop_index('ix_resource_date_created_id', table_name='resource')
+    op.drop_index('ix_resource_name_id', table_name='resource')
+    op.drop_index('ix_news_date_created_id', table_name='news')
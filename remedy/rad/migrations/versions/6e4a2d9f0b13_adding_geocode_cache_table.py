@@ -0,0 +1,36 @@
+"""Adding geocode cache table.
+
+Revision ID: 6e4a2d9f0b13
+Revises: 3b8f2c6d1e57
+Create Date: 2026-10-17 18:42:09.315000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e4a2d9f0b13'
+down_revision = '3b8f2c6d1e57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('geocode_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('address_hash', sa.String(length=40), nullable=False),
+    sa.Column('address', sa.Unicode(length=500), nullable=False),
+    sa.Column('found', sa.Boolean(), nullable=False),
+    sa.Column('formatted_address', sa.Unicode(length=500), nullable=True),
+    sa.Column('latitude', sa.Float(), nullable=True),
+    sa.Column('longitude', sa.Float(), nullable=True),
+    sa.Column('city', sa.Unicode(length=250), nullable=True),
+    sa.Column('county', sa.Unicode(length=250), nullable=True),
+    sa.Column('state', sa.Unicode(length=250), nullable=True),
+    sa.Column('date_cached', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('address_hash')
+    )
+
+
+def downgrade():
+    op.drop_table('geocode_cache')
@@ -0,0 +1,63 @@
+"""Adding Resource.normalized_name and Resource.normalized_npi columns.
+
+Revision ID: 7d3e5b2a9c41
+Revises: 5a1c9e3b7d24
+Create Date: 2026-10-17 15:12:44.120000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3e5b2a9c41'
+down_revision = '5a1c9e3b7d24'
+
+from alembic import op
+import sqlalchemy as sa
+
+from remedy.rad.models import get_duplicate_key
+
+
+def upgrade():
+    op.add_column(
+        'resource',
+        sa.Column('normalized_name', sa.Unicode(length=250), nullable=True))
+    op.add_column(
+        'resource',
+        sa.Column('normalized_npi', sa.Unicode(length=10), nullable=True))
+    op.create_index(
+        'ix_resource_normalized_name',
+        'resource',
+        ['normalized_name'],
+        unique=False)
+    op.create_index(
+        'ix_resource_normalized_npi',
+        'resource',
+        ['normalized_npi'],
+        unique=False)
+
+    # Backfill the keys for existing resources
+    resource = sa.sql.table(
+        'resource',
+        sa.sql.column('id', sa.Integer),
+        sa.sql.column('name', sa.Unicode),
+        sa.sql.column('npi', sa.Unicode),
+        sa.sql.column('normalized_name', sa.Unicode),
+        sa.sql.column('normalized_npi', sa.Unicode))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([resource.c.id, resource.c.name, resource.c.npi])).fetchall()
+
+    for row in rows:
+        connection.execute(
+            resource.update().
+            where(resource.c.id == row.id).
+            values(
+                normalized_name=get_duplicate_key(row.name),
+                normalized_npi=get_duplicate_key(row.npi)))
+
+
+def downgrade():
+    op.drop_index('ix_resource_normalized_npi', 'resource')
+    op.drop_index('ix_resource_normalized_name', 'resource')
+    op.drop_column('resource', 'normalized_npi')
+    op.drop_column('resource', 'normalized_name')
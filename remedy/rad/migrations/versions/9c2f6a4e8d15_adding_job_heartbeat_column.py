@@ -0,0 +1,24 @@
+"""Adding Job.date_heartbeat column.
+
+Revision ID: 9c2f6a4e8d15
+Revises: 6e4a2d9f0b13
+Create Date: 2026-10-17 21:14:36.502000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c2f6a4e8d15'
+down_revision = '6e4a2d9f0b13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'job',
+        sa.Column('date_heartbeat', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'date_heartbeat')
@@ -11,6 +11,8 @@ from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import UserMixin
 import bcrypt
 
+import geoutils
+
 db = SQLAlchemy()
 
 
@@ -81,6 +83,11 @@ class News(db.Model):
 
     visible = db.Column(db.Boolean, nullable=False, default=True)
 
+    # Supports keyset pagination, newest first
+    __table_args__ = (
+        db.Index('ix_news_date_created_id', 'date_created', 'id'),
+    )
+
     def __unicode__(self):
         return self.subject
 
@@ -102,6 +109,12 @@ class Resource(db.Model):
     longitude = db.Column(db.Float)
     location = db.Column(db.Unicode(500))
 
+    """
+    The geohash of the resource's latitude/longitude, used to find
+    resources within a particular area. Maintained automatically.
+    """
+    geohash = db.Column(db.Unicode(12), index=True)
+
     email = db.Column(db.Unicode(250))
     phone = db.Column(db.Unicode(50))
     fax = db.Column(db.Unicode(50))
@@ -111,6 +124,13 @@ class Resource(db.Model):
     source = db.Column(db.UnicodeText)
     npi = db.Column(db.Unicode(10))
     notes = db.Column(db.UnicodeText)
+
+    """
+    The lowercased, stripped name and NPI of the resource, used to
+    detect duplicates. Maintained automatically.
+    """
+    normalized_name = db.Column(db.Unicode(250), index=True)
+    normalized_npi = db.Column(db.Unicode(10), index=True)
     advisory_notes = db.Column(db.UnicodeText, nullable=True)
 
     is_icath = db.Column(db.Boolean, nullable=True)
@@ -165,6 +185,13 @@ class Resource(db.Model):
         primaryjoin='and_(Resource.id==ResourceReviewScore.resource_id, '
                     'ResourceReviewScore.population_id==0)')
 
+    # Supports keyset pagination for each of the search orderings
+    __table_args__ = (
+        db.Index('ix_resource_name_id', 'name', 'id'),
+        db.Index('ix_resource_date_created_id', 'date_created', 'id'),
+        db.Index('ix_resource_last_updated_id', 'last_updated', 'id'),
+    )
+
     def __unicode__(self):
         return self.name
 
@@ -477,15 +504,157 @@ class LoginHistory(db.Model):
     failure_reason = db.Column(db.Unicode(20))
 
 
+class Job(db.Model):
+    """
+    A long-running task, such as geocoding or importing resources,
+    that is queued to be run by a worker process.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+
+    """
+    The name of the handler that runs the job.
+    """
+    job_type = db.Column(db.Unicode(50), nullable=False)
+
+    """
+    A description of the job to display to administrators.
+    """
+    description = db.Column(db.Unicode(250), nullable=False)
+
+    """
+    The JSON-encoded arguments passed to the handler.
+    """
+    params = db.Column(db.UnicodeText, nullable=False)
+
+    """
+    One of "queued", "running", "succeeded", "failed" or "cancelled".
+    """
+    status = db.Column(db.Unicode(20), nullable=False, default=u'queued')
+
+    """
+    The number of items processed so far, out of the total number
+    of items (if known).
+    """
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+
+    """
+    The messages produced by the job, separated by newlines.
+    """
+    messages = db.Column(db.UnicodeText)
+    error = db.Column(db.UnicodeText)
+
+    """
+    Indicates if an administrator has asked for the job to stop.
+    """
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+
+    """
+    The host name and process ID of the worker running the job.
+    """
+    worker = db.Column(db.Unicode(100))
+
+    created_by_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', ondelete='SET NULL'))
+
+    created_by = db.relationship('User')
+
+    date_created = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow)
+    date_started = db.Column(db.DateTime)
+    date_finished = db.Column(db.DateTime)
+
+    """
+    The last time the worker running the job recorded its progress,
+    used to detect jobs whose worker has stopped.
+    """
+    date_heartbeat = db.Column(db.DateTime)
+
+    # Supports workers looking for the oldest queued job
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),
+    )
+
+    def __unicode__(self):
+        return self.description
+
+
+class GeocodeCache(db.Model):
+    """
+    The stored result of geocoding an address, used to avoid repeated
+    requests to the geocoding service for the same address.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+
+    """
+    The SHA-1 hash of the normalized address, which is used
+    for lookups since addresses can be too long to index.
+    """
+    address_hash = db.Column(db.String(40), nullable=False, unique=True)
+
+    """
+    The normalized address that was geocoded.
+    """
+    address = db.Column(db.Unicode(500), nullable=False)
+
+    """
+    Indicates if the geocoding service found the address. Addresses
+    that weren't found are cached as well, but for a shorter time.
+    """
+    found = db.Column(db.Boolean, nullable=False, default=True)
+
+    formatted_address = db.Column(db.Unicode(500))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+
+    """
+    The city, county and state of the address, if known.
+    """
+    city = db.Column(db.Unicode(250))
+    county = db.Column(db.Unicode(250))
+    state = db.Column(db.Unicode(250))
+
+    date_cached = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow)
+
+    def __unicode__(self):
+        return self.address
+
+
+def get_duplicate_key(value):
+    """
+    Normalizes a resource name or NPI for use in detecting
+    duplicate resources.
+
+    Args:
+        value: The value to normalize.
+
+    Returns:
+        The lowercased, stripped value, or None if
+        the value is empty.
+    """
+    if value is None or value.isspace() or len(value) == 0:
+        return None
+
+    return value.strip().lower()
+
+
 @listens_for(Resource, 'before_insert')
 @listens_for(Resource, 'before_update')
 def normalize_resource(mapper, connect, target):
     """
     Normalizes a resource before it is saved to the database.
     This ensures that the resource's categories are properly
-    denormalized in the category_text and that the resource's
+    denormalized in the category_text, that the resource's
     URL starts with some sort of http:// or https:// prefix
-    if it has been provided.
+    if it has been provided, that the geohash reflects
+    the resource's latitude/longitude, and that the keys used
+    for duplicate detection reflect its name and NPI.
 
     Args:
         mapper: The mapper that is the target of the event.
@@ -532,6 +701,18 @@ def normalize_resource(mapper, connect, target):
             not target.url.lower().strip().startswith(('http://', 'https://')):
         target.url = 'http://' + target.url.strip()
 
+    # Keep the geohash in sync with the coordinates
+    if target.latitude is not None and target.longitude is not None:
+        target.geohash = unicode(geoutils.geohash_encode(
+            float(target.latitude),
+            float(target.longitude)))
+    else:
+        target.geohash = None
+
+    # Keep the duplicate detection keys in sync
+    target.normalized_name = get_duplicate_key(target.name)
+    target.normalized_npi = get_duplicate_key(target.npi)
+
 
 @listens_for(Review, 'before_insert')
 @listens_for(Review, 'before_update')
@@ -5,26 +5,58 @@ This module contains functionality for interacting with resource models in
 the database.
 """
 
+from copy import copy
+from datetime import datetime
+
+from flask import current_app
 from sqlalchemy import *
-from models import Resource, Category, Population, ResourceReviewScore
+from sqlalchemy.orm import joinedload
+from models import Resource, Category, Population, ResourceReviewScore, \
+    resourcecategory, resourcepopulation, db
+from keyset import SortKey
+from remedy.caching import get_versioned
+from remedy.pagination import seek_paginate, list_paginate
 import geoutils
+import searchindex
+import searchplanner
+import textsearch
+
+# Used in place of a missing last-reviewed date when sorting by rating.
+MIN_REVIEW_DATE = datetime(1900, 1, 1)
+
+# The cache tags of cached search results.
+SEARCH_RESULT_TAGS = (
+    'resource',
+    'resource_review_score',
+    'category',
+    'population'
+)
 
 
 def search(
         search_params=None,
         limit=0,
         page_size=0,
-        page_number=0):
+        page_number=0,
+        cursor=None,
+        ids_only=False):
     """
     Searches for one or more resources in the database
     using the specified parameters.
 
+    The matching IDs are cached (see get_cached_results), so only the
+    resources that will be returned are loaded from the database.
+
     Args:
-        database: The current database context.
         search_params: The dictionary of searching parameters to use.
         limit: The maximum number of results to return.
         page_size: The size of each page when using paged queries.
         page_number: The 1-indexed page number when using paged queries.
+            Ignored if a valid cursor is provided.
+        cursor: The cursor dictionary for the page to seek to when
+            using paged queries. Optional.
+        ids_only: If true, returns the ordered list of all matching
+            resource IDs instead, ignoring the limit and paging options.
 
     Returns:
         A list of all resources matching the specified filtering criteria.
@@ -37,6 +69,116 @@ def search(
     if (search_params is None or len(search_params) == 0) and limit <= 0:
         return None
 
+    if ids_only:
+        return get_cached_results(search_params)[0]
+
+    results, distances = get_cached_results(
+        search_params,
+        limit,
+        page_size,
+        page_number,
+        cursor)
+
+    if page_size > 0:
+        # Don't modify the cached pagination
+        results = copy(results)
+        results.items = load_ordered(results.items, distances)
+        return results
+
+    return load_ordered(results, distances)
+
+
+def get_cached_results(
+        search_params,
+        limit=0,
+        page_size=0,
+        page_number=0,
+        cursor=None):
+    """
+    Gets the IDs of the resources matching a search, caching them
+    until resources or their aggregate ratings are changed. Concurrent
+    identical searches are coalesced, so that only one of them is run.
+
+    Caching is controlled by the SEARCH_RESULT_CACHE_ENABLED and
+    SEARCH_RESULT_CACHE_TIMEOUT configuration values.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+        limit: The maximum number of results to return.
+        page_size: The size of each page when using paged queries.
+        page_number: The 1-indexed page number when using paged queries.
+        cursor: The cursor dictionary for the page to seek to when
+            using paged queries. Optional.
+
+    Returns:
+        The results of find_results.
+    """
+    def find():
+        return find_results(
+            search_params,
+            limit,
+            page_size,
+            page_number,
+            cursor)
+
+    if not current_app.config.get('SEARCH_RESULT_CACHE_ENABLED', True):
+        return find()
+
+    return get_versioned(
+        'search-results',
+        repr((
+            get_canonical_params(search_params, exclude=('addr',)),
+            limit,
+            page_size,
+            sorted(cursor.items()) if cursor else page_number)),
+        find,
+        timeout=current_app.config.get('SEARCH_RESULT_CACHE_TIMEOUT'),
+        tags=SEARCH_RESULT_TAGS,
+        coalesce=True)
+
+
+def find_results(
+        search_params,
+        limit=0,
+        page_size=0,
+        page_number=0,
+        cursor=None):
+    """
+    Finds the IDs of the resources matching a search.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+        limit: The maximum number of results to return.
+        page_size: The size of each page when using paged queries.
+        page_number: The 1-indexed page number when using paged queries.
+            Ignored if a valid cursor is provided.
+        cursor: The cursor dictionary for the page to seek to when
+            using paged queries. Optional.
+
+    Returns:
+        A tuple of the results and a dictionary of the resulting resource
+        IDs to their distance from the searched location, in miles (or
+        None if this isn't a proximity search). The results are an
+        ordered list of resource IDs, or a Pagination object whose items
+        are resource IDs if the page_size is specified.
+    """
+
+    # Answer from the in-memory index where possible
+    if search_params is not None and len(search_params) > 0:
+        index_results = searchindex.search(db.session, search_params)
+
+        if index_results is not None:
+            result_ids, distances = index_results
+
+            return paginate_ids(
+                result_ids,
+                limit,
+                page_size,
+                page_number,
+                distances,
+                cursor,
+                search_params.get('order_by'))
+
     # Determine we have location searching, which we'll use in our sorting/
     # filtering as appropriate
     has_location = False
@@ -47,129 +189,535 @@ def search(
             and'long' in search_params:
         has_location = True
 
-    # Set up our base query
-    query = Resource.query. \
-        outerjoin(Resource.overall_aggregate)
-
-    # Make sure we have some searching parameters!
-    if search_params is not None and len(search_params) > 0:
+    # Track how text searching was applied, which affects ordering. Ranked
+    # database backends provide an expression to rank on, while in-process
+    # backends provide a dictionary of matching IDs to relevance scores.
+    text_matches = get_text_matches(search_params)
 
-        # "id" parameter - search against specific resource ID
-        if 'id' in search_params:
-            query = query.filter(
-                Resource.id == search_params['id'])
-
-        # "visible" parameter - treat as a flag
-        if 'visible' in search_params:
-            query = query.filter(
-                Resource.visible == search_params['visible'])
-
-        # "is_approved" parameter - treat as a flag
-        if 'is_approved' in search_params:
-            query = query.filter(
-                Resource.is_approved == search_params['is_approved'])
-
-        # "icath" parameter - treat as a flag
-        if 'icath' in search_params:
-            query = query.filter(
-                Resource.is_icath == search_params['icath'])
-
-        # "wpath" parameter - treat as a flag
-        if 'wpath' in search_params:
-            query = query.filter(
-                Resource.is_wpath == search_params['wpath'])
-
-        # "wheelchair_accessible" parameter - treat as a flag
-        if 'wheelchair_accessible' in search_params:
-            query = query.filter(
-                Resource.is_accessible ==
-                search_params['wheelchair_accessible'])
-
-        # "sliding_scale" parameter - treat as a flag
-        if 'sliding_scale' in search_params:
-            query = query.filter(
-                Resource.has_sliding_scale ==
-                search_params['sliding_scale'])
-
-        # "search" parameter - text search against
-        # name/description/keywords fields
-        if 'search' in search_params and \
-                not search_params['search'].isspace():
-
-            search_like_str = '%' + search_params['search'] + '%'
-            query = query.filter(or_(
-                Resource.name.like(search_like_str),
-                Resource.description.like(search_like_str),
-                Resource.organization.like(search_like_str),
-                Resource.category_text.like(search_like_str)))
-
-        # Category filtering - ensure at least one has been provided
-        if 'categories' in search_params and \
-                len(search_params['categories']) > 0:
-            query = query.filter(Resource.categories.any(
-                Category.id.in_(search_params['categories'])))
-
-        # Population filtering - ensure at least one has been provided
-        if 'populations' in search_params and \
-                len(search_params['populations']) > 0:
-            query = query.filter(Resource.populations.any(
-                Population.id.in_(search_params['populations'])))
-
-        # Location parameters ("lat", "long", "dist") - proximity filtering
-        if has_location:
-
-            # Convert our overall distance value to kilometers
-            dist_km = geoutils.miles2km(search_params['dist'])
-
-            # Calculate our bounding box
-            minLat, minLong, maxLat, maxLong = geoutils.boundingBox(
-                search_params['lat'],
-                search_params['long'],
-                dist_km)
+    # Decide which filter to find candidates with, and then apply them
+    plan = searchplanner.plan_search(db.session, search_params, text_matches)
 
-            # Now apply filtering against that bounding box
-            query = query.filter(
-                Resource.latitude >= minLat, Resource.latitude <= maxLat)
-            query = query.filter(
-                Resource.longitude >= minLong, Resource.longitude <= maxLong)
+    query, text_rank = filter_query(
+        Resource.query.outerjoin(Resource.overall_aggregate),
+        search_params,
+        plan,
+        text_matches)
 
     # Apply ordering. Distance is handled near the end so that
     # we can assume that it's either not specified or explicitly
-    # specified as distance at that point.
+    # specified as distance at that point. Every ordering ends with
+    # the ID so that it can be used for keyset pagination.
     order_by = search_params.get('order_by')
+    sort_relevance = False
+    sort_distance = False
+
+    # Most orderings fall back to last-modified descending
+    modified_keys = [
+        SortKey(Resource.last_updated, descending=True, is_datetime=True),
+        SortKey(Resource.id, descending=True)
+    ]
 
     if order_by == 'name':
-        query = query.order_by(Resource.name)
-    elif order_by == 'modified':
-        query = query.order_by(Resource.last_updated.desc())
+        sort_keys = [
+            SortKey(Resource.name),
+            SortKey(Resource.id)
+        ]
     elif order_by == 'created':
-        query = query.order_by(Resource.date_created.desc())
+        sort_keys = [
+            SortKey(Resource.date_created, descending=True, is_datetime=True),
+            SortKey(Resource.id, descending=True)
+        ]
     elif order_by == 'rating':
-        query = query.order_by(
-            ResourceReviewScore.rating_avg.desc(),
-            ResourceReviewScore.num_ratings.desc(),
-            ResourceReviewScore.last_reviewed.desc(),
-            Resource.last_updated.desc())
-    elif has_location:
-        # We determine this by summing up the absolute value of the
-        # differences between the resource and search latitudes/longitudes.
-        # The absolute value prevents differences with opposing signs
-        # from cancelling each other out.
-        query = query.order_by(
-            func.abs(Resource.latitude - search_params['lat']) +
-            func.abs(Resource.longitude - search_params['long']))
+        # Unrated resources sort last. Coalescing the missing values
+        # keeps this consistent across databases and makes it possible
+        # to seek past them.
+        sort_keys = [
+            SortKey(
+                func.coalesce(ResourceReviewScore.rating_avg, -1),
+                descending=True),
+            SortKey(
+                func.coalesce(ResourceReviewScore.num_ratings, -1),
+                descending=True),
+            SortKey(
+                func.coalesce(
+                    ResourceReviewScore.last_reviewed,
+                    MIN_REVIEW_DATE),
+                descending=True,
+                is_datetime=True)
+        ] + modified_keys
+    elif order_by == 'relevance' and text_rank is not None:
+        sort_keys = [SortKey(text_rank, descending=True)] + modified_keys
+    elif order_by == 'relevance' and text_matches is not None:
+        # Ranked by score below, falling back to last-modified
+        sort_keys = modified_keys
+        sort_relevance = True
+    elif order_by != 'modified' and has_location:
+        # Ranked by exact distance below, falling back to last-modified
+        sort_keys = modified_keys
+        sort_distance = True
     else:
-        # Fall back to last-modified descending
-        query = query.order_by(Resource.last_updated.desc())
+        sort_keys = modified_keys
+
+    query = query.order_by(*[key.order_clause() for key in sort_keys])
+
+    # Proximity searching and in-process text matching are finished
+    # against the list of candidate IDs
+    if has_location or text_matches is not None:
+        candidates = query.with_entities(
+            Resource.id,
+            Resource.latitude,
+            Resource.longitude).all()
+
+        if text_matches is not None:
+            candidates = [c for c in candidates if c[0] in text_matches]
+
+        result_ids = [c[0] for c in candidates]
+        distances = {}
+
+        if has_location and len(candidates) > 0:
+            # Filter on the true great-circle distance, since the
+            # bounding box includes its corners. This is computed for
+            # every candidate in a single call.
+            mask, candidate_distances = geoutils.within_radius_batch(
+                search_params['lat'],
+                search_params['long'],
+                [c[1] for c in candidates],
+                [c[2] for c in candidates],
+                geoutils.miles2km(search_params['dist']))
+
+            result_ids = []
+
+            for res_id, is_within, distance in zip(
+                    [c[0] for c in candidates],
+                    mask,
+                    candidate_distances):
+                if is_within:
+                    result_ids.append(res_id)
+                    distances[res_id] = geoutils.km2miles(float(distance))
+
+        # The SQL ordering above falls back to last-modified, so
+        # a stable sort keeps that as the tiebreaker.
+        if sort_relevance:
+            result_ids.sort(key=lambda i: text_matches[i], reverse=True)
+        elif sort_distance:
+            result_ids.sort(key=lambda i: distances[i])
+
+        return paginate_ids(
+            result_ids,
+            limit,
+            page_size,
+            page_number,
+            distances,
+            cursor,
+            order_by)
+
+    if page_size > 0:
+        # Page by keyset, only loading the resources on the page
+        pagination = seek_paginate(
+            query,
+            sort_keys,
+            page_size,
+            page_number,
+            cursor,
+            order_by,
+            count_results(query, search_params))
+
+        pagination.items = [row[-1] for row in pagination.items]
+        return pagination, None
+
+    query = query.with_entities(Resource.id)
 
     # Apply limiting
     if limit > 0:
         query = query.limit(limit)
 
+    return [row[0] for row in query], None
+
+
+def explain(search_params):
+    """
+    Describes how a search would be run against the database,
+    without running it.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        A dictionary containing:
+            params: The canonical searching parameters.
+            plan: The search plan, from SearchPlan.to_dict.
+            sql: The SQL of the filtered query.
+            text_matches: The number of resources matched in-process by
+                the text backend, or None if it filters in the database.
+    """
+    text_matches = get_text_matches(search_params)
+    plan = searchplanner.plan_search(db.session, search_params, text_matches)
+
+    query = filter_query(
+        Resource.query.outerjoin(Resource.overall_aggregate),
+        search_params,
+        plan,
+        text_matches)[0]
+
+    return {
+        'params': dict(get_canonical_params(search_params)),
+        'plan': plan.to_dict(),
+        'sql': unicode(query.statement.compile(
+            dialect=db.session.bind.dialect)),
+        'text_matches': len(text_matches)
+        if text_matches is not None else None
+    }
+
+
+def get_candidate_query(search_params):
+    """
+    Builds a query of the IDs of the candidate resources for a search,
+    so that the results can be aggregated in the database. Candidates
+    have every filter applied in the database, but the exact distance
+    and in-process text matches are only applied by searching.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        A tuple of the query of candidate resource IDs and a boolean
+        indicating if the candidates include resources that don't match
+        the search.
+    """
+    text_matches = get_text_matches(search_params)
+    plan = searchplanner.plan_search(db.session, search_params, text_matches)
+
+    query = filter_query(
+        Resource.query,
+        search_params,
+        plan,
+        text_matches)[0]
+
+    has_location = search_params.get('dist', 0) > 0 and \
+        'lat' in search_params and \
+        'long' in search_params
+
+    return query.with_entities(Resource.id), \
+        has_location or text_matches is not None
+
+
+def get_text_matches(search_params):
+    """
+    Matches the search text of the provided parameters with the
+    configured text backend, if that backend matches in-process.
+
+    Args:
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        A dictionary of matching resource IDs to relevance scores, or
+        None if there is no search text or the backend filters queries
+        in the database.
+    """
+    if 'search' not in search_params or \
+            search_params['search'].isspace():
+        return None
+
+    backend = textsearch.get_backend()
+
+    if not backend.in_process:
+        return None
+
+    return backend.match(db.session, search_params['search'])
+
+
+def filter_query(query, search_params, plan, text_matches=None):
+    """
+    Applies the filters in the provided search parameters to a query,
+    using the plan to decide which filter finds the candidates.
+
+    Args:
+        query: The resource query to filter.
+        search_params: The dictionary of searching parameters to use.
+        plan: The SearchPlan from searchplanner.plan_search.
+        text_matches: The results of get_text_matches. Optional.
+
+    Returns:
+        The filtered query and the expression to use when ranking
+        results by relevance (in descending order), or None if the
+        text wasn't ranked in the database.
+    """
+    text_rank = None
+
+    # "id" parameter - search against specific resource ID
+    if 'id' in search_params:
+        query = query.filter(
+            Resource.id == search_params['id'])
+
+    # "visible" parameter - treat as a flag
+    if 'visible' in search_params:
+        query = query.filter(
+            Resource.visible == search_params['visible'])
+
+    # "is_approved" parameter - treat as a flag
+    if 'is_approved' in search_params:
+        query = query.filter(
+            Resource.is_approved == search_params['is_approved'])
+
+    # "icath" parameter - treat as a flag
+    if 'icath' in search_params:
+        query = query.filter(
+            Resource.is_icath == search_params['icath'])
+
+    # "wpath" parameter - treat as a flag
+    if 'wpath' in search_params:
+        query = query.filter(
+            Resource.is_wpath == search_params['wpath'])
+
+    # "wheelchair_accessible" parameter - treat as a flag
+    if 'wheelchair_accessible' in search_params:
+        query = query.filter(
+            Resource.is_accessible ==
+            search_params['wheelchair_accessible'])
+
+    # "sliding_scale" parameter - treat as a flag
+    if 'sliding_scale' in search_params:
+        query = query.filter(
+            Resource.has_sliding_scale ==
+            search_params['sliding_scale'])
+
+    # "search" parameter - text search against
+    # name/description/keywords fields, using the configured backend.
+    # In-process matches are applied to the candidates afterwards,
+    # unless they're being used to find the candidates.
+    if 'search' in search_params and \
+            not search_params['search'].isspace():
+
+        if text_matches is None:
+            query, text_rank = textsearch.get_backend().filter_query(
+                query,
+                search_params['search'])
+        elif plan.strategy == 'text':
+            if len(text_matches) > 0:
+                query = query.filter(Resource.id.in_(text_matches.keys()))
+            else:
+                query = query.filter(false())
+
+    # Category/population filtering - ensure at least one has been
+    # provided. When finding candidates with one of these, select the
+    # resource IDs from the association table so it can drive the query.
+    for param, relationship, model, table in (
+            ('categories', Resource.categories, Category, resourcecategory),
+            ('populations', Resource.populations, Population,
+             resourcepopulation)):
+        if len(search_params.get(param) or []) == 0:
+            continue
+
+        if plan.strategy == 'facet' and plan.facet_param == param:
+            other_col = [c for c in table.c if c.name != 'resource_id'][0]
+
+            query = query.filter(Resource.id.in_(
+                select([table.c.resource_id]).
+                where(other_col.in_(search_params[param]))))
+        else:
+            query = query.filter(relationship.any(
+                model.id.in_(search_params[param])))
+
+    # Location parameters ("lat", "long", "dist") - proximity filtering
+    if search_params.get('dist', 0) > 0 and \
+            'lat' in search_params and \
+            'long' in search_params:
+
+        # Convert our overall distance value to kilometers
+        dist_km = geoutils.miles2km(search_params['dist'])
+
+        # Calculate our bounding box
+        minLat, minLong, maxLat, maxLong = geoutils.boundingBox(
+            search_params['lat'],
+            search_params['long'],
+            dist_km)
+
+        # Select candidates through the indexed geohash column, using
+        # range comparisons on the cells covering the bounding box.
+        # ('~' sorts after every geohash character.)
+        if plan.strategy == 'geo':
+            query = query.filter(or_(*[
+                and_(Resource.geohash >= cell, Resource.geohash < cell + '~')
+                for cell in geoutils.geohash_cells(
+                    minLat,
+                    minLong,
+                    maxLat,
+                    maxLong)
+            ]))
+
+        # Now apply filtering against that bounding box
+        query = query.filter(
+            Resource.latitude >= minLat, Resource.latitude <= maxLat)
+        query = query.filter(
+            Resource.longitude >= minLong, Resource.longitude <= maxLong)
+
+    return query, text_rank
+
+
+def count_results(query, search_params):
+    """
+    Counts the results of a search query, depending on the
+    SEARCH_COUNT_MODE configuration value:
+        exact: The results are counted for every request.
+        cached: Counts are cached until resources are changed.
+        none: Results are not counted.
+
+    Args:
+        query: The search query.
+        search_params: The dictionary of searching parameters in use.
+
+    Returns:
+        The number of results, or None if they are not counted.
+    """
+    count_mode = current_app.config.get('SEARCH_COUNT_MODE', 'cached')
+
+    if count_mode == 'none':
+        return None
+
+    def count():
+        return query.order_by(None).count()
+
+    if count_mode == 'exact':
+        return count()
+
+    return get_versioned(
+        'search-counts',
+        get_params_key(search_params),
+        count,
+        tags=('resource', 'category', 'population'))
+
+
+def get_canonical_params(search_params, exclude=()):
+    """
+    Gets a canonical form of the provided search parameters, so that
+    equivalent searches can share cached results.
+
+    Args:
+        search_params: The dictionary of searching parameters in use.
+        exclude: The names of parameters to leave out. Optional.
+
+    Returns:
+        A sorted list of parameter name/value tuples.
+    """
+    has_location = 'lat' in search_params and 'long' in search_params
+    params = []
+
+    for key, value in search_params.iteritems():
+        if key in exclude:
+            continue
+
+        # The distance doesn't matter without a location
+        if key == 'dist' and not has_location:
+            continue
+
+        if isinstance(value, (set, list, tuple)):
+            value = sorted(value)
+        elif key in ('dist', 'lat', 'long'):
+            value = float(value)
+        elif key == 'search':
+            value = u' '.join(value.split())
+
+        params.append((key, value))
+
+    return sorted(params)
+
+
+def get_params_key(search_params):
+    """
+    Gets a key that identifies the set of resources matched by the
+    provided search parameters, for caching results that don't depend
+    on the ordering or the displayed address.
+
+    Args:
+        search_params: The dictionary of searching parameters in use.
+
+    Returns:
+        The key, as a string.
+    """
+    return repr(get_canonical_params(
+        search_params,
+        exclude=('order_by', 'addr')))
+
+
+def load_ordered(resource_ids, distances=None):
+    """
+    Loads the resources with the provided IDs, preserving their order.
+
+    Args:
+        resource_ids: The ordered list of resource IDs to load.
+        distances: A dictionary of resource IDs to their distance from
+            the searched location, in miles. If provided, each resource
+            will have the distance stored in a "distance" field. Optional.
+
+    Returns:
+        A list of the resources, in the same order as the provided IDs.
+    """
+    if len(resource_ids) == 0:
+        return []
+
+    resources = Resource.query. \
+        options(joinedload(Resource.overall_aggregate)). \
+        filter(Resource.id.in_(resource_ids)). \
+        all()
+
+    resource_dict = dict((r.id, r) for r in resources)
+
+    if distances is not None:
+        for res in resources:
+            res.distance = distances.get(res.id)
+
+    return [
+        resource_dict[rid]
+        for rid in resource_ids
+        if rid in resource_dict
+    ]
+
+
+def paginate_ids(
+        result_ids,
+        limit=0,
+        page_size=0,
+        page_number=0,
+        distances=None,
+        cursor=None,
+        order_by=None):
+    """
+    Applies limiting and paging to an ordered list of matching resource IDs.
+
+    Args:
+        result_ids: The ordered list of all matching resource IDs.
+        limit: The maximum number of results to return.
+        page_size: The size of each page when using paged queries.
+        page_number: The 1-indexed page number when using paged queries.
+            Ignored if a valid cursor is provided.
+        distances: A dictionary of resource IDs to their distance from
+            the searched location, in miles. Optional.
+        cursor: The cursor dictionary for the page to seek to when
+            using paged queries. Optional.
+        order_by: The name of the ordering in use. Optional.
+
+    Returns:
+        A tuple of the results and the distances of the resulting
+        resources, in the same format as find_results.
+    """
+    if limit > 0:
+        result_ids = result_ids[:limit]
+
     if page_size > 0:
-        return query.paginate(page_number, per_page=page_size)
-    else:
-        return query.all()
+        result_ids = list_paginate(
+            result_ids,
+            page_size,
+            page_number,
+            cursor,
+            order_by)
+
+        # Only keep the distances that will be displayed
+        if distances is not None:
+            distances = dict(
+                (rid, distances.get(rid))
+                for rid in result_ids.items)
+
+    return result_ids, distances
 
 
 def save(database, resource):
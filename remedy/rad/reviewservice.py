@@ -5,7 +5,70 @@ This module contains functionality for interacting with review models in
 the database.
 """
 
-from models import Review
+from sqlalchemy.orm import joinedload
+
+from models import Review, ResourceReviewScore
+from aggregateservice import update_resource_aggregates
+
+
+def get_visible_reviews(resource_id):
+    """
+    Gets the visible top-level reviews for a resource. All visible
+    reviews (including old ones) and their users are loaded in a
+    single query, and the old reviews are then attached to the review
+    that replaced them.
+
+    Args:
+        resource_id: The ID of the resource.
+
+    Returns:
+        A list of the visible top-level reviews, ordered by ID. Visible
+        old reviews, sorted by descending creation date, will be stored
+        as an old_reviews_filtered field on each review.
+    """
+    all_reviews = Review.query. \
+        options(joinedload(Review.user)). \
+        filter(Review.resource_id == resource_id). \
+        filter(Review.visible == True). \
+        order_by(Review.id). \
+        all()
+
+    # Group old reviews by the review that replaced them
+    old_reviews = {}
+
+    for rev in all_reviews:
+        if rev.new_review_id is not None:
+            old_reviews.setdefault(rev.new_review_id, []).append(rev)
+
+    reviews = [rev for rev in all_reviews if not rev.is_old_review]
+
+    for rev in reviews:
+        rev.old_reviews_filtered = sorted(
+            old_reviews.get(rev.id, []),
+            key=lambda r: r.date_created,
+            reverse=True)
+
+    return reviews
+
+
+def get_aggregates(resource_id, population_ids):
+    """
+    Gets the aggregate ratings for a resource, along with their
+    populations, in a single query.
+
+    Args:
+        resource_id: The ID of the resource.
+        population_ids: The IDs of the populations to include.
+            The overall aggregate has a population ID of 0.
+
+    Returns:
+        A list of the matching aggregate ratings.
+    """
+    return ResourceReviewScore.query. \
+        options(joinedload(ResourceReviewScore.population)). \
+        filter(ResourceReviewScore.resource_id == resource_id). \
+        filter(ResourceReviewScore.population_id.in_(population_ids)). \
+        all()
 
 
 def delete(session, review):
@@ -55,6 +118,8 @@ def delete(session, review):
             # in that case, so we don't get FK errors on our delete.
             existing_review.new_review_id = None
 
-    # After all that, delete the review
+    # After all that, delete the review and update
+    # the resource's aggregates
     session.delete(review)
+    update_resource_aggregates(session, [review.resource_id])
     session.commit()
@@ -0,0 +1,685 @@
+"""
+searchindex.py
+
+Contains an optional in-memory index of visible, approved resources
+that can answer resource searches without querying the database.
+
+The index is a column-oriented snapshot: each resource occupies a
+position, and categories, populations and boolean flags are stored as
+bitsets over those positions (using Python's arbitrary-precision
+integers), alongside coordinate/sorting columns and a token index.
+The snapshot is refreshed incrementally from Resource.last_updated and
+periodically rebuilt from scratch. Deleted resources leave no trace to
+refresh from, so incremental refreshes also compare the snapshot against
+the IDs of all visible, approved resources, which catches deletions
+made by any process.
+"""
+from datetime import datetime
+from threading import Lock
+import time
+
+from flask import current_app
+
+from models import Resource, ResourceReviewScore, resourcecategory, \
+    resourcepopulation
+from textsearch import InvertedIndex, get_resource_text, SEARCH_FIELDS
+import geoutils
+
+# Maps boolean search parameters to the equivalent resource fields.
+FLAG_FIELDS = {
+    'icath': 'is_icath',
+    'wpath': 'is_wpath',
+    'wheelchair_accessible': 'is_accessible',
+    'sliding_scale': 'has_sliding_scale'
+}
+
+# The number of IDs to include in a single IN clause.
+ID_CHUNK_SIZE = 500
+
+
+def bit_positions(bits):
+    """
+    Gets the positions of all set bits in the provided bitset.
+
+    Args:
+        bits: The bitset, as an integer.
+
+    Returns:
+        A list of the positions of the set bits, in ascending order.
+    """
+    binary = bin(bits)[:1:-1]
+    return [pos for pos, digit in enumerate(binary) if digit == '1']
+
+
+def bit_count(bits):
+    """
+    Gets the number of set bits in the provided bitset.
+
+    Args:
+        bits: The bitset, as an integer.
+
+    Returns:
+        The number of set bits.
+    """
+    return bin(bits).count('1')
+
+
+def chunks(items, size=ID_CHUNK_SIZE):
+    """
+    Splits the provided list into chunks.
+
+    Args:
+        items: The list to split.
+        size: The maximum size of each chunk.
+
+    Returns:
+        A generator of lists of at most the specified size.
+    """
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+class ResourceSnapshot(object):
+    """
+    A snapshot of visible, approved resources that can answer searches.
+
+    Attributes:
+        ids: The resource ID at each position. Positions of resources
+            that have since been removed hold None.
+        positions: A dictionary of resource IDs to positions.
+        live_bits: The bitset of positions holding current resources.
+        category_bits: A dictionary of category IDs to bitsets.
+        population_bits: A dictionary of population IDs to bitsets.
+        flag_bits: A dictionary of (search parameter, value) tuples
+            to bitsets.
+        text_index: The token index, keyed by resource ID.
+        ratings: A dictionary of resource IDs to tuples of their
+            average rating, number of ratings and last review date.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.live_bits = 0
+        self.category_bits = {}
+        self.population_bits = {}
+        self.flag_bits = {}
+        self.memberships = []
+        self.latitudes = []
+        self.longitudes = []
+        self.names = []
+        self.last_updated = []
+        self.date_created = []
+        self.ratings = {}
+        self.text_index = InvertedIndex()
+
+    def remove(self, resource_id):
+        """
+        Removes a resource from the snapshot, if it is present.
+
+        Args:
+            resource_id: The ID of the resource to remove.
+        """
+        pos = self.positions.pop(resource_id, None)
+
+        if pos is None:
+            return
+
+        mask = ~(1 << pos)
+
+        for bitsets, key in self.memberships[pos]:
+            bitsets[key] &= mask
+
+        self.memberships[pos] = []
+        self.live_bits &= mask
+        self.ids[pos] = None
+        self.text_index.remove(resource_id)
+
+    def _set_bit(self, bitsets, key, pos):
+        """
+        Sets a bit in one of the snapshot's bitset dictionaries and
+        records the membership so it can be cleared later.
+        """
+        bitsets[key] = bitsets.get(key, 0) | (1 << pos)
+        self.memberships[pos].append((bitsets, key))
+
+    def add(self, row, category_ids, population_ids):
+        """
+        Adds a resource to the snapshot, replacing any previous entry.
+
+        Args:
+            row: The resource row to add, which must have the id,
+                latitude, longitude, name, last_updated, date_created,
+                flag and search text fields.
+            category_ids: The IDs of the resource's categories.
+            population_ids: The IDs of the resource's populations.
+        """
+        self.remove(row.id)
+
+        pos = len(self.ids)
+        self.ids.append(row.id)
+        self.positions[row.id] = pos
+        self.memberships.append([])
+        self.live_bits |= (1 << pos)
+
+        self.latitudes.append(row.latitude)
+        self.longitudes.append(row.longitude)
+        self.names.append(row.name.lower() if row.name else u'')
+        self.last_updated.append(row.last_updated)
+        self.date_created.append(row.date_created)
+
+        for category_id in category_ids:
+            self._set_bit(self.category_bits, category_id, pos)
+
+        for population_id in population_ids:
+            self._set_bit(self.population_bits, population_id, pos)
+
+        # Flags are nullable, so store bitsets for both values.
+        for param, field in FLAG_FIELDS.iteritems():
+            value = getattr(row, field)
+
+            if value is not None:
+                self._set_bit(self.flag_bits, (param, bool(value)), pos)
+
+        self.text_index.add(row.id, get_resource_text(row))
+
+    def match_bits(self, search_params):
+        """
+        Gets the bitset of resources matching the non-text, non-location
+        filters in the provided search parameters.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            The bitset of matching positions.
+        """
+        bits = self.live_bits
+
+        if 'id' in search_params:
+            # Route parameters are strings, but positions are keyed
+            # by integer IDs
+            try:
+                pos = self.positions.get(int(search_params['id']))
+            except (TypeError, ValueError):
+                pos = None
+
+            bits &= (1 << pos) if pos is not None else 0
+
+        for param in FLAG_FIELDS:
+            if param in search_params:
+                bits &= self.flag_bits.get(
+                    (param, bool(search_params[param])),
+                    0)
+
+        # Categories/populations match if the resource has any of them
+        for param, bitsets in (
+                ('categories', self.category_bits),
+                ('populations', self.population_bits)):
+            if len(search_params.get(param) or []) > 0:
+                any_bits = 0
+
+                for key in search_params[param]:
+                    any_bits |= bitsets.get(key, 0)
+
+                bits &= any_bits
+
+        return bits
+
+    def match_positions(self, search_params):
+        """
+        Gets the positions of resources matching all of the filters in
+        the provided search parameters, including text and location.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            A tuple of the list of matching positions, in ascending order,
+            a dictionary of resource IDs to text relevance scores (or None
+            if this isn't a text search) and a dictionary of resource IDs
+            to distances in miles (or None if this isn't a proximity
+            search).
+        """
+        positions = bit_positions(self.match_bits(search_params))
+        scores = None
+
+        if 'search' in search_params and \
+                not search_params['search'].isspace():
+            scores = self.text_index.search(search_params['search'])
+            positions = [p for p in positions if self.ids[p] in scores]
+
+        distances = None
+
+        if search_params.get('dist', 0) > 0 and \
+                'lat' in search_params and \
+                'long' in search_params and \
+                len(positions) > 0:
+            mask, pos_distances = geoutils.within_radius_batch(
+                search_params['lat'],
+                search_params['long'],
+                [self.latitudes[p] for p in positions],
+                [self.longitudes[p] for p in positions],
+                geoutils.miles2km(search_params['dist']))
+
+            distances = {}
+            within = []
+
+            for pos, is_within, distance in zip(
+                    positions,
+                    mask,
+                    pos_distances):
+                if is_within:
+                    within.append(pos)
+                    distances[self.ids[pos]] = \
+                        geoutils.km2miles(float(distance))
+
+            positions = within
+
+        return positions, scores, distances
+
+    def search(self, search_params):
+        """
+        Searches the snapshot using the provided parameters, with the
+        same semantics as resourceservice.search.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            A tuple of the ordered list of matching resource IDs and a
+            dictionary of resource IDs to distances in miles (or None if
+            this isn't a proximity search).
+        """
+        positions, scores, distances = self.match_positions(search_params)
+
+        # Sort by last-modified first, which is the tiebreaker for
+        # everything else, and then by the requested order.
+        positions.sort(key=lambda p: self.last_updated[p], reverse=True)
+        order_by = search_params.get('order_by')
+
+        if order_by == 'name':
+            positions.sort(key=lambda p: self.names[p])
+        elif order_by == 'created':
+            positions.sort(key=lambda p: self.date_created[p], reverse=True)
+        elif order_by == 'rating':
+            positions.sort(key=self.rating_key, reverse=True)
+        elif order_by == 'relevance' and scores is not None:
+            positions.sort(key=lambda p: scores[self.ids[p]], reverse=True)
+        elif order_by != 'modified' and distances is not None:
+            positions.sort(key=lambda p: distances[self.ids[p]])
+
+        return [self.ids[p] for p in positions], distances
+
+    def facet_counts(self, search_params):
+        """
+        Counts the resources matching a search that belong to each
+        category, population and flag, by intersecting the bitset of
+        matching resources with the bitset of each facet.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            A dictionary of facet counts, in the same format as
+            facetservice.count_facets.
+        """
+        if 'search' in search_params or 'lat' in search_params:
+            positions = self.match_positions(search_params)[0]
+
+            # Build the bitset in one step, rather than setting
+            # each bit in turn
+            digits = bytearray('0' * len(self.ids))
+
+            for pos in positions:
+                digits[pos] = '1'
+
+            bits = int(str(digits[::-1]) or '0', 2)
+        else:
+            bits = self.match_bits(search_params)
+
+        def count_bitsets(bitsets):
+            counts = {}
+
+            for key, key_bits in bitsets.iteritems():
+                count = bit_count(bits & key_bits)
+
+                if count > 0:
+                    counts[key] = count
+
+            return counts
+
+        return {
+            'total': bit_count(bits),
+            'categories': count_bitsets(self.category_bits),
+            'populations': count_bitsets(self.population_bits),
+            'flags': dict(
+                (param, bit_count(
+                    bits & self.flag_bits.get((param, True), 0)))
+                for param in FLAG_FIELDS)
+        }
+
+    def rating_key(self, pos):
+        """
+        Gets the key to use when sorting a position by rating,
+        in descending order. Unrated resources sort last.
+
+        Args:
+            pos: The position of the resource.
+
+        Returns:
+            The sort key.
+        """
+        rating = self.ratings.get(self.ids[pos])
+
+        if rating is None or rating[0] is None:
+            return (False, 0.0, 0, datetime.min)
+
+        return (True, rating[0], rating[1], rating[2])
+
+
+class ResourceSearchIndex(object):
+    """
+    Maintains the current snapshot of visible, approved resources.
+    Incremental refreshes update the snapshot under the lock, while full
+    rebuilds load a new snapshot and swap it in once it is complete.
+
+    Attributes:
+        snapshot: The current ResourceSnapshot.
+        lock: The lock held while reading or updating the snapshot.
+        refresh_lock: The lock held by the thread refreshing the snapshot.
+        built: The time the snapshot was last fully rebuilt.
+        refreshed: The time the snapshot was last refreshed.
+        max_updated: The latest last_updated date seen so far.
+    """
+
+    def __init__(self):
+        self.snapshot = ResourceSnapshot()
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.built = None
+        self.refreshed = None
+        self.max_updated = None
+
+    def load(self, session, full=False):
+        """
+        Loads resources from the database into the snapshot.
+
+        Args:
+            session: The current database session.
+            full: If true, rebuilds the snapshot from scratch. Otherwise,
+                only resources updated since the last load are reloaded.
+        """
+        columns = [
+            Resource.id,
+            Resource.latitude,
+            Resource.longitude,
+            Resource.last_updated,
+            Resource.date_created,
+            Resource.visible,
+            Resource.is_approved
+        ] + [getattr(Resource, f) for f in FLAG_FIELDS.itervalues()] + \
+            [getattr(Resource, f) for f in SEARCH_FIELDS]
+
+        full = full or self.max_updated is None
+        query = session.query(*columns)
+
+        if full:
+            query = query. \
+                filter(Resource.visible == True). \
+                filter(Resource.is_approved == True)
+        else:
+            # Include hidden/unapproved resources so they can be removed
+            query = query.filter(Resource.last_updated >= self.max_updated)
+
+        rows = query.all()
+        row_ids = [r.id for r in rows]
+
+        # Get the category/population memberships for the loaded rows
+        category_ids = dict((rid, []) for rid in row_ids)
+        population_ids = dict((rid, []) for rid in row_ids)
+
+        for table, target in (
+                (resourcecategory, category_ids),
+                (resourcepopulation, population_ids)):
+            other_col = [c for c in table.c if c.name != 'resource_id'][0]
+
+            if full:
+                member_query = session.query(table.c.resource_id, other_col)
+                member_rows = member_query.all()
+            else:
+                member_rows = []
+
+                for id_chunk in chunks(row_ids):
+                    member_rows.extend(
+                        session.query(table.c.resource_id, other_col).
+                        filter(table.c.resource_id.in_(id_chunk)).all())
+
+            for resource_id, other_id in member_rows:
+                if resource_id in target:
+                    target[resource_id].append(other_id)
+
+        # Overall ratings change independently of resources, but there's
+        # only one row per resource, so reload all of them.
+        ratings = dict(
+            (score.resource_id, (
+                score.rating_avg,
+                score.num_ratings,
+                score.last_reviewed))
+            for score in session.query(
+                ResourceReviewScore.resource_id,
+                ResourceReviewScore.rating_avg,
+                ResourceReviewScore.num_ratings,
+                ResourceReviewScore.last_reviewed).
+            filter(ResourceReviewScore.population_id == 0))
+
+        # Deleted resources don't show up in the query, so find
+        # the snapshot's resources that are no longer current.
+        if full:
+            current_ids = None
+        else:
+            current_ids = set(
+                resource_id for resource_id, in session.query(Resource.id).
+                filter(Resource.visible == True).
+                filter(Resource.is_approved == True))
+
+        # Rebuilds fill in a new snapshot so that searches can keep
+        # using the current one in the meantime.
+        if full:
+            snapshot = ResourceSnapshot()
+        else:
+            snapshot = self.snapshot
+            self.lock.acquire()
+
+        try:
+            max_updated = None if full else self.max_updated
+
+            for row in rows:
+                if row.visible and row.is_approved:
+                    snapshot.add(
+                        row,
+                        category_ids[row.id],
+                        population_ids[row.id])
+                else:
+                    snapshot.remove(row.id)
+
+                if max_updated is None or row.last_updated > max_updated:
+                    max_updated = row.last_updated
+
+            # Removed after adding the rows, in case any of them were
+            # deleted since they were loaded
+            if current_ids is not None:
+                deleted_ids = [
+                    resource_id for resource_id in snapshot.positions
+                    if resource_id not in current_ids
+                ]
+
+                for resource_id in deleted_ids:
+                    snapshot.remove(resource_id)
+
+            snapshot.ratings = ratings
+
+            if full:
+                with self.lock:
+                    self.snapshot = snapshot
+
+                self.built = time.time()
+        finally:
+            if not full:
+                self.lock.release()
+
+        self.max_updated = max_updated
+        self.refreshed = time.time()
+
+    def ensure_fresh(self, session, config):
+        """
+        Refreshes the snapshot if it is due, based on the
+        SEARCH_INDEX_REFRESH_SECONDS and SEARCH_INDEX_REBUILD_SECONDS
+        configuration values. If another thread is already refreshing,
+        the current snapshot is used.
+
+        Args:
+            session: The current database session.
+            config: The application configuration.
+
+        Returns:
+            A boolean indicating if the snapshot is fresh enough to use,
+            based on the SEARCH_INDEX_MAX_AGE configuration value.
+        """
+        now = time.time()
+        rebuild_seconds = config.get('SEARCH_INDEX_REBUILD_SECONDS', 3600)
+        refresh_seconds = config.get('SEARCH_INDEX_REFRESH_SECONDS', 30)
+
+        rebuild_due = self.built is None or \
+            now - self.built > rebuild_seconds
+        refresh_due = rebuild_due or self.refreshed is None or \
+            now - self.refreshed > refresh_seconds
+
+        if refresh_due and self.refresh_lock.acquire(False):
+            try:
+                self.load(session, full=rebuild_due)
+            except Exception:
+                current_app.logger.exception(
+                    'Error refreshing the resource search index.')
+            finally:
+                self.refresh_lock.release()
+
+        return self.refreshed is not None and \
+            time.time() - self.refreshed <= \
+            config.get('SEARCH_INDEX_MAX_AGE', 300)
+
+    def can_answer(self, search_params):
+        """
+        Determines if the snapshot can answer a search. The snapshot only
+        contains visible, approved resources, so searches must be
+        explicitly restricted to those.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            A boolean indicating if the search can be answered.
+        """
+        return search_params.get('visible') is True and \
+            search_params.get('is_approved') is True
+
+    def search(self, search_params):
+        """
+        Searches the current snapshot. See ResourceSnapshot.search.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            The results of ResourceSnapshot.search.
+        """
+        with self.lock:
+            return self.snapshot.search(search_params)
+
+    def facet_counts(self, search_params):
+        """
+        Counts the facets of a search from the current snapshot.
+        See ResourceSnapshot.facet_counts.
+
+        Args:
+            search_params: The dictionary of searching parameters to use.
+
+        Returns:
+            The results of ResourceSnapshot.facet_counts.
+        """
+        with self.lock:
+            return self.snapshot.facet_counts(search_params)
+
+
+def get_index(app=None):
+    """
+    Gets the resource search index for the provided application,
+    creating it on first use.
+
+    Args:
+        app: The application. Defaults to the current application.
+
+    Returns:
+        The resource search index, or None if SEARCH_INDEX_ENABLED
+        is not set.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+
+    if not app.config.get('SEARCH_INDEX_ENABLED', False):
+        return None
+
+    index = app.extensions.get('remedy_searchindex')
+
+    if index is None:
+        index = ResourceSearchIndex()
+        app.extensions['remedy_searchindex'] = index
+
+    return index
+
+
+def search(session, search_params):
+    """
+    Attempts to answer a resource search from the in-memory index.
+
+    Args:
+        session: The current database session.
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        The results of ResourceSearchIndex.search, or None if the
+        index is disabled, stale or cannot answer the search.
+    """
+    index = get_index()
+
+    if index is None or not index.can_answer(search_params):
+        return None
+
+    if not index.ensure_fresh(session, current_app.config):
+        return None
+
+    return index.search(search_params)
+
+
+def facet_counts(session, search_params):
+    """
+    Attempts to count the facets of a resource search from the
+    in-memory index.
+
+    Args:
+        session: The current database session.
+        search_params: The dictionary of searching parameters to use.
+
+    Returns:
+        The results of ResourceSearchIndex.facet_counts, or None if the
+        index is disabled, stale or cannot answer the search.
+    """
+    index = get_index()
+
+    if index is None or not index.can_answer(search_params):
+        return None
+
+    if not index.ensure_fresh(session, current_app.config):
+        return None
+
+    return index.facet_counts(search_params)
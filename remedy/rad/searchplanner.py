@@ -0,0 +1,289 @@
+"""
+searchplanner.py
+
+Chooses how database resource searches should find their candidates.
+
+A search can start from the resources near its location (through the
+indexed geohash column), from the resources in its categories or
+populations (through the association tables), or from the resources
+matching its text (when the text backend matches in-process). The
+planner keeps cheap statistics - the number of resources in each
+category, population and geohash cell - and starts from whichever
+candidate set is estimated to be the smallest. The remaining filters
+are then applied to those candidates.
+"""
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import Resource, resourcecategory, resourcepopulation
+from remedy.caching import get_versioned
+import geoutils
+
+# The length of the geohash prefixes that resources are counted by.
+STATS_CELL_PRECISION = 4
+
+# The number of cells at each geohash precision that make up
+# a cell at the previous precision.
+CELL_FANOUT = 32.0
+
+# The largest number of text matches to search by ID.
+MAX_TEXT_CANDIDATES = 1000
+
+# Candidate sets estimated to include more than this fraction of all
+# resources aren't selective enough to start from.
+MAX_SELECTIVITY = 0.5
+
+# The order in which equally-selective strategies are preferred.
+STRATEGY_ORDER = ('geo', 'facet', 'text')
+
+# The cache tags of the statistics.
+STATISTICS_TAGS = ('resource', 'category', 'population')
+
+
+def build_statistics(session):
+    """
+    Counts the visible, approved resources in each category, population
+    and geohash cell.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        A dictionary containing:
+            total: The total number of resources.
+            categories: A dictionary of category IDs to resource counts.
+            populations: A dictionary of population IDs to resource counts.
+            cell_keys: The sorted list of geohash cells that contain
+                resources, each STATS_CELL_PRECISION characters long.
+            cell_counts: The number of resources in each of those cells.
+    """
+    def visible(query):
+        return query. \
+            filter(Resource.visible == True). \
+            filter(Resource.is_approved == True)
+
+    stats = {
+        'total': visible(session.query(func.count(Resource.id))).scalar()
+    }
+
+    for key, table in (
+            ('categories', resourcecategory),
+            ('populations', resourcepopulation)):
+        other_col = [c for c in table.c if c.name != 'resource_id'][0]
+
+        stats[key] = dict(
+            visible(session.query(other_col, func.count()).
+                    join(Resource, Resource.id == table.c.resource_id)).
+            group_by(other_col).
+            all())
+
+    cell = func.substr(Resource.geohash, 1, STATS_CELL_PRECISION)
+
+    cells = visible(session.query(cell, func.count())). \
+        filter(Resource.geohash != None). \
+        group_by(cell). \
+        order_by(cell). \
+        all()
+
+    stats['cell_keys'] = [c[0] for c in cells]
+    stats['cell_counts'] = [c[1] for c in cells]
+
+    return stats
+
+
+def get_statistics(session):
+    """
+    Gets the search statistics, which are cached until resources,
+    categories or populations are changed.
+
+    Args:
+        session: The current database session.
+
+    Returns:
+        The statistics, in the same format as build_statistics.
+    """
+    return get_versioned(
+        'search-statistics',
+        'all',
+        lambda: build_statistics(session),
+        timeout=current_app.config.get('SEARCH_PLANNER_STATS_TIMEOUT'),
+        tags=STATISTICS_TAGS,
+        coalesce=True)
+
+
+def estimate_cells(stats, cells):
+    """
+    Estimates the number of resources in the provided geohash cells.
+    Cells more precise than the statistics are assumed to have an even
+    share of the resources in their containing cell.
+
+    Args:
+        stats: The search statistics.
+        cells: The geohash cells.
+
+    Returns:
+        The estimated number of resources.
+    """
+    keys = stats['cell_keys']
+    counts = stats['cell_counts']
+    estimate = 0.0
+
+    for cell in cells:
+        prefix = cell[:STATS_CELL_PRECISION]
+        pos = bisect_left(keys, prefix)
+
+        if len(cell) >= STATS_CELL_PRECISION:
+            if pos < len(keys) and keys[pos] == prefix:
+                estimate += counts[pos] / \
+                    CELL_FANOUT ** (len(cell) - STATS_CELL_PRECISION)
+        else:
+            while pos < len(keys) and keys[pos].startswith(prefix):
+                estimate += counts[pos]
+                pos += 1
+
+    return int(round(estimate))
+
+
+class SearchPlan(object):
+    """
+    Describes how a database resource search will find its candidates.
+
+    Attributes:
+        strategy: The candidate set to start from. One of:
+            geo: The resources in the geohash cells around the location.
+            facet: The resources in the categories or populations
+                named by facet_param.
+            text: The resources matching the search text.
+            scan: No candidate set is selective enough, so every
+                filter is applied as-is.
+        facet_param: The search parameter ("categories" or "populations")
+            to start from when using the facet strategy.
+        estimates: A dictionary of strategies to their estimated number
+            of candidates, or None if it can't be estimated.
+        total: The total number of resources.
+        reason: A description of why the strategy was chosen.
+    """
+
+    def __init__(self, strategy, estimates=None, total=None, reason=None,
+                 facet_param=None):
+        self.strategy = strategy
+        self.estimates = estimates or {}
+        self.total = total
+        self.reason = reason
+        self.facet_param = facet_param
+
+    def to_dict(self):
+        """
+        Gets the plan as a dictionary, for displaying it.
+
+        Returns:
+            A dictionary of the plan's attributes.
+        """
+        return {
+            'strategy': self.strategy,
+            'facet_param': self.facet_param,
+            'estimates': self.estimates,
+            'total': self.total,
+            'reason': self.reason
+        }
+
+
+def plan_search(session, search_params, text_matches=None):
+    """
+    Chooses how a database resource search should find its candidates,
+    based on the SEARCH_PLANNER_ENABLED configuration value.
+
+    Args:
+        session: The current database session.
+        search_params: The dictionary of searching parameters to use.
+        text_matches: A dictionary of resource IDs matching the search
+            text to their relevance, if the text backend matches
+            in-process. Optional.
+
+    Returns:
+        The SearchPlan.
+    """
+    has_location = search_params.get('dist', 0) > 0 and \
+        'lat' in search_params and \
+        'long' in search_params
+
+    # Without the planner, always start from the location
+    if not current_app.config.get('SEARCH_PLANNER_ENABLED', True):
+        return SearchPlan(
+            'geo' if has_location else 'scan',
+            reason='The search planner is disabled.')
+
+    # Nothing is more selective than a specific resource
+    if 'id' in search_params:
+        return SearchPlan(
+            'scan',
+            reason='The search is for a specific resource.')
+
+    stats = get_statistics(session)
+    total = stats['total']
+    estimates = {}
+    facet_param = None
+
+    if has_location:
+        minLat, minLong, maxLat, maxLong = geoutils.boundingBox(
+            search_params['lat'],
+            search_params['long'],
+            geoutils.miles2km(search_params['dist']))
+
+        estimates['geo'] = estimate_cells(
+            stats,
+            geoutils.geohash_cells(minLat, minLong, maxLat, maxLong))
+
+    # Resources can match any of the selected categories/populations,
+    # so the sum of their counts is an upper bound
+    for param in ('categories', 'populations'):
+        if len(search_params.get(param) or []) > 0:
+            estimate = min(
+                sum(stats[param].get(i, 0) for i in search_params[param]),
+                total)
+
+            if 'facet' not in estimates or estimate < estimates['facet']:
+                estimates['facet'] = estimate
+                facet_param = param
+
+    if text_matches is not None:
+        estimates['text'] = len(text_matches)
+    elif 'search' in search_params and \
+            not search_params['search'].isspace():
+        # Matched by the database's text index, which can't be estimated
+        estimates['text'] = None
+
+    candidates = [
+        (estimates[strategy], STRATEGY_ORDER.index(strategy), strategy)
+        for strategy in STRATEGY_ORDER
+        if estimates.get(strategy) is not None and
+        (strategy != 'text' or estimates[strategy] <= MAX_TEXT_CANDIDATES)
+    ]
+
+    if len(candidates) == 0:
+        return SearchPlan(
+            'scan',
+            estimates,
+            total,
+            'No filter can be used to find candidates.')
+
+    estimate, order, strategy = min(candidates)
+
+    if estimate > total * MAX_SELECTIVITY:
+        return SearchPlan(
+            'scan',
+            estimates,
+            total,
+            'The most selective filter (' + strategy + ') is estimated ' +
+            'to match ' + str(estimate) + ' of ' + str(total) +
+            ' resources.')
+
+    return SearchPlan(
+        strategy,
+        estimates,
+        total,
+        'Estimated to match ' + str(estimate) + ' of ' + str(total) +
+        ' resources, the fewest of any filter.',
+        facet_param if strategy == 'facet' else None)
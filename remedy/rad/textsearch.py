@@ -0,0 +1,608 @@
+"""
+textsearch.py
+
+Contains the backends used for free-text searching against resources.
+
+Each backend supports the same query semantics: the search text is split
+into tokens, every token must match (as a prefix) a word somewhere in the
+resource's name, organization, description or category text, and matches
+are ranked by relevance. The backend in use is selected through the
+SEARCH_BACKEND configuration value.
+"""
+from bisect import bisect_left
+from math import log
+from threading import RLock
+import re
+
+from flask import current_app, has_app_context
+from sqlalchemy import or_, func, text, literal_column, literal, case, \
+    false, Float
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression, ClauseList
+from sqlalchemy.event import listens_for
+
+from models import Resource
+
+# Splits text into word tokens.
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+# The resource fields included in text searching.
+SEARCH_FIELDS = ('name', 'organization', 'description', 'category_text')
+
+
+def tokenize(value):
+    """
+    Splits the provided text into lowercase word tokens.
+
+    Args:
+        value: The text to split.
+
+    Returns:
+        A list of lowercase tokens in the order they appear.
+    """
+    if not value:
+        return []
+
+    return [t.lower() for t in _token_re.findall(value)]
+
+
+def get_search_tokens(search_text):
+    """
+    Gets the distinct tokens to use when searching on the provided text.
+
+    Args:
+        search_text: The search text provided by the user.
+
+    Returns:
+        A list of distinct lowercase tokens, preserving their order.
+    """
+    tokens = []
+
+    for token in tokenize(search_text):
+        if token not in tokens:
+            tokens.append(token)
+
+    return tokens
+
+
+def get_resource_text(resource):
+    """
+    Gets the searchable text for the provided resource.
+
+    Args:
+        resource: The resource, or any object with the searchable fields.
+
+    Returns:
+        The searchable fields joined together with spaces.
+    """
+    return u' '.join(
+        getattr(resource, field) or u''
+        for field in SEARCH_FIELDS)
+
+
+class InvertedIndex(object):
+    """
+    A simple in-memory inverted index supporting prefix matching
+    of tokens and BM25 relevance ranking.
+
+    Attributes:
+        postings: A dictionary of terms to dictionaries of document IDs
+            and term frequencies.
+        doc_lengths: A dictionary of document IDs to token counts.
+    """
+    # BM25 tuning parameters
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self._sorted_terms = None
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_lengths
+
+    def clear(self):
+        """
+        Removes all documents from the index.
+        """
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self._sorted_terms = None
+
+    def add(self, doc_id, value):
+        """
+        Adds (or replaces) a document in the index.
+
+        Args:
+            doc_id: The ID of the document.
+            value: The text of the document.
+        """
+        self.remove(doc_id)
+
+        tokens = tokenize(value)
+        frequencies = {}
+
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        for term, freq in frequencies.iteritems():
+            if term not in self.postings:
+                self.postings[term] = {}
+                self._sorted_terms = None
+
+            self.postings[term][doc_id] = freq
+
+        self.doc_terms[doc_id] = frequencies.keys()
+        self.doc_lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc_id):
+        """
+        Removes a document from the index if it exists.
+
+        Args:
+            doc_id: The ID of the document.
+        """
+        if doc_id not in self.doc_lengths:
+            return
+
+        for term in self.doc_terms.pop(doc_id):
+            term_postings = self.postings[term]
+            term_postings.pop(doc_id, None)
+
+            if len(term_postings) == 0:
+                del self.postings[term]
+                self._sorted_terms = None
+
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def expand_prefix(self, prefix):
+        """
+        Gets all indexed terms starting with the provided prefix.
+
+        Args:
+            prefix: The prefix to look up.
+
+        Returns:
+            A list of matching terms.
+        """
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings.iterkeys())
+
+        terms = self._sorted_terms
+        matches = []
+        pos = bisect_left(terms, prefix)
+
+        while pos < len(terms) and terms[pos].startswith(prefix):
+            matches.append(terms[pos])
+            pos += 1
+
+        return matches
+
+    def search(self, search_text):
+        """
+        Finds all documents matching every token in the provided
+        text, treating each token as a prefix.
+
+        Args:
+            search_text: The text to search on.
+
+        Returns:
+            A dictionary of matching document IDs to relevance scores,
+            where higher scores are more relevant.
+        """
+        tokens = get_search_tokens(search_text)
+
+        if len(tokens) == 0 or len(self.doc_lengths) == 0:
+            return {}
+
+        doc_count = float(len(self.doc_lengths))
+        avg_length = max(self.total_length / doc_count, 1.0)
+        scores = None
+
+        for token in tokens:
+            token_scores = {}
+
+            for term in self.expand_prefix(token):
+                term_postings = self.postings[term]
+                idf = log(1.0 + (doc_count - len(term_postings) + 0.5) /
+                          (len(term_postings) + 0.5))
+
+                for doc_id, freq in term_postings.iteritems():
+                    norm = self.k1 * (
+                        1.0 - self.b +
+                        self.b * self.doc_lengths[doc_id] / avg_length)
+                    score = idf * freq * (self.k1 + 1.0) / (freq + norm)
+
+                    token_scores[doc_id] = token_scores.get(doc_id, 0.0) + \
+                        score
+
+            # Every token has to match, so intersect as we go
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = dict(
+                    (doc_id, score + token_scores[doc_id])
+                    for doc_id, score in scores.iteritems()
+                    if doc_id in token_scores)
+
+            if len(scores) == 0:
+                break
+
+        return scores
+
+
+class LikeSearchBackend(object):
+    """
+    The legacy text search backend, which performs substring matching
+    against each searchable column. Does not use any index and does not
+    rank results.
+    """
+    name = 'like'
+    ranked = False
+    in_process = False
+
+    def filter_query(self, query, search_text):
+        """
+        Filters the provided resource query to those matching the text.
+
+        Args:
+            query: The resource query to filter.
+            search_text: The text to search on.
+
+        Returns:
+            The filtered query and the expression to use when ranking
+            results (in descending order), or None if unranked.
+        """
+        search_like_str = '%' + search_text + '%'
+
+        return query.filter(or_(
+            Resource.name.like(search_like_str),
+            Resource.description.like(search_like_str),
+            Resource.organization.like(search_like_str),
+            Resource.category_text.like(search_like_str))), None
+
+    def index_resource(self, connection, resource):
+        """
+        Updates the index entry for the provided resource.
+
+        Args:
+            connection: The database connection in use.
+            resource: The resource that was inserted or updated.
+        """
+        pass
+
+    def unindex_resource(self, connection, resource_id):
+        """
+        Removes the index entry for the provided resource.
+
+        Args:
+            connection: The database connection in use.
+            resource_id: The ID of the resource that was deleted.
+        """
+        pass
+
+    def rebuild(self, session):
+        """
+        Rebuilds the index from scratch.
+
+        Args:
+            session: The current database session.
+        """
+        pass
+
+
+class MySqlFullTextBackend(LikeSearchBackend):
+    """
+    A text search backend that uses a MySQL FULLTEXT index over the
+    searchable resource columns. MySQL maintains the index itself.
+    """
+    name = 'mysql'
+    ranked = True
+
+    def get_match_expression(self, search_text):
+        """
+        Gets the boolean-mode MATCH ... AGAINST expression for the text.
+
+        Args:
+            search_text: The text to search on.
+
+        Returns:
+            The MATCH expression, which evaluates to the relevance of
+            each resource, or None if there are no tokens.
+        """
+        tokens = get_search_tokens(search_text)
+
+        if len(tokens) == 0:
+            return None
+
+        # The MySQL dialect compiles the match operator as a boolean-mode
+        # MATCH ... AGAINST, so an ungrouped list of columns produces the
+        # column list of the FULLTEXT index.
+        return BinaryExpression(
+            ClauseList(
+                *[getattr(Resource, f) for f in SEARCH_FIELDS],
+                group=False),
+            literal(u' '.join(u'+' + t + u'*' for t in tokens)),
+            operator=operators.match_op,
+            type_=Float())
+
+    def filter_query(self, query, search_text):
+        match_expr = self.get_match_expression(search_text)
+
+        if match_expr is None:
+            return query, None
+
+        return query.filter(match_expr), match_expr
+
+    def rebuild(self, session):
+        session.execute('OPTIMIZE TABLE resource')
+
+
+class SqliteFtsBackend(LikeSearchBackend):
+    """
+    A text search backend that uses an SQLite FTS5 virtual table,
+    keyed on the resource ID, which is kept in sync as resources
+    are inserted, updated and deleted.
+    """
+    name = 'sqlite'
+    ranked = True
+
+    table_name = 'resource_fts'
+
+    def get_match_query(self, search_text):
+        """
+        Gets the FTS5 query string for the provided search text.
+
+        Args:
+            search_text: The text to search on.
+
+        Returns:
+            The FTS5 query string, or None if there are no tokens.
+        """
+        tokens = get_search_tokens(search_text)
+
+        if len(tokens) == 0:
+            return None
+
+        return u' '.join(u'"' + t + u'"*' for t in tokens)
+
+    def filter_query(self, query, search_text):
+        match_query = self.get_match_query(search_text)
+
+        if match_query is None:
+            return query, None
+
+        matches = text(
+            'SELECT rowid AS resource_id, bm25(' + self.table_name + ') ' +
+            'AS fts_rank FROM ' + self.table_name + ' ' +
+            'WHERE ' + self.table_name + ' MATCH :fts_query'). \
+            bindparams(fts_query=match_query). \
+            columns(
+                literal_column('resource_id'),
+                literal_column('fts_rank')). \
+            alias('fts_matches')
+
+        # bm25() returns more negative values for better matches,
+        # so negate it to rank in descending order.
+        query = query.join(matches, matches.c.resource_id == Resource.id)
+
+        return query, -matches.c.fts_rank
+
+    def create_table(self, connection):
+        """
+        Creates the FTS5 table if it does not exist.
+
+        Args:
+            connection: The database connection to use.
+        """
+        connection.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS ' + self.table_name +
+            ' USING fts5(' + ', '.join(SEARCH_FIELDS) + ')')
+
+    def index_resource(self, connection, resource):
+        self.unindex_resource(connection, resource.id)
+
+        connection.execute(
+            text(
+                'INSERT INTO ' + self.table_name +
+                ' (rowid, ' + ', '.join(SEARCH_FIELDS) + ') VALUES ' +
+                '(:id, :' + ', :'.join(SEARCH_FIELDS) + ')'),
+            id=resource.id,
+            **dict((f, getattr(resource, f)) for f in SEARCH_FIELDS))
+
+    def unindex_resource(self, connection, resource_id):
+        connection.execute(
+            text('DELETE FROM ' + self.table_name + ' WHERE rowid = :id'),
+            id=resource_id)
+
+    def rebuild(self, session):
+        connection = session.connection()
+
+        self.create_table(connection)
+        connection.execute('DELETE FROM ' + self.table_name)
+        connection.execute(
+            'INSERT INTO ' + self.table_name +
+            ' (rowid, ' + ', '.join(SEARCH_FIELDS) + ') ' +
+            'SELECT id, ' + ', '.join(SEARCH_FIELDS) + ' FROM resource')
+
+
+class PythonSearchBackend(LikeSearchBackend):
+    """
+    A text search backend that keeps an in-process inverted index of
+    all resources. The index is refreshed from the database whenever
+    the resource count or latest last_updated date changes, so every
+    worker process converges on the same data without any database
+    support for full-text searching.
+    """
+    name = 'python'
+    ranked = True
+    in_process = True
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self.signature = None
+        self.lock = RLock()
+
+    def get_signature(self, session):
+        """
+        Gets a cheap signature that changes when resources change.
+
+        Args:
+            session: The current database session.
+
+        Returns:
+            A tuple of the resource count and latest last_updated date.
+        """
+        return tuple(session.query(
+            func.count(Resource.id),
+            func.max(Resource.last_updated)).one())
+
+    def refresh(self, session):
+        """
+        Brings the in-process index up to date with the database,
+        re-indexing only resources that have changed since the last
+        refresh where possible.
+
+        Args:
+            session: The current database session.
+        """
+        signature = self.get_signature(session)
+
+        if signature == self.signature:
+            return
+
+        with self.lock:
+            if signature == self.signature:
+                return
+
+            fields = [Resource.id] + \
+                [getattr(Resource, f) for f in SEARCH_FIELDS]
+            query = session.query(*fields)
+
+            # Only look at updated resources if we have a prior signature
+            if self.signature is not None and self.signature[1] is not None:
+                query = query.filter(
+                    Resource.last_updated >= self.signature[1])
+            else:
+                self.index.clear()
+
+            for row in query:
+                self.index.add(row[0], get_resource_text(row))
+
+            # If the counts don't line up, resources have been deleted.
+            if len(self.index) != signature[0]:
+                self.index.clear()
+
+                for row in session.query(*fields):
+                    self.index.add(row[0], get_resource_text(row))
+
+            self.signature = signature
+
+    def match(self, session, search_text):
+        """
+        Finds resources matching the provided text.
+
+        Args:
+            session: The current database session.
+            search_text: The text to search on.
+
+        Returns:
+            A dictionary of matching resource IDs to relevance scores.
+        """
+        self.refresh(session)
+
+        with self.lock:
+            return self.index.search(search_text)
+
+    def filter_query(self, query, search_text):
+        scores = self.match(query.session, search_text)
+
+        if len(scores) == 0:
+            return query.filter(false()), None
+
+        return query.filter(Resource.id.in_(scores.keys())), \
+            case(scores, value=Resource.id, else_=0.0)
+
+    def rebuild(self, session):
+        with self.lock:
+            self.signature = None
+            self.refresh(session)
+
+
+# Maps SEARCH_BACKEND configuration values to backend classes.
+backend_types = {
+    'like': LikeSearchBackend,
+    'mysql': MySqlFullTextBackend,
+    'sqlite': SqliteFtsBackend,
+    'python': PythonSearchBackend
+}
+
+
+def get_backend(app=None):
+    """
+    Gets the text search backend for the provided application,
+    creating it on first use.
+
+    Args:
+        app: The application. Defaults to the current application.
+
+    Returns:
+        The text search backend.
+
+    Raises:
+        ValueError: The configured SEARCH_BACKEND is not recognized.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+
+    backend = app.extensions.get('remedy_textsearch')
+
+    if backend is None:
+        backend_name = app.config.get('SEARCH_BACKEND', 'like')
+
+        if backend_name not in backend_types:
+            raise ValueError(
+                'Unrecognized SEARCH_BACKEND "' + str(backend_name) + '".')
+
+        backend = backend_types[backend_name]()
+        app.extensions['remedy_textsearch'] = backend
+
+    return backend
+
+
+@listens_for(Resource, 'after_insert')
+@listens_for(Resource, 'after_update')
+def index_resource(mapper, connection, target):
+    """
+    Keeps the text search index in sync after a resource is saved.
+
+    Args:
+        mapper: The mapper that is the target of the event.
+        connection: The database connection being used.
+        target: The resource that was persisted to the database.
+    """
+    if has_app_context():
+        get_backend().index_resource(connection, target)
+
+
+@listens_for(Resource, 'after_delete')
+def unindex_resource(mapper, connection, target):
+    """
+    Keeps the text search index in sync after a resource is deleted.
+
+    Args:
+        mapper: The mapper that is the target of the event.
+        connection: The database connection being used.
+        target: The resource that was deleted from the database.
+    """
+    if has_app_context():
+        get_backend().unindex_resource(connection, target.id)
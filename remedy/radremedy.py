@@ -27,7 +27,8 @@ def create_app(config):
     app = Flask(__name__)
     app.config.from_object(config)
 
-    from remedyblueprint import remedy, url_for_other_page, server_error
+    from remedyblueprint import remedy, url_for_other_page, url_for_cursor, \
+        url_for_first_page, server_error
     app.register_blueprint(remedy)
 
     # Register a custom error handler for production scenarios
@@ -47,10 +48,27 @@ def create_app(config):
 
     # Register the paging helper method with Jinja2
     app.jinja_env.globals['url_for_other_page'] = url_for_other_page
+    app.jinja_env.globals['url_for_cursor'] = url_for_cursor
+    app.jinja_env.globals['url_for_first_page'] = url_for_first_page
     app.jinja_env.globals['logged_in'] = lambda: current_user.is_authenticated
 
     db.init_app(app)
 
+    from caching import init_cache
+    init_cache(app)
+
+    from instrumentation import init_instrumentation
+    init_instrumentation(app)
+
+    from profiling import init_profiling
+    init_profiling(app)
+
+    from metrics import init_metrics
+    init_metrics(app)
+
+    # Register the handlers for background jobs
+    import jobhandlers  # noqa
+
     from flask_wtf.csrf import CsrfProtect
     CsrfProtect(app)
 
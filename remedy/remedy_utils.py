@@ -10,6 +10,7 @@ from flask import request, flash, get_flashed_messages
 
 from wtforms.validators import Length, URL, Email, NumberRange
 
+import os
 import re
 
 # This normalizes multiple contiguous nelines into discrete paragraphs.
@@ -201,3 +202,19 @@ def get_field_args(field, **kwargs):
         field_args['rows'] = '3'
 
     return field_args
+
+
+def replace_file(source, dest):
+    """
+    Renames a file, replacing the destination if it exists.
+    On Windows, renaming onto an existing file fails, so the
+    destination is removed first (and the replacement isn't atomic).
+
+    Args:
+        source: The path of the file to rename.
+        dest: The path to rename it to.
+    """
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)
+
+    os.rename(source, dest)
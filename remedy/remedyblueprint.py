@@ -7,24 +7,27 @@ helper methods employed by those routes.
 from datetime import datetime, timedelta
 
 from flask import Blueprint, Response, render_template, redirect, url_for, \
-    request, abort, flash, send_from_directory
+    request, abort, flash, send_from_directory, current_app
 from flask.json import dumps
 from flask.ext.login import login_required, current_user
-from werkzeug.contrib.cache import SimpleCache
 from werkzeug.datastructures import MultiDict
 from functools import wraps
 
-from sqlalchemy import or_
-
-from flask.ext.sqlalchemy import Pagination
-
 from .remedy_utils import get_ip, get_field_args, get_nl2br, get_phoneintl, \
     flash_errors, get_grouped_flashed_messages
 from .email_utils import send_resource_error
-from rad.models import News, Resource, Review, Category, Population, \
-    ResourceReviewScore, CategoryGroup, db
+from .pagination import Pagination, seek_paginate, encode_cursor, \
+    decode_cursor
+from .caching import get_versioned, cached_view, \
+    CATEGORY_OPTIONS, POPULATION_OPTIONS
+from rad.models import News, Resource, Review, Category, Population, db
 from rad.forms import ContactForm, UserSubmitProviderForm, ReviewForm, \
     UserSettingsForm
+from rad.keyset import SortKey
+from rad.gazetteer import get_gazetteer
+from rad.autocomplete import get_autocomplete_index
+import rad.aggregateservice
+import rad.facetservice
 import rad.resourceservice
 import rad.reviewservice
 import rad.searchutils
@@ -37,8 +40,16 @@ import os
 
 PER_PAGE = 20
 
-# Set up a basic in-memory cache
-cache = SimpleCache()
+# The cache tags of models displayed on resource and search pages.
+RESOURCE_PAGE_TAGS = (
+    'resource',
+    'review',
+    'resource_review_score',
+    'category',
+    'category_group',
+    'population',
+    'population_group'
+)
 
 
 def get_json_response(data):
@@ -95,6 +106,53 @@ def url_for_other_page(page, anchor=None):
         return url_for(request.endpoint, **args)
 
 
+def url_for_cursor(cursor, anchor=None):
+    """
+    Generates a URL for the same page, with the only difference
+    being that the provided cursor is used to seek to another page
+    of results.
+
+    Args:
+        cursor: The cursor dictionary to use.
+        anchor: The anchor to use in the URL. Optional.
+
+    Returns:
+        The URL for the current page with the new cursor.
+    """
+    args = MultiDict(request.args)
+    args.update(request.view_args)
+
+    # Cursors replace page numbers, so always use the first page's URL
+    args['page'] = 1
+    args['cursor'] = encode_cursor(cursor)
+
+    if anchor is not None and len(anchor) > 0:
+        return url_for(request.endpoint, _anchor=anchor, **args)
+    else:
+        return url_for(request.endpoint, **args)
+
+
+def url_for_first_page(anchor=None):
+    """
+    Generates a URL for the first page of the current results.
+
+    Args:
+        anchor: The anchor to use in the URL. Optional.
+
+    Returns:
+        The URL for the first page.
+    """
+    args = MultiDict(request.args)
+    args.update(request.view_args)
+    args.pop('cursor', None)
+    args['page'] = 1
+
+    if anchor is not None and len(anchor) > 0:
+        return url_for(request.endpoint, _anchor=anchor, **args)
+    else:
+        return url_for(request.endpoint, **args)
+
+
 def get_sorted_options(optionlist):
     """
     Gets sorted options (ID/name tuples) from the provided list,
@@ -189,6 +247,40 @@ def group_active_categories(categories):
     return make_grouping(categories)
 
 
+def grouped_active_categories():
+    """
+    Returns all active categories, grouped for use in a form.
+    The grouping is cached until categories or category
+    groups are changed.
+
+    Returns:
+        A grouped list of categories. See make_grouping
+        for more information about the specific format.
+    """
+    return get_versioned(
+        CATEGORY_OPTIONS,
+        'grouped',
+        lambda: group_active_categories(active_categories()),
+        tags=('category', 'category_group'))
+
+
+def categories_with_ids(ids):
+    """
+    Returns the active categories with the provided IDs.
+
+    Args:
+        ids: The IDs of the categories to return.
+
+    Returns:
+        A list of categories from the database.
+    """
+    if len(ids) == 0:
+        return []
+
+    return Category.query.filter(Category.visible == True). \
+        filter(Category.id.in_(ids)).all()
+
+
 def active_populations():
     """
     Returns all active populations in the database.
@@ -215,6 +307,40 @@ def group_active_populations(populations):
     return make_grouping(populations)
 
 
+def grouped_active_populations():
+    """
+    Returns all active populations, grouped for use in a form.
+    The grouping is cached until populations or population
+    groups are changed.
+
+    Returns:
+        A grouped list of populations. See make_grouping
+        for more information about the specific format.
+    """
+    return get_versioned(
+        POPULATION_OPTIONS,
+        'grouped',
+        lambda: group_active_populations(active_populations()),
+        tags=('population', 'population_group'))
+
+
+def populations_with_ids(ids):
+    """
+    Returns the active populations with the provided IDs.
+
+    Args:
+        ids: The IDs of the populations to return.
+
+    Returns:
+        A list of populations from the database.
+    """
+    if len(ids) == 0:
+        return []
+
+    return Population.query.filter(Population.visible == True). \
+        filter(Population.id.in_(ids)).all()
+
+
 def resource_with_id(id):
     """
     Returns a resource from the database or aborts with a
@@ -477,17 +603,35 @@ def news(page):
             pagination: The paging information to use.
             news: The page of news posts to display.
     """
-    # Use the Flask-SQLA pagination structure to handle this for us.
-    # This will also handle if we've gone too far from a paging perspective.
-    sqlpage = News.query. \
-        filter(News.visible == True). \
-        order_by(News.date_created.desc()). \
-        paginate(page, per_page=10)
+    # Page through news by keyset, newest first. This will also
+    # handle if we've gone too far from a paging perspective.
+    query = News.query.filter(News.visible == True)
+
+    news_page = seek_paginate(
+        query,
+        [
+            SortKey(News.date_created, descending=True, is_datetime=True),
+            SortKey(News.id, descending=True)
+        ],
+        10,
+        page,
+        decode_cursor(request.args.get('cursor')),
+        'news')
+
+    # Load the posts on the page, preserving order
+    news_ids = [row[-1] for row in news_page.items]
+    news_dict = {}
+
+    if len(news_ids) > 0:
+        for news_post in query.filter(News.id.in_(news_ids)).all():
+            news_dict[news_post.id] = news_post
+
+    news_page.items = [news_dict[nid] for nid in news_ids]
 
     return render_template(
         'news.html',
-        news=sqlpage.items,
-        pagination=sqlpage)
+        news=news_page.items,
+        pagination=news_page)
 
 
 @remedy.route('/news/<int:news_id>/')
@@ -520,6 +664,7 @@ def redirect_home():
 
 
 @remedy.route('/resource/<resource_id>/')
+@cached_view('resource-pages', tags=RESOURCE_PAGE_TAGS)
 def resource(resource_id):
     """
     Gets information about a single resource.
@@ -545,13 +690,10 @@ def resource(resource_id):
             user_review_pending: A boolean indicating if the current user's
                 last review is not included in the aggregates.
     """
-    # Get the resource and all visible top-level reviews
+    # Get the resource and all visible top-level reviews, along with
+    # their users and visible old reviews
     resource = resource_with_id(resource_id)
-
-    reviews = resource.reviews. \
-        filter(Review.is_old_review == False). \
-        filter(Review.visible == True). \
-        all()
+    reviews = rad.reviewservice.get_visible_reviews(resource.id)
 
     # Store the date of an existing review by the user,
     # as well as if their latest review has been included
@@ -559,47 +701,37 @@ def resource(resource_id):
     user_review_date = None
     user_review_pending = False
 
-    # Ensure the filtered set of old reviews is
-    # available on each review we're displaying
-    for rev in reviews:
-
-        # See if the current user (if any) has reviewed this provider,
-        # and if so, store the created date of that
-        if current_user.is_authenticated and rev.user_id == current_user.id:
-            user_review_date = rev.date_created
-
-        # Filter down old to only the visible ones,
-        # and add appropriate sorting
-        rev.old_reviews_filtered = rev.old_reviews. \
-            filter(Review.visible == True). \
-            order_by(Review.date_created.desc()) \
-            .all()
+    # See if the current user (if any) has reviewed this provider,
+    # and if so, store the created date of that
+    if current_user.is_authenticated:
+        user_review_date = next(
+            (
+                rev.date_created
+                for rev in reviews
+                if rev.user_id == current_user.id
+            ),
+            None)
 
     # Get aggregate ratings if we have any reviews.
     aggregate_ratings = []
     overall_aggregate = None
 
     if len(reviews) > 0:
-        # First see if the user's logged in
+        # Always get the summary
+        agg_pop_ids = [0]
+
+        # If the user's logged in, get scores for their identities as
+        # well. This also ensures foreign-key consistency in case a
+        # population is deleted after aggregates have been calculated.
         if current_user.is_authenticated:
-            # Get scores for their identities as well as the summary.
-            # This also ensures foreign-key consistency in case a population
-            # is deleted after aggregates have been calculated.
-            user_pop_ids = [
+            agg_pop_ids.extend(
                 p.id
                 for p in current_user.populations
-                if p.visible
-            ]
-            user_pop_ids.append(0)
+                if p.visible)
 
-            aggregate_ratings = resource.aggregateratings \
-                .filter(ResourceReviewScore.population_id.in_(user_pop_ids)) \
-                .all()
-        else:
-            # Not logged in - only get summary
-            aggregate_ratings = resource.aggregateratings \
-                .filter(ResourceReviewScore.population_id == 0) \
-                .all()
+        aggregate_ratings = rad.reviewservice.get_aggregates(
+            resource.id,
+            agg_pop_ids)
 
         # Find the top-level aggregate
         overall_aggregate = next(
@@ -690,44 +822,17 @@ def is_aggregate_visible(agg_rating, user_review_date):
     return False
 
 
-@remedy.route('/find-provider/', defaults={'page': 1})
-@remedy.route('/find-provider/page/<int:page>')
-def resource_search(page):
+def get_search_params():
     """
-    Searches for resources that match the provided options
-    and displays a page of search results.
+    Builds the normalized searching options for a resource search
+    from the current request's arguments.
 
-    Args:
-        search: The text to search on.
-        id: The specific ID to filter on.
-        addr: The text to display in the "Address" field.
-            Not used for filtering.
-        categories: The IDs of the categories to filter on.
-        populations: The IDs of the populations to filter on.
-        icath: The ICATH status (in the form of a 1/0 value) to filter on.
-        wpath: The WPATH status (in the form of a 1/0 value) to filter on.
-        wheelchair_accessible: The accessibility status
-            (in the form of a 1/0 value) to filter on.
-        sliding_scale: The sliding scale status
-            (in the form of a 1/0 value) to filter on.
-        dist: The distance, in miles, to use for proximity-based searching.
-        lat: The latitude to use for proximity-based searching.
-        long: The longitude to use for proximity-based searching.
-        page: The current page number. Defaults to 1.
-        autofill: If set, will attempt to automatically fill the
-            proximity-based search fields with the current user's default
-            location, defaulting to a distance of 25.
+    See resource_search for the supported arguments.
 
     Returns:
-        A templated set of search results (via find-provider.html). This
-        template is provided with the following variables:
-            pagination: The paging information to use.
-            providers: The page of providers to display.
-            search_params: The dictionary of normalized searching options.
-            has_params: A boolean indicating if any user-defined options
-            were provided.
-            grouped_categories: The grouped set of all active categories.
-            grouped_populations: The grouped set of all active populations.
+        A tuple containing the dictionary of normalized searching
+        options and the number of those options that were added by
+        default, rather than provided by the user.
     """
 
     # Start building out the search parameters.
@@ -745,7 +850,8 @@ def resource_search(page):
             'created',
             'modified',
             'distance',
-            'rating'
+            'rating',
+            'relevance'
         )
 
         # Validate it's something we allow
@@ -843,6 +949,19 @@ def resource_search(page):
         'long',
         request.args.get('long'))
 
+    # If the address wasn't geocoded in the browser (such as when the
+    # Maps API is unavailable), try to find it with the offline gazetteer
+    if 'addr' in search_params and \
+            ('lat' not in search_params or 'long' not in search_params):
+        gazetteer = get_gazetteer(current_app)
+
+        if gazetteer is not None:
+            match = gazetteer.resolve(search_params['addr'])
+
+            if match is not None:
+                search_params['lat'] = match.latitude
+                search_params['long'] = match.longitude
+
     # See if we have a valid location
     if 'addr' not in search_params or \
             'dist' not in search_params or \
@@ -892,77 +1011,154 @@ def resource_search(page):
     if 'order_by' not in search_params:
         if valid_location:
             search_params['order_by'] = 'distance'
+        elif 'search' in search_params:
+            search_params['order_by'] = 'relevance'
         else:
             search_params['order_by'] = 'modified'
 
         # Ensure it's marked as a default param
         default_params_count = default_params_count + 1
 
+    return search_params, default_params_count
+
+
+@remedy.route('/find-provider/', defaults={'page': 1})
+@remedy.route('/find-provider/page/<int:page>')
+@cached_view('search-pages', tags=RESOURCE_PAGE_TAGS)
+def resource_search(page):
+    """
+    Searches for resources that match the provided options
+    and displays a page of search results.
+
+    Args:
+        search: The text to search on.
+        id: The specific ID to filter on.
+        addr: The text to display in the "Address" field.
+            Not used for filtering.
+        categories: The IDs of the categories to filter on.
+        populations: The IDs of the populations to filter on.
+        icath: The ICATH status (in the form of a 1/0 value) to filter on.
+        wpath: The WPATH status (in the form of a 1/0 value) to filter on.
+        wheelchair_accessible: The accessibility status
+            (in the form of a 1/0 value) to filter on.
+        sliding_scale: The sliding scale status
+            (in the form of a 1/0 value) to filter on.
+        dist: The distance, in miles, to use for proximity-based searching.
+        lat: The latitude to use for proximity-based searching.
+        long: The longitude to use for proximity-based searching.
+        page: The current page number. Defaults to 1.
+        autofill: If set, will attempt to automatically fill the
+            proximity-based search fields with the current user's default
+            location, defaulting to a distance of 25.
+
+    Returns:
+        A templated set of search results (via find-provider.html). This
+        template is provided with the following variables:
+            pagination: The paging information to use.
+            providers: The page of providers to display.
+            search_params: The dictionary of normalized searching options.
+            has_params: A boolean indicating if any user-defined options
+            were provided.
+            grouped_categories: The grouped set of all active categories.
+            grouped_populations: The grouped set of all active populations.
+            facet_counts: The facet counts of the search results (as
+            returned by rad.facetservice.get_facet_counts), or None
+            if no options were provided.
+    """
+    search_params, default_params_count = get_search_params()
+    has_params = len(search_params) > default_params_count
+
     # All right - time to search! (if we have anything to search on)
-    if len(search_params) > default_params_count:
+    if has_params:
         provider_page = rad.resourceservice.search(
             search_params=search_params,
             page_number=page,
-            page_size=PER_PAGE)
+            page_size=PER_PAGE,
+            cursor=decode_cursor(request.args.get('cursor')))
+
+        facet_counts = rad.facetservice.get_facet_counts(search_params)
     else:
         # Create a dummy page
-        provider_page = Pagination(None, 1, PER_PAGE, 0, [])
-
-    # Load up available categories
-    categories = active_categories()
-
-    # Load up available populations
-    populations = active_populations()
+        provider_page = Pagination(1, PER_PAGE, 0, [])
+        facet_counts = None
 
     return render_template(
         'find-provider.html',
         pagination=provider_page,
         providers=provider_page.items,
         search_params=search_params,
-        has_params=(len(search_params) > default_params_count),
-        grouped_categories=group_active_categories(categories),
-        grouped_populations=group_active_populations(populations)
+        has_params=has_params,
+        grouped_categories=grouped_active_categories(),
+        grouped_populations=grouped_active_populations(),
+        facet_counts=facet_counts
     )
 
 
+@remedy.route('/find-provider/facets/')
+def resource_search_facets():
+    """
+    Counts the categories, populations and flags of the resources
+    matching a search. Accepts the same arguments as resource_search.
+
+    Returns:
+        A JSON object containing the total number of matching
+        resources ("total"), objects mapping category and population
+        IDs to their counts ("categories" and "populations") and an
+        object mapping flags (such as "icath") to their counts ("flags").
+    """
+    search_params = get_search_params()[0]
+
+    return get_json_response(
+        rad.facetservice.get_facet_counts(search_params))
+
+
+@remedy.route('/find-provider/explain/')
+@login_required
+def resource_search_explain():
+    """
+    Describes how a search would be run against the database, for
+    administrators. Accepts the same arguments as resource_search.
+
+    Returns:
+        A JSON object containing the parameters of the search ("params"),
+        the chosen plan ("plan") and the SQL of the query ("sql").
+    """
+    if not current_user.admin:
+        abort(403)
+
+    search_params = get_search_params()[0]
+
+    return get_json_response(
+        rad.resourceservice.explain(search_params))
+
+
 @remedy.route('/search-suggest/<text>')
 def autocomplete(text):
     """
     Gets autocomplete suggestions for search text options.
 
+    Suggestions are matched against the start of any word in the
+    names and keywords of categories and populations, as well as the
+    names of the most-reviewed resources.
+
     Args:
         text: The search text to use.
 
     Returns:
         A JSON array containing suggested searching strings.
     """
-    if text is None:
-        return get_json_response([])
-
-    text = str(text).strip()
+    index, version = get_autocomplete_index()
 
-    if len(text) == 0:
-        return get_json_response([])
+    response = get_json_response(index.search(text or u''))
 
-    text = '%' + text + '%'
+    # Suggestions only change when the index is rebuilt, so let
+    # browsers reuse them until then
+    response.cache_control.public = True
+    response.cache_control.max_age = \
+        current_app.config.get('AUTOCOMPLETE_MAX_AGE', 300)
+    response.set_etag(version)
 
-    # Search for visible categories matching the name/description
-    categories = Category.query. \
-        filter(Category.visible == True). \
-        filter(or_(
-            Category.name.like(text),
-            Category.description.like(text))). \
-        outerjoin(CategoryGroup, Category.grouping). \
-        order_by(
-            CategoryGroup.grouporder,
-            CategoryGroup.name,
-            Category.name). \
-        limit(8). \
-        all()
-
-    # Get the names, converted to JSON, and return those
-    category_json = [cat.name for cat in categories]
-    return get_json_response(category_json)
+    return response.make_conditional(request)
 
 
 @remedy.route('/submit-provider/', methods=['GET', 'POST'])
@@ -980,15 +1176,11 @@ def submit_provider():
         This template is provided with the following variables:
             form: The WTForm to use for provider/review submission.
     """
-    # Get active categories and populations
-    category_choices = active_categories()
-    population_choices = active_populations()
-
     form = UserSubmitProviderForm(
         request.form,
         None,
-        group_active_categories(category_choices),
-        group_active_populations(population_choices))
+        grouped_active_categories(),
+        grouped_active_populations())
 
     if request.method == 'GET':
         return render_template(
@@ -996,11 +1188,12 @@ def submit_provider():
             form=form)
     else:
         if form.validate_on_submit():
-            # Get the new resource
+            # Get the new resource, loading only the selected
+            # categories and populations
             resource = get_new_resource(
                 form,
-                category_choices,
-                population_choices)
+                categories_with_ids(form.categories.data),
+                populations_with_ids(form.populations.data))
 
             # Add the resource and flush the DB to get the new resource ID
             db.session.add(resource)
@@ -1009,8 +1202,12 @@ def submit_provider():
             # Get the corresponding review
             review = get_new_review(form, resource)
 
-            # Add the review and commit changes
+            # Add the review, update the resource's aggregates
+            # and commit changes
             db.session.add(review)
+            rad.aggregateservice.update_resource_aggregates(
+                db.session,
+                [resource.id])
             db.session.commit()
 
             # Flash a message and send them to the home page
@@ -1085,6 +1282,10 @@ def new_review(resource_id):
                     old_review.is_old_review = True
                     old_review.new_review_id = new_r.id
 
+            rad.aggregateservice.update_resource_aggregates(
+                db.session,
+                [new_r.resource_id])
+
             db.session.commit()
 
             # Redirect the user to the resource
@@ -1157,13 +1358,11 @@ def settings():
         This template is provided with the following variables:
             form: The WTForm to use for changing profile options.
     """
-    # Prefill with existing user settings and get active populations
-    population_choices = active_populations()
-
+    # Prefill with existing user settings
     form = UserSettingsForm(
         request.form,
         current_user,
-        group_active_populations(population_choices))
+        grouped_active_populations())
 
     if request.method == 'GET':
         return render_template(
@@ -1182,6 +1381,8 @@ def settings():
 
             # Process population IDs
             pop_ids = set(form.populations.data)
+            populations_changed = \
+                pop_ids != set(p.id for p in current_user.populations)
 
             for cur_pop in current_user.populations:
                 # Remove any existing populations not in the set
@@ -1192,19 +1393,19 @@ def settings():
                     pop_ids.discard(cur_pop.id)
 
             # Now iterate over any new populations
-            for new_pop_id in pop_ids:
-                # Find it in our population choices
-                new_pop = find_by_id(population_choices, new_pop_id)
-
-                # Make sure we found it and that the current user doesn't
-                # already have it
-                if new_pop and \
-                        find_by_id(
-                            current_user.populations,
-                            new_pop_id
-                        ) is None:
+            for new_pop in populations_with_ids(list(pop_ids)):
+                # Make sure the current user doesn't already have it
+                if find_by_id(
+                        current_user.populations,
+                        new_pop.id) is None:
                     current_user.populations.append(new_pop)
 
+            # The user's reviews now count towards different populations
+            if populations_changed:
+                rad.aggregateservice.update_user_aggregates(
+                    db.session,
+                    current_user.id)
+
             db.session.commit()
 
             flash('Your profile has been updated!', 'success')
@@ -1326,10 +1527,10 @@ def get_new_resource(form, category_choices, population_choices):
     Args:
         form: The WTForms Form instance to use.
             Should incorporate the ProviderFieldsMixin mixin.
-        category_choices: The list of active categories
-            available for selection.
-        population_choices: The list of active populations
-            available for selection.
+        category_choices: The list of selected active categories.
+            Categories not selected on the form are ignored.
+        population_choices: The list of selected active populations.
+            Populations not selected on the form are ignored.
 
     Returns:
         An instantiated/inflated Resource instance.
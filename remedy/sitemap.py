@@ -55,17 +55,23 @@ def add_url(
         ET.SubElement(url_elem, 'changefreq').text = frequency
 
 
-def create_sitemap(application):
+def create_sitemap(application, dest_folder=None):
     """
     Creates a robots.txt and sitemap file.
+
+    Args:
+        application: The application.
+        dest_folder: The folder to write the files to. Defaults to
+            the robots folder served by the application.
     """
     with application.app_context():
 
         base = application.config.get('BASE_URL', 'https://radremedy.org')
 
-        dest_folder = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            'robots')
+        if dest_folder is None:
+            dest_folder = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                'robots')
 
         print 'Outputting to ' + dest_folder
 
@@ -1,3 +1,5 @@
 #!/bin/sh
 
-mysql --host=$RAD_DB_HOSTNAME --user=$RAD_DB_USERNAME --password=$RAD_DB_PASSWORD --database=$RAD_DB_NAME < ./calculate_review_aggregates.sql
+# Aggregates are maintained as reviews change - this verifies them
+# and recalculates any that have drifted.
+cd "$(dirname "$0")/.." && python application.py aggregates --repair
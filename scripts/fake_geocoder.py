@@ -0,0 +1,171 @@
+"""
+fake_geocoder.py
+
+Runs a local web service that imitates the Google geocoding API, which
+can be used to test geocoding large numbers of resources without
+making requests to Google.
+
+Each address is given made-up (but consistent) coordinates in Chicago.
+Addresses containing "nowhere" are not found.
+
+Args:
+    --port: The port to listen on. Defaults to 8089.
+    --latency: The number of seconds to wait before each response.
+    --rate-limit: The number of requests allowed each second before
+        OVER_QUERY_LIMIT responses are returned.
+    --error-rate: The fraction of requests that should fail with a
+        503 (Service Unavailable) error.
+
+Sample usage:
+    python fake_geocoder.py --port 8089 --latency 0.2 --rate-limit 20
+
+Then set GEOCODER_DOMAIN = 'localhost:8089' and GEOCODER_SCHEME = 'http'
+in the application's configuration.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+
+class RequestCounter(object):
+    """
+    Counts the requests made in the current second.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.second = 0
+        self.count = 0
+
+    def increment(self):
+        """
+        Counts a request.
+
+        Returns:
+            The number of requests made so far in the current second.
+        """
+        with self.lock:
+            second = int(time.time())
+
+            if second != self.second:
+                self.second = second
+                self.count = 0
+
+            self.count += 1
+            return self.count
+
+
+def get_place(address):
+    """
+    Builds a made-up geocoding result for the provided address.
+
+    Args:
+        address: The address to geocode.
+
+    Returns:
+        A dictionary in the same format as a Google geocoding result.
+    """
+    digest = hashlib.sha1(address.lower().encode('utf-8')).hexdigest()
+
+    return {
+        'formatted_address': address.split(',')[0].strip().title() +
+        ', Chicago, IL 60601, USA',
+        'geometry': {
+            'location': {
+                'lat': 41.8 + int(digest[:4], 16) / 655360.0,
+                'lng': -87.6 - int(digest[4:8], 16) / 655360.0
+            }
+        },
+        'address_components': [
+            {
+                'long_name': 'Chicago',
+                'short_name': 'Chicago',
+                'types': ['locality', 'political']
+            },
+            {
+                'long_name': 'Cook County',
+                'short_name': 'Cook County',
+                'types': ['administrative_area_level_2', 'political']
+            },
+            {
+                'long_name': 'Illinois',
+                'short_name': 'IL',
+                'types': ['administrative_area_level_1', 'political']
+            }
+        ]
+    }
+
+
+class GeocodeHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the fake geocoding API.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path != '/maps/api/geocode/json':
+            self.send_error(404)
+            return
+
+        time.sleep(self.server.latency)
+
+        address = parse_qs(url.query).get('address', [''])[0]. \
+            decode('utf-8')
+
+        if random.random() < self.server.error_rate:
+            self.send_error(503)
+            return
+
+        if self.server.rate_limit and \
+                self.server.counter.increment() > self.server.rate_limit:
+            result = {'status': 'OVER_QUERY_LIMIT', 'results': []}
+        elif 'nowhere' in address.lower():
+            result = {'status': 'ZERO_RESULTS', 'results': []}
+        else:
+            result = {'status': 'OK', 'results': [get_place(address)]}
+
+        body = json.dumps(result)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't log every request
+        pass
+
+
+class FakeGeocoderServer(ThreadingMixIn, HTTPServer):
+    """
+    A multi-threaded server for the fake geocoding API.
+    """
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs a fake geocoding service.')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeGeocoderServer(('localhost', args.port), GeocodeHandler)
+    server.latency = args.latency
+    server.rate_limit = args.rate_limit
+    server.error_rate = args.error_rate
+    server.counter = RequestCounter()
+
+    print('Fake geocoder listening on port ' + str(args.port))
+    server.serve_forever()